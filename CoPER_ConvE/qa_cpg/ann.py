@@ -0,0 +1,243 @@
+"""Approximate top-k retrieval of ConvE answers, using an inverted file index with product quantization (IVF-PQ).
+
+ConvE scores entity `e` for a query with predicted embedding `q` as `q . ent_emb[e] + pred_bias[e]`, and so finding
+the highest scoring entities is a maximum inner product search (MIPS). The entity embeddings are augmented with
+their biases and with an extra coordinate that makes all their norms equal, which reduces MIPS to a nearest neighbor
+search. The index then only scans the entities in the `num_probes` clusters closest to each query, ranks them by
+their (product quantized) approximate distances, and re-scores the `num_candidates` best ones exactly.
+
+Running this module compares the index against exact scoring for random queries, and reports recall@k along with
+the query times.
+
+Usage:
+    python -m qa_cpg.ann --config [config.yml] --data_dir [data_dir] --checkpoint [ckpt] --num_probes 1 4 16
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import tensorflow as tf
+import time
+import yaml
+
+from .data import _DataLoader
+from .experiment import create_model
+from .utils.dict_with_attributes import AttributeDict
+
+__all__ = ['IVFPQIndex', 'exact_top_k', 'recall_at_k']
+
+logger = logging.getLogger(__name__)
+
+
+def _squared_distances(x, centroids):
+    return (np.sum(x ** 2, axis=1, keepdims=True) - 2 * np.dot(x, centroids.T) +
+            np.sum(centroids ** 2, axis=1)[None, :])
+
+
+def _kmeans(x, num_clusters, num_iterations, random_state, batch_size=65536):
+    """Runs Lloyd's k-means algorithm and returns the centroids and the cluster assignments."""
+    num_clusters = min(num_clusters, len(x))
+    centroids = x[random_state.choice(len(x), num_clusters, replace=False)].copy()
+    assignments = np.zeros([len(x)], dtype=np.int64)
+    for _ in range(num_iterations):
+        for start in range(0, len(x), batch_size):
+            batch = x[start:start + batch_size]
+            assignments[start:start + batch_size] = np.argmin(_squared_distances(batch, centroids), axis=1)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        # Empty clusters keep their previous centroids.
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return centroids, assignments
+
+
+def exact_top_k(queries, ent_emb, pred_bias, k):
+    """Returns the scores and indices of the `k` highest scoring entities for each query, sorted by score."""
+    scores = np.dot(queries, ent_emb.T) + pred_bias[None, :]
+    indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_k_scores = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top_k_scores, axis=1)
+    return np.take_along_axis(top_k_scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def recall_at_k(approximate_indices, exact_indices):
+    """Returns the average fraction of the exact top-k entities that are also in the approximate top-k."""
+    hits = [len(np.intersect1d(approximate, exact)) for approximate, exact in zip(approximate_indices, exact_indices)]
+    return float(np.sum(hits)) / exact_indices.size
+
+
+class IVFPQIndex(object):
+    """Inverted file index with product quantization, for the top-k queries of a ConvE model.
+
+    Arguments:
+        ent_emb (np.ndarray): Entity embeddings, with shape `[num_ent, ent_emb_size]`.
+        pred_bias (np.ndarray): Entity biases, with shape `[num_ent]`.
+        num_lists (int, optional): Number of clusters (inverted lists). Defaults to `sqrt(num_ent)`.
+        num_subspaces (int, optional): Number of subspaces used for product quantization.
+        num_codes (int, optional): Number of codes per subspace (at most 256).
+        num_iterations (int, optional): Number of k-means iterations used to train the quantizers.
+        seed (int, optional): Random seed.
+    """
+
+    def __init__(self, ent_emb, pred_bias, num_lists=None, num_subspaces=8, num_codes=256, num_iterations=10,
+                 seed=0):
+        assert num_codes <= 256, 'Parameter `num_codes` must be at most 256, so that codes fit in one byte.'
+        random_state = np.random.RandomState(seed)
+        self.ent_emb = np.asarray(ent_emb, dtype=np.float32)
+        self.pred_bias = np.asarray(pred_bias, dtype=np.float32)
+        num_ent = len(self.ent_emb)
+        if num_lists is None:
+            num_lists = int(np.sqrt(num_ent))
+
+        # Append the biases and a coordinate that makes all norms equal, so that the inner products can be found
+        # using Euclidean distances. The vectors are also zero-padded to a multiple of `num_subspaces`.
+        augmented = np.concatenate([self.ent_emb, self.pred_bias[:, None]], axis=1)
+        norms = np.sum(augmented ** 2, axis=1)
+        extra = np.sqrt(np.maximum(np.max(norms) - norms, 0.0))
+        augmented = np.concatenate([augmented, extra[:, None]], axis=1)
+        self.num_subspaces = num_subspaces
+        self.dim = augmented.shape[1]
+        self.padded_dim = -(-self.dim // num_subspaces) * num_subspaces
+        augmented = np.pad(augmented, [(0, 0), (0, self.padded_dim - self.dim)], 'constant')
+
+        # Coarse quantizer.
+        self.centroids, assignments = _kmeans(augmented, num_lists, num_iterations, random_state)
+        order = np.argsort(assignments, kind='stable')
+        self.list_indices = order
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))])
+
+        # Product quantizer of the residuals, stored in the order of the inverted lists.
+        residuals = (augmented - self.centroids[assignments])[order]
+        subspace_dim = self.padded_dim // num_subspaces
+        self.codebooks = np.zeros([num_subspaces, min(num_codes, num_ent), subspace_dim], dtype=np.float32)
+        self.codes = np.zeros([num_ent, num_subspaces], dtype=np.uint8)
+        for s in range(num_subspaces):
+            subspace = residuals[:, s * subspace_dim:(s + 1) * subspace_dim]
+            self.codebooks[s], self.codes[:, s] = _kmeans(subspace, num_codes, num_iterations, random_state)
+
+    def _augment_queries(self, queries):
+        queries = np.asarray(queries, dtype=np.float32)
+        augmented = np.concatenate([queries, np.ones([len(queries), 1], dtype=np.float32)], axis=1)
+        return np.pad(augmented, [(0, 0), (0, self.padded_dim - augmented.shape[1])], 'constant')
+
+    def search(self, queries, k, num_probes=8, num_candidates=100):
+        """Returns the approximate top-`k` entities for each query.
+
+        Arguments:
+            queries (np.ndarray): Predicted embeddings, with shape `[num_queries, ent_emb_size]`.
+            k (int): Number of entities to return per query.
+            num_probes (int, optional): Number of inverted lists that are scanned per query.
+            num_candidates (int, optional): Number of candidates (ranked by their approximate distances) that are
+                re-scored exactly. At least `k` candidates are always re-scored.
+
+        Returns:
+            Tuple containing the exact scores and the indices of the returned entities, with shape
+            `[num_queries, k]`, sorted by score. If fewer than `k` entities are scanned, the remaining indices are -1
+            and the remaining scores are `-inf`.
+        """
+        num_candidates = max(num_candidates, k)
+        queries = np.asarray(queries, dtype=np.float32)
+        augmented = self._augment_queries(queries)
+        num_probes = min(num_probes, len(self.centroids))
+        probes = np.argsort(_squared_distances(augmented, self.centroids), axis=1)[:, :num_probes]
+        subspace_dim = self.padded_dim // self.num_subspaces
+        top_k_scores = np.full([len(augmented), k], -np.inf, dtype=np.float32)
+        top_k_indices = np.full([len(augmented), k], -1, dtype=np.int64)
+        for i, (query, query_probes) in enumerate(zip(augmented, probes)):
+            positions, distances = [], []
+            for probe in query_probes:
+                start, end = self.list_offsets[probe], self.list_offsets[probe + 1]
+                if start == end:
+                    continue
+                # Asymmetric distances between the query residual and the quantized entity residuals.
+                residual = (query - self.centroids[probe]).reshape(self.num_subspaces, 1, subspace_dim)
+                tables = np.sum((residual - self.codebooks) ** 2, axis=2)
+                codes = self.codes[start:end]
+                distances.append(np.sum(tables[np.arange(self.num_subspaces)[None, :], codes], axis=1))
+                positions.append(np.arange(start, end))
+            if not positions:
+                continue
+            positions = np.concatenate(positions)
+            distances = np.concatenate(distances)
+            if len(positions) > num_candidates:
+                positions = positions[np.argpartition(distances, num_candidates - 1)[:num_candidates]]
+            candidates = self.list_indices[positions]
+
+            # Re-score the candidates exactly.
+            scores = np.dot(self.ent_emb[candidates], queries[i]) + self.pred_bias[candidates]
+            order = np.argsort(-scores)[:k]
+            top_k_scores[i, :len(order)] = scores[order]
+            top_k_indices[i, :len(order)] = candidates[order]
+        return top_k_scores, top_k_indices
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', required=True, help='Path to the config file saved while training.')
+    parser.add_argument('--data_dir', required=True, help='Directory containing `entities.txt` and `relations.txt`.')
+    parser.add_argument('--checkpoint', required=True, help='Path to the checkpoint of the trained model.')
+    parser.add_argument('--use_parameter_lookup', action='store_true')
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--num_lists', type=int, default=None)
+    parser.add_argument('--num_subspaces', type=int, default=8)
+    parser.add_argument('--num_probes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--num_candidates', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to.')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as handle:
+        cfg = AttributeDict(yaml.safe_load(handle))
+    num_ent = len(_DataLoader._read_index_file(os.path.join(args.data_dir, 'entities.txt')))
+    num_rel = len(_DataLoader._read_index_file(os.path.join(args.data_dir, 'relations.txt')))
+
+    # Compute the predicted embeddings of random queries.
+    random_state = np.random.RandomState(args.seed)
+    with tf.Graph().as_default():
+        model = create_model(
+            cfg, num_ent, num_rel, use_parameter_lookup=args.use_parameter_lookup, inference_only=True)
+        pred_bias = tf.convert_to_tensor(model.variables['pred_bias'])
+        with tf.Session() as session:
+            tf.train.Saver().restore(session, args.checkpoint)
+            ent_emb, pred_bias = session.run([model.ent_emb_table, pred_bias])
+            queries = session.run(model.predicted_e2_emb, feed_dict={
+                model.e1: random_state.randint(num_ent, size=args.num_queries),
+                model.rel: random_state.randint(num_rel, size=args.num_queries)})
+
+    start_time = time.time()
+    _, exact_indices = exact_top_k(queries, ent_emb, pred_bias, args.k)
+    exact_ms = (time.time() - start_time) * 1000.0 / args.num_queries
+
+    start_time = time.time()
+    index = IVFPQIndex(
+        ent_emb, pred_bias, num_lists=args.num_lists, num_subspaces=args.num_subspaces, seed=args.seed)
+    logger.info('Built the index in %.1f seconds.', time.time() - start_time)
+
+    results = []
+    for num_probes in args.num_probes:
+        start_time = time.time()
+        _, indices = index.search(queries, args.k, num_probes=num_probes, num_candidates=args.num_candidates)
+        ann_ms = (time.time() - start_time) * 1000.0 / args.num_queries
+        result = {
+            'num_probes': num_probes,
+            'num_candidates': args.num_candidates,
+            'recall@%d' % args.k: recall_at_k(indices, exact_indices),
+            'ann_ms_per_query': ann_ms,
+            'exact_ms_per_query': exact_ms}
+        logger.info(
+            'Probes: %4d | Recall@%d: %.4f | ANN: %8.3f ms/query | Exact: %8.3f ms/query',
+            num_probes, args.k, result['recall@%d' % args.k], ann_ms, exact_ms)
+        results.append(result)
+
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
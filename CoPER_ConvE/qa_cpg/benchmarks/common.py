@@ -0,0 +1,139 @@
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import json
+import logging
+import time
+import numpy as np
+import tensorflow as tf
+
+from ..models import ConvE
+
+__all__ = [
+    'create_model', 'create_session', 'synthetic_train_dataset', 'time_steps', 'train_session',
+    'write_results']
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_train_dataset(num_ent, num_rel, batch_size, num_labels=None, seed=0):
+    """Creates an infinite dataset of random training batches, matching the inputs of `ConvE`.
+
+    Arguments:
+        num_ent (int): Number of entities.
+        num_rel (int): Number of relations.
+        batch_size (int): Batch size.
+        num_labels (int, optional): Number of labels per sample when using negative sampling. If `None`, all
+            entities are scored.
+        seed (int, optional): Random seed.
+
+    Returns:
+        `tf.data.Dataset` producing batches.
+    """
+    def sample(_):
+        e1 = tf.random_uniform([batch_size], maxval=num_ent, dtype=tf.int64, seed=seed)
+        e2 = tf.random_uniform([batch_size], maxval=num_ent, dtype=tf.int64, seed=seed + 1)
+        rel = tf.random_uniform([batch_size], maxval=num_rel, dtype=tf.int64, seed=seed + 2)
+        if num_labels is None:
+            e2_multi = tf.random_uniform([batch_size, num_ent], seed=seed + 3)
+            lookup_values = tf.zeros([batch_size, 0], dtype=tf.int32)
+        else:
+            e2_multi = tf.random_uniform([batch_size, num_labels], seed=seed + 3)
+            lookup_values = tf.random_uniform(
+                [batch_size, num_labels], maxval=num_ent, dtype=tf.int32, seed=seed + 4)
+        return {
+            'e1': e1,
+            'e2': e2,
+            'rel': rel,
+            'e2_multi': tf.cast(tf.less(e2_multi, 0.01), tf.float32),
+            'e2_answers': tf.zeros([batch_size, 0], dtype=tf.int64),
+            'lookup_values': lookup_values}
+
+    return tf.data.Dataset.range(1).repeat().map(sample).prefetch(16)
+
+
+def create_model(num_ent, num_rel, **model_descriptors):
+    """Creates a `ConvE` model with the default CPG configuration, overridden by `model_descriptors`."""
+    descriptors = {
+        'use_negative_sampling': True,
+        'label_smoothing_epsilon': 0.1,
+        'num_ent': num_ent,
+        'num_rel': num_rel,
+        'ent_emb_size': 200,
+        'rel_emb_size': 32,
+        'context_rel_conv': [],
+        'context_rel_out': [],
+        'context_rel_dropout': 0.2,
+        'context_rel_use_batch_norm': True,
+        'input_dropout': 0.2,
+        'hidden_dropout': 0.3,
+        'output_dropout': 0.2,
+        'learning_rate': 0.001,
+        'add_loss_summaries': False,
+        'add_variable_summaries': False,
+        'add_tensor_summaries': False,
+        'batch_norm_momentum': 0.99,
+        'batch_norm_train_stats': True}
+    descriptors.update(model_descriptors)
+    with tf.variable_scope('variables', use_resource=True):
+        return ConvE(model_descriptors=descriptors)
+
+
+def create_session():
+    """Creates a session that places ops without a kernel for the requested device on the CPU, and that only
+    allocates the GPU memory it needs."""
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    return tf.Session(config=config)
+
+
+@contextlib.contextmanager
+def train_session(num_ent, num_rel, batch_size, num_labels=None, device='/CPU:0', **model_descriptors):
+    """Creates a model on `device` in a new graph, fed by `synthetic_train_dataset`, along with a session in which
+    its variables are initialized.
+
+    Arguments:
+        num_ent (int): Number of entities.
+        num_rel (int): Number of relations.
+        batch_size (int): Batch size.
+        num_labels (int, optional): Number of labels per sample when using negative sampling.
+        device (str, optional): Device on which to create the model.
+        **model_descriptors: Model descriptors that override the defaults of `create_model`.
+
+    Yields:
+        `(session, model, feed_dict)` tuple, where `feed_dict` feeds the training batches to the model.
+    """
+    with tf.Graph().as_default():
+        dataset = synthetic_train_dataset(num_ent, num_rel, batch_size, num_labels)
+        iterator = dataset.make_one_shot_iterator()
+        with tf.device(device):
+            model = create_model(num_ent, num_rel, **model_descriptors)
+        with create_session() as session:
+            session.run(tf.global_variables_initializer())
+            feed_dict = {
+                model.is_train: True,
+                model.input_iterator_handle: session.run(iterator.string_handle())}
+            yield session, model, feed_dict
+
+
+def time_steps(session, fetches, feed_dict=None, num_warmup_steps=10, num_steps=50):
+    """Runs `fetches` repeatedly and returns statistics about the step times, in milliseconds."""
+    for _ in range(num_warmup_steps):
+        session.run(fetches, feed_dict)
+    step_times = []
+    for _ in range(num_steps):
+        start_time = time.time()
+        session.run(fetches, feed_dict)
+        step_times.append((time.time() - start_time) * 1000.0)
+    step_times = np.asarray(step_times)
+    return {
+        'mean_ms': float(np.mean(step_times)),
+        'p50_ms': float(np.percentile(step_times, 50)),
+        'p90_ms': float(np.percentile(step_times, 90))}
+
+
+def write_results(path, results):
+    """Writes the benchmark results to a JSON file."""
+    with open(path, 'w') as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+    logger.info('Benchmark results written to: %s', path)
@@ -0,0 +1,76 @@
+"""Compares the per-sample convolution implementations used by CPG ConvE models.
+
+Usage:
+    python -m qa_cpg.benchmarks.conv --batch_sizes 128 256 512
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import numpy as np
+import tensorflow as tf
+
+from .common import time_steps, train_session, write_results
+from ..models import _per_sample_conv2d
+
+logger = logging.getLogger(__name__)
+
+_CONV_IMPLS = ['map_fn', 'im2col']
+
+
+def _max_abs_difference(batch_size, seed=0):
+    # Checks that all implementations compute the same convolution.
+    with tf.Graph().as_default():
+        inputs = tf.random_normal([batch_size, 10, 20, 1], seed=seed)
+        filters = tf.random_normal([batch_size, 3, 3, 1, 32], seed=seed + 1)
+        outputs = [_per_sample_conv2d(inputs, filters, impl=impl) for impl in _CONV_IMPLS]
+        with tf.Session() as session:
+            outputs = session.run(outputs)
+    return float(max(np.max(np.abs(outputs[0] - output)) for output in outputs[1:]))
+
+
+def _benchmark_step(conv_impl, batch_size, args):
+    with train_session(
+            args.num_ent, args.num_rel, batch_size, args.num_labels, args.device,
+            conv_impl=conv_impl) as (session, model, feed_dict):
+        return time_steps(
+            session, model.train_op, feed_dict, num_warmup_steps=args.num_warmup_steps, num_steps=args.num_steps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 128, 256, 512])
+    parser.add_argument('--num_ent', type=int, default=14541)
+    parser.add_argument('--num_rel', type=int, default=474)
+    parser.add_argument('--num_labels', type=int, default=1000)
+    parser.add_argument('--num_warmup_steps', type=int, default=10)
+    parser.add_argument('--num_steps', type=int, default=50)
+    parser.add_argument('--device', default='/GPU:0')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='Maximum absolute difference allowed between the outputs of the implementations.')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to.')
+    args = parser.parse_args()
+
+    results = []
+    for batch_size in args.batch_sizes:
+        result = {'batch_size': batch_size, 'max_abs_difference': _max_abs_difference(batch_size)}
+        for conv_impl in _CONV_IMPLS:
+            result[conv_impl] = _benchmark_step(conv_impl, batch_size, args)
+        result['speedup'] = result['map_fn']['mean_ms'] / result['im2col']['mean_ms']
+        logger.info(
+            'Batch size %5d | map_fn: %8.2f ms | im2col: %8.2f ms | speedup: %5.2fx | max abs diff: %.2e',
+            batch_size, result['map_fn']['mean_ms'], result['im2col']['mean_ms'], result['speedup'],
+            result['max_abs_difference'])
+        results.append(result)
+
+    if args.output is not None:
+        write_results(args.output, results)
+
+    mismatches = [result['batch_size'] for result in results if result['max_abs_difference'] > args.tolerance]
+    if mismatches:
+        raise RuntimeError('The convolution implementations differ by more than %g for batch sizes: %s' % (
+            args.tolerance, ', '.join(str(batch_size) for batch_size in mismatches)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""Measures where the time goes when training and evaluating ConvE models, one stage at a time.
+
+The following stages are measured separately:
+    - `tf_records`: Creation of the TF record files (including preprocessing), from the raw dataset files.
+    - `train_dataset`: Throughput of `train_dataset` (in samples per second), for each negative sampling mode.
+    - `train_step`: Step time of plain, CPG, and parameter lookup models, for several batch sizes. The models are fed
+      by synthetic in-memory batches, and so the input pipeline is not included.
+    - `ranking`: Latency of `ranking_and_hits` on the dev split.
+
+The benchmarks run either on a synthetic dataset (the default), or on a real dataset given by the name of its data
+loader class (e.g., `NELL995Loader`) and its data directory (e.g., `data/nell-995`, where any missing raw files are
+downloaded). The raw files are copied to a temporary directory, so that the TF record files are always recreated.
+
+Usage:
+    python -m qa_cpg.benchmarks.suite --output suite.json
+    python -m qa_cpg.benchmarks.suite --loader NELL995Loader --data_dir data/nell-995 --output suite.json
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+import tensorflow as tf
+
+from .common import create_model, create_session, time_steps, train_session, write_results
+from .. import data
+from ..data import _DataLoader
+from ..metrics import ranking_and_hits
+
+logger = logging.getLogger(__name__)
+
+_BENCHMARKS = ['tf_records', 'train_dataset', 'train_step', 'ranking']
+
+# Options of `train_dataset` for each negative sampling mode.
+_NEGATIVE_SAMPLING_MODES = {
+    'none': {'num_labels': None},
+    'per_sample': {'one_positive_label_per_sample': False},
+    'one_positive_per_sample': {'one_positive_label_per_sample': True},
+    'batch': {'one_positive_label_per_sample': False, 'batch_negative_sampling': True},
+    'batch_shared': {'one_positive_label_per_sample': False, 'batch_negative_sampling': True,
+                     'share_negatives': True}}
+
+# Model descriptors of each model type, which override the default CPG configuration of `common.create_model`.
+_MODEL_TYPES = {
+    'plain': {'context_rel_conv': None, 'context_rel_out': None},
+    'cpg': {},
+    'param_lookup': {'do_parameter_lookup': True}}
+
+
+class _SyntheticLoader(_DataLoader):
+    """Loads a synthetic dataset whose raw files have been written by `_write_synthetic_dataset`."""
+
+    def __init__(self):
+        super(_SyntheticLoader, self).__init__(
+            url=None, filenames=['train.txt', 'dev.txt', 'test.txt'], dataset_name='synthetic',
+            filetypes=['train', 'dev', 'test'], add_reverse_per_filetype=[True, False, False])
+
+
+def _write_synthetic_dataset(directory, num_ent, num_rel, num_triples, seed=0):
+    """Writes random triples to `train.txt`, `dev.txt`, and `test.txt`, using 90%, 5%, and 5% of them."""
+    rng = np.random.RandomState(seed)
+    triples = np.stack([
+        rng.randint(num_ent, size=num_triples),
+        rng.randint(num_rel, size=num_triples),
+        rng.randint(num_ent, size=num_triples)], axis=1)
+    splits = np.split(triples, [int(0.9 * num_triples), int(0.95 * num_triples)])
+    for filename, split in zip(['train.txt', 'dev.txt', 'test.txt'], splits):
+        with open(os.path.join(directory, filename), 'w') as handle:
+            for e1, rel, e2 in split:
+                handle.write('entity_%d\trelation_%d\tentity_%d\n' % (e1, rel, e2))
+
+
+def _prepare_raw_files(args, directory):
+    """Writes or copies the raw dataset files to `directory` and returns the data loader of the dataset."""
+    if args.loader is None:
+        _write_synthetic_dataset(directory, args.num_ent, args.num_rel, args.num_triples)
+        return _SyntheticLoader()
+    loader = getattr(data, args.loader)()
+    for filename in loader.filenames:
+        path = os.path.join(args.data_dir, filename)
+        if os.path.exists(path):
+            shutil.copy(path, directory)
+    return loader
+
+
+def benchmark_tf_records(data_loader, directory):
+    """Returns the time taken to create the TF record files, in seconds."""
+    start_time = time.time()
+    data_loader.maybe_create_tf_record_files(directory)
+    return {'seconds': time.time() - start_time}
+
+
+def benchmark_train_dataset(data_loader, directory, args):
+    """Returns the throughput of `train_dataset` (in samples per second) for each negative sampling mode."""
+    results = {}
+    for mode, options in sorted(_NEGATIVE_SAMPLING_MODES.items()):
+        options = dict({
+            'prop_negatives': args.prop_negatives,
+            'num_labels': args.num_labels,
+            'negative_sampling_distribution': args.negative_sampling_distribution}, **options)
+        with tf.Graph().as_default():
+            dataset = data_loader.train_dataset(
+                directory=directory, batch_size=args.dataset_batch_size, buffer_size=1024, prefetch_buffer_size=16,
+                **options)
+            iterator = dataset.make_initializable_iterator()
+            next_batch = iterator.get_next()
+            with tf.Session() as session:
+                data.initialize_query_tables(session)
+                session.run(iterator.initializer)
+                times = time_steps(
+                    session, next_batch, num_warmup_steps=args.num_warmup_steps, num_steps=args.num_steps)
+        times['samples_per_second'] = args.dataset_batch_size * 1000.0 / times['mean_ms']
+        logger.info('Train dataset | %-24s | %10.1f samples/s', mode, times['samples_per_second'])
+        results[mode] = times
+    return results
+
+
+def benchmark_train_step(num_ent, num_rel, args):
+    """Returns the step times of each model type, for each batch size."""
+    results = {}
+    for model_type, model_descriptors in sorted(_MODEL_TYPES.items()):
+        results[model_type] = {}
+        for batch_size in args.batch_sizes:
+            with train_session(
+                    num_ent, num_rel, batch_size, args.num_labels, args.device,
+                    **model_descriptors) as (session, model, feed_dict):
+                times = time_steps(
+                    session, model.train_op, feed_dict,
+                    num_warmup_steps=args.num_warmup_steps, num_steps=args.num_steps)
+            logger.info('Train step | %-12s | Batch size %5d | %8.2f ms', model_type, batch_size, times['mean_ms'])
+            results[model_type][str(batch_size)] = times
+    return results
+
+
+def benchmark_ranking(data_loader, directory, args):
+    """Returns the latency of `ranking_and_hits` on the dev split, in seconds."""
+    with tf.Graph().as_default():
+        dev_dataset = data_loader.eval_dataset(
+            directory=directory, dataset_type='dev', batch_size=args.eval_batch_size, include_inv_relations=False,
+            buffer_size=1024, prefetch_buffer_size=16)
+        dev_iterator = dev_dataset.make_initializable_iterator()
+        with tf.device(args.device):
+            model = create_model(data_loader.num_ent, data_loader.num_rel)
+        with create_session() as session:
+            session.run(tf.global_variables_initializer())
+            data.initialize_query_tables(session)
+            dev_iterator_handle = session.run(dev_iterator.string_handle())
+            latencies = []
+            for _ in range(args.num_ranking_runs):
+                session.run(dev_iterator.initializer)
+                start_time = time.time()
+                ranking_and_hits(
+                    model, os.path.join(directory, 'ranking'), dev_iterator_handle, 'dev_evaluation',
+                    session=session)
+                latencies.append(time.time() - start_time)
+    results = {'mean_seconds': float(np.mean(latencies)), 'min_seconds': float(np.min(latencies))}
+    logger.info('Ranking | %8.3f s', results['mean_seconds'])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--benchmarks', nargs='+', choices=_BENCHMARKS, default=_BENCHMARKS)
+    parser.add_argument('--loader', default=None,
+                        help='Name of the data loader class (e.g., `NELL995Loader`). Defaults to a synthetic dataset.')
+    parser.add_argument('--data_dir', default=None, help='Directory containing the raw files of the dataset.')
+    parser.add_argument('--num_ent', type=int, default=14541, help='Number of entities of the synthetic dataset.')
+    parser.add_argument('--num_rel', type=int, default=237, help='Number of relations of the synthetic dataset.')
+    parser.add_argument('--num_triples', type=int, default=300000,
+                        help='Number of triples of the synthetic dataset.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[128, 256, 512])
+    parser.add_argument('--dataset_batch_size', type=int, default=512)
+    parser.add_argument('--eval_batch_size', type=int, default=512)
+    parser.add_argument('--num_labels', type=int, default=1000)
+    parser.add_argument('--prop_negatives', type=float, default=10.0)
+    parser.add_argument('--negative_sampling_distribution', default='uniform')
+    parser.add_argument('--num_warmup_steps', type=int, default=10)
+    parser.add_argument('--num_steps', type=int, default=50)
+    parser.add_argument('--num_ranking_runs', type=int, default=3)
+    parser.add_argument('--device', default='/CPU:0')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to.')
+    args = parser.parse_args()
+    assert args.loader is None or args.data_dir is not None, 'Parameter `data_dir` is required with `loader`.'
+
+    directory = tempfile.mkdtemp()
+    try:
+        data_loader = _prepare_raw_files(args, directory)
+        results = {'dataset': args.loader or 'synthetic'}
+        # The TF record files are needed by all other dataset benchmarks, and so they are always created.
+        tf_records_results = benchmark_tf_records(data_loader, directory)
+        logger.info('TF records | %8.3f s', tf_records_results['seconds'])
+        if 'tf_records' in args.benchmarks:
+            results['tf_records'] = tf_records_results
+        if 'train_dataset' in args.benchmarks:
+            results['train_dataset'] = benchmark_train_dataset(data_loader, directory, args)
+        if 'train_step' in args.benchmarks:
+            results['train_step'] = benchmark_train_step(data_loader.num_ent, data_loader.num_rel, args)
+        if 'ranking' in args.benchmarks:
+            results['ranking'] = benchmark_ranking(data_loader, directory, args)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output is not None:
+        write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Compares the step times of ConvE models compiled with XLA against those of uncompiled models.
+
+Both the training step and the scoring of all entities (i.e., `predictions_all`) are timed, using batches with a
+fixed shape, so that the compiled graphs are only compiled once (during the warmup steps).
+
+Usage:
+    python -m qa_cpg.benchmarks.xla --batch_sizes 128 256 512 --device /CPU:0
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import numpy as np
+
+from .common import time_steps, train_session, write_results
+
+logger = logging.getLogger(__name__)
+
+
+def _benchmark(use_xla, batch_size, args):
+    with train_session(
+            args.num_ent, args.num_rel, batch_size, args.num_labels, args.device,
+            use_xla=use_xla) as (session, model, train_feed_dict):
+        train_times = time_steps(
+            session, model.train_op, train_feed_dict,
+            num_warmup_steps=args.num_warmup_steps, num_steps=args.num_steps)
+
+        # The scoring inputs are fed directly, similar to the cached evaluation batches.
+        random_state = np.random.RandomState(0)
+        scoring_feed_dict = {
+            model.e1: random_state.randint(args.num_ent, size=batch_size),
+            model.rel: random_state.randint(args.num_rel, size=batch_size)}
+        scoring_times = time_steps(
+            session, model.predictions_all, scoring_feed_dict,
+            num_warmup_steps=args.num_warmup_steps, num_steps=args.num_steps)
+    return {'train': train_times, 'scoring': scoring_times}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[128, 256, 512])
+    parser.add_argument('--num_ent', type=int, default=14541)
+    parser.add_argument('--num_rel', type=int, default=474)
+    parser.add_argument('--num_labels', type=int, default=1000)
+    parser.add_argument('--num_warmup_steps', type=int, default=10)
+    parser.add_argument('--num_steps', type=int, default=50)
+    parser.add_argument('--device', default='/CPU:0')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to.')
+    args = parser.parse_args()
+
+    results = []
+    for batch_size in args.batch_sizes:
+        result = {'batch_size': batch_size}
+        result['uncompiled'] = _benchmark(False, batch_size, args)
+        result['xla'] = _benchmark(True, batch_size, args)
+        for step in ['train', 'scoring']:
+            result[step + '_speedup'] = result['uncompiled'][step]['mean_ms'] / result['xla'][step]['mean_ms']
+            logger.info(
+                'Batch size %5d | %-7s | uncompiled: %8.2f ms | xla: %8.2f ms | speedup: %5.2fx',
+                batch_size, step, result['uncompiled'][step]['mean_ms'], result['xla'][step]['mean_ms'],
+                result[step + '_speedup'])
+        results.append(result)
+
+    if args.output is not None:
+        write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,17 @@
 from __future__ import absolute_import, division, print_function
 
 import abc
+import collections
 import glob
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import tarfile
 import six
 
+import numpy as np
 import requests
 import tensorflow as tf
 
@@ -15,12 +19,41 @@ import tensorflow as tf
 
 from tqdm import tqdm
 
+from .sampling import NegativeSampler, contains_sorted
+
 __all__ = [
     'Loader', 'NationsLoader', 'UMLSLoader', 'KinshipLoader', 'WN18RRLoader', 'YAGO310Loader', 'FB15k237Loader',
-    'CountriesS1Loader', 'CountriesS2Loader', 'CountriesS3Loader', 'NELL995Loader', 'WN18Loader', 'FB15kLoader']
+    'CountriesS1Loader', 'CountriesS2Loader', 'CountriesS3Loader', 'NELL995Loader', 'WN18Loader', 'FB15kLoader',
+    'initialize_query_tables']
 
 logger = logging.getLogger(__name__)
 
+# Bumped whenever the contents of the TF record files change, so that existing files get recreated.
+_TF_RECORD_FORMAT_VERSION = 2
+_TF_RECORD_MANIFEST_FILENAME = 'tfrecords_manifest.json'
+_ENTITY_COUNTS_FILENAME = 'entity_counts.npy'
+_DEFAULT_NUM_TF_RECORD_SHARDS = 16
+
+# Graph collection containing the `_QueryTableVariables` of all datasets created in a graph.
+_QUERY_TABLES_COLLECTION = 'query_tables'
+
+_QueryTableVariables = collections.namedtuple(
+    '_QueryTableVariables', ['key', 'indptr', 'indices', 'initializer', 'feed_dict'])
+
+
+def initialize_query_tables(session):
+    """Loads the query tables of all datasets created in the graph of `session` into their variables.
+
+    The query tables are not embedded in the graph (whose serialized size is limited to 2GB), but are instead fed to
+    the initializers of their variables. This needs to be run once per session, before any dataset iterators are
+    initialized.
+
+    Arguments:
+        session (tf.Session): Session in which to initialize the query tables.
+    """
+    for table in session.graph.get_collection(_QUERY_TABLES_COLLECTION):
+        session.run(table.initializer, table.feed_dict)
+
 
 class Loader(six.with_metaclass(abc.ABCMeta, object)):
     def __init__(self, url, filenames, dataset_name):
@@ -74,17 +107,24 @@ class Loader(six.with_metaclass(abc.ABCMeta, object)):
 
 class _DataLoader(Loader):
     def __init__(self, url, filenames, dataset_name, filetypes=['train', 'dev', 'test'],  needs_test_set_cleaning=False,
-                 add_reverse_per_filetype=None):
+                 add_reverse_per_filetype=None, use_columnar_store=False):
         self.filetypes = filetypes
         if add_reverse_per_filetype is None:
             add_reverse_per_filetype = [True for _ in range(len(filetypes))]
         self.add_reverse_per_filetype = add_reverse_per_filetype
         self.needs_test_set_cleaning = needs_test_set_cleaning
+        # If True, the preprocessed splits are stored as integer-encoded `.npy` columns instead of JSON files.
+        self.use_columnar_store = use_columnar_store
         super(_DataLoader, self).__init__(url, filenames, dataset_name)
 
         # TODO: This is a bad way of "leaking" this information because it may be incomplete when querried.
         self.num_ent = None
         self.num_rel = None
+        self.entity_counts = None
+
+        # Hashes of the TF record inputs, keyed by directory and settings, along with the sizes and modification
+        # times of the input files when they were hashed (see `_tf_record_inputs_hash`).
+        self._tf_record_inputs_hashes = {}
 
     def train_dataset(self,
                       directory,
@@ -97,19 +137,29 @@ class _DataLoader(Loader):
                       prop_negatives=10.0,
                       num_labels=100,
                       cache=False, 
-                      one_positive_label_per_sample=True):
-        conve_parser, filenames = self.maybe_create_tf_record_files(
+                      one_positive_label_per_sample=True,
+                      negative_sampling_distribution='uniform',
+                      batch_negative_sampling=False,
+                      share_negatives=False,
+                      drop_remainder=False,
+                      num_shards=1,
+                      shard_index=0):
+        conve_parser, filenames, query_tables = self.maybe_create_tf_record_files(
             directory, buffer_size=buffer_size)
+        query_table = self._query_table_variables(directory, 'train', query_tables['train'])
+        sampler = NegativeSampler(
+            self.num_ent, distribution=negative_sampling_distribution, entity_counts=self.entity_counts)
 
         conve_files = filenames['train']
 
-        def map_fn(sample):
-            sample = conve_parser(sample)
+        def map_fn(records):
+            # Records are parsed a whole batch at a time.
+            sample = conve_parser(records)
             return {
                 'e1': sample['e1'],
                 'e2': sample['e2'],
                 'rel': sample['rel'],
-                'e2_multi': sample['e2_multi'],
+                'query': sample['query'],
                 'is_inverse': tf.cast(sample['is_inverse'], tf.bool)}
 
         def filter_inv_relations(sample):
@@ -120,13 +170,33 @@ class _DataLoader(Loader):
                 'e1': sample['e1'],
                 'e2': sample['e2'],
                 'rel': sample['rel'],
-                'e2_multi': sample['e2_multi']}
+                'query': sample['query']}
 
-        conve_data = tf.data.Dataset.from_tensor_slices(conve_files) \
-            .interleave(tf.data.TFRecordDataset,
-                        cycle_length=num_parallel_readers,
-                        block_length=batch_size) \
-            .map(map_fn)
+        def add_answers(sample):
+            # Join the sample with its answers from the query table.
+            return {
+                'e1': sample['e1'],
+                'e2': sample['e2'],
+                'rel': sample['rel'],
+                'e2_multi': self._lookup_answers(query_table, sample['query'])}
+
+        # For data-parallel training, each worker only reads a disjoint shard of the training data. Whole files are
+        # assigned to the workers if there are enough files, and individual records otherwise.
+        shard_files = num_shards > 1 and len(conve_files) >= num_shards
+        conve_data = tf.data.Dataset.from_tensor_slices(conve_files)
+        if shard_files:
+            conve_data = conve_data.shard(num_shards, shard_index)
+        conve_data = conve_data.interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=num_parallel_readers,
+            block_length=batch_size,
+            num_parallel_calls=num_parallel_readers)
+        if num_shards > 1 and not shard_files:
+            conve_data = conve_data.shard(num_shards, shard_index)
+        conve_data = conve_data \
+            .batch(batch_size) \
+            .map(map_fn, num_parallel_calls=num_parallel_batches) \
+            .apply(tf.contrib.data.unbatch())
 
         if not include_inv_relations:
             conve_data = conve_data.filter(filter_inv_relations)
@@ -137,12 +207,29 @@ class _DataLoader(Loader):
 
         conve_data = conve_data.repeat()
 
+        if num_labels is not None and batch_negative_sampling:
+            return self._batch_negative_sampling_dataset(
+                conve_data=conve_data,
+                query_table=query_table,
+                batch_size=batch_size,
+                num_parallel_batches=num_parallel_batches,
+                prefetch_buffer_size=prefetch_buffer_size,
+                prop_negatives=prop_negatives,
+                num_labels=num_labels,
+                one_positive_label_per_sample=one_positive_label_per_sample,
+                share_negatives=share_negatives,
+                sampler=sampler,
+                drop_remainder=drop_remainder)
+
+        conve_data = conve_data.map(add_answers)
+
         if num_labels is not None:
             if one_positive_label_per_sample:
                 conve_data = conve_data.map(
                         lambda sample: self._create_negative_sampling_dataset(
                             sample=sample,
-                            num_negative_labels=num_labels-1),
+                            num_negative_labels=num_labels-1,
+                            sampler=sampler),
                     num_parallel_calls=num_parallel_batches)
                 conve_data = conve_data.apply(tf.contrib.data.unbatch())
             else:
@@ -152,15 +239,19 @@ class _DataLoader(Loader):
                     lambda sample: self._sample_negatives(
                         sample=sample,
                         prop_negatives=prop_negatives,
-                        num_labels=num_labels),
+                        num_labels=num_labels,
+                        sampler=sampler),
                     num_parallel_calls=num_parallel_batches)
         else:
             conve_data = conve_data.map(self._add_lookup_values)
 
         conve_data = conve_data.shuffle(buffer_size=1000)
 
+        # Dropping the remainder gives all batches the same static shape, which is needed to avoid recompilations
+        # when the model is compiled with XLA.
         conve_data = conve_data \
-            .batch(batch_size) \
+            .batch(batch_size, drop_remainder=drop_remainder) \
+            .map(self._add_empty_answers) \
             .prefetch(prefetch_buffer_size)
 
         return conve_data
@@ -171,78 +262,302 @@ class _DataLoader(Loader):
                      batch_size,
                      include_inv_relations=True,
                      buffer_size=1024 * 1024,
-                     prefetch_buffer_size=10):
-        parser, filenames = self.maybe_create_tf_record_files(
+                     prefetch_buffer_size=10,
+                     dense_e2_multi=False):
+        """Creates an evaluation dataset.
+
+        Each batch contains the answers of each query both as padded entity indices (`e2_answers`, padded with -1)
+        and, if `dense_e2_multi` is `True`, as a `[batch_size, num_ent]` multi-hot matrix (`e2_multi`). Otherwise,
+        `e2_multi` is empty, which avoids materializing a matrix whose size grows with the number of entities. The
+        models compute the filtered ranks from `e2_answers`, and so the dense matrix is not needed for evaluation.
+        """
+        parser, filenames, query_tables = self.maybe_create_tf_record_files(
             directory, buffer_size=buffer_size)
         filenames = filenames[dataset_type]
+        query_table = self._query_table_variables(directory, dataset_type, query_tables[dataset_type])
 
-        def map_fn(sample):
-            sample = parser(sample)
-            
-            e2_multi = tf.sparse_to_dense(
-                sparse_indices=sample['e2_multi'][:, None],
-                sparse_values=tf.ones([tf.shape(sample['e2_multi'])[0]]),
-                output_shape=[self.num_ent], 
-                validate_indices=False)
-
+        def map_fn(records):
+            # Records are parsed a whole batch at a time.
+            sample = parser(records)
             return {
                 'e1': sample['e1'],
                 'e2': sample['e2'],
                 'rel': sample['rel'],
-                'e2_multi': e2_multi,
+                'query': sample['query'],
                 'is_inverse': tf.cast(sample['is_inverse'], tf.bool)}
 
+        def expand_answers(batch):
+            # Train samples are stored once per query, without a target (i.e., with `e2 = -1`, see
+            # `_graph_samples`). They are expanded to one sample per answer of their query, like the samples of the
+            # other splits, so that they can be ranked.
+            answers = self._lookup_answers_batch(query_table, batch['query'])
+            has_e2 = tf.greater_equal(batch['e2'], 0)
+            e2s = tf.concat([batch['e2'][:, None], answers], axis=1)
+            valid = tf.concat([
+                has_e2[:, None],
+                tf.logical_and(tf.logical_not(has_e2)[:, None], tf.greater_equal(answers, 0))], axis=1)
+            positions = tf.where(valid)
+            expanded = {key: tf.gather(value, positions[:, 0]) for key, value in six.iteritems(batch)}
+            expanded['e2'] = tf.gather_nd(e2s, positions)
+            return expanded
+
         def filter_inv_relations(sample):
             return tf.logical_not(sample['is_inverse'])
 
-        def remove_is_inverse(sample):
-            return {
-                'e1': sample['e1'],
-                'e2': sample['e2'],
-                'rel': sample['rel'],
-                'e2_multi': sample['e2_multi']}
+        def add_answers(batch):
+            # Join the batch with its answers from the query table, which are optionally converted directly to a
+            # multi-hot matrix. Add an empty `lookup_values` tensor to match the inputs in the training dataset and
+            # use a single iterator.
+            answers = self._lookup_answers_batch(query_table, batch['query'])
+            if dense_e2_multi:
+                positions = tf.where(tf.greater_equal(answers, 0))
+                positions = tf.stack([positions[:, 0], tf.gather_nd(answers, positions)], axis=1)
+                e2_multi = tf.scatter_nd(
+                    indices=positions,
+                    updates=tf.ones([tf.shape(positions)[0]]),
+                    shape=tf.stack([tf.shape(answers, out_type=tf.int64)[0], self.num_ent]))
+            else:
+                e2_multi = tf.zeros([tf.shape(answers)[0], 0])
 
-        def add_fake_lookup_vals(sample):
-            # Add an empty `lookup_values` tensor to match the inputs in the training dataset and use a single iterator.
-            lookup_values = tf.zeros(shape=(0,), dtype=tf.int32)
             return {
-                'e1': sample['e1'],
-                'e2': sample['e2'],
-                'rel': sample['rel'],
-                'e2_multi': sample['e2_multi'],
-                'lookup_values': lookup_values}
+                'e1': batch['e1'],
+                'e2': batch['e2'],
+                'rel': batch['rel'],
+                'e2_multi': e2_multi,
+                'e2_answers': answers,
+                'lookup_values': tf.zeros(shape=(tf.shape(batch['e1'])[0], 0), dtype=tf.int32)}
 
         data = tf.data.Dataset.from_tensor_slices(filenames)\
             .flat_map(tf.data.TFRecordDataset)\
-            .map(map_fn)
+            .batch(batch_size)\
+            .map(map_fn)\
+            .map(expand_answers)\
+            .apply(tf.contrib.data.unbatch())
 
+        # The inverse relations are filtered before batching, so that all batches but the last one have
+        # `batch_size` samples.
         if not include_inv_relations:
             data = data.filter(filter_inv_relations)
 
         return data \
-            .map(remove_is_inverse) \
-            .map(add_fake_lookup_vals)  \
             .batch(batch_size) \
+            .map(add_answers) \
+            .prefetch(prefetch_buffer_size)
+
+    def _batch_negative_sampling_dataset(self, conve_data, query_table, batch_size, num_parallel_batches,
+                                         prefetch_buffer_size, prop_negatives, num_labels,
+                                         one_positive_label_per_sample, share_negatives, sampler,
+                                         drop_remainder=False):
+        """Batches the samples first and then draws the negatives for each whole batch at once.
+
+        If `share_negatives` is `True`, a single set of negatives is shared by all samples in a batch, along with
+        one positive per sample (similar to in-batch negatives). In that case, `lookup_values` has shape
+        `[1, batch_size + num_labels]` and `e2_multi` has shape `[batch_size, batch_size + num_labels]`.
+        """
+        if share_negatives:
+            assert not one_positive_label_per_sample, \
+                'Shared negatives are not supported together with `one_positive_label_per_sample`.'
+        if not one_positive_label_per_sample:
+            assert num_labels <= self.num_ent, \
+                'Parameter `num_labels` needs to be at most the total number of entities.'
+
+        def add_answers(batch):
+            # Join the batch with its answers from the query table, padded with -1.
+            return {
+                'e1': batch['e1'],
+                'e2': batch['e2'],
+                'rel': batch['rel'],
+                'e2_multi': self._lookup_answers_batch(query_table, batch['query'])}
+
+        conve_data = conve_data \
+            .shuffle(buffer_size=1000) \
+            .batch(batch_size, drop_remainder=drop_remainder) \
+            .map(add_answers, num_parallel_calls=num_parallel_batches)
+
+        if one_positive_label_per_sample:
+            conve_data = conve_data \
+                .map(lambda batch: self._sample_negatives_one_positive_batch(
+                        batch=batch,
+                        num_negative_labels=num_labels-1,
+                        sampler=sampler),
+                     num_parallel_calls=num_parallel_batches) \
+                .apply(tf.contrib.data.unbatch()) \
+                .shuffle(buffer_size=1000) \
+                .batch(batch_size, drop_remainder=drop_remainder)
+        elif share_negatives:
+            conve_data = conve_data.map(
+                lambda batch: self._sample_shared_negatives_batch(
+                    batch=batch,
+                    num_negative_labels=num_labels,
+                    sampler=sampler),
+                num_parallel_calls=num_parallel_batches)
+        else:
+            conve_data = conve_data.map(
+                lambda batch: self._sample_negatives_batch(
+                    batch=batch,
+                    prop_negatives=prop_negatives,
+                    num_labels=num_labels,
+                    sampler=sampler),
+                num_parallel_calls=num_parallel_batches)
+
+        return conve_data \
+            .map(self._add_empty_answers) \
             .prefetch(prefetch_buffer_size)
 
-    def _sample_negatives(self, sample, prop_negatives, num_labels):
+    @staticmethod
+    def _add_empty_answers(batch):
+        # The padded `e2_answers` are only used for evaluation, but are added to the training batches so that the
+        # same iterator can be used for both.
+        batch = dict(batch)
+        batch['e2_answers'] = tf.zeros([tf.shape(batch['e1'])[0], 0], dtype=tf.int64)
+        return batch
+
+    @staticmethod
+    def _query_table_variables(directory, dataset_type, query_table):
+        """Returns variables holding an `(indptr, indices)` query table, creating them if needed.
+
+        The variables are initialized from placeholders by `initialize_query_tables`, rather than from constants,
+        so that the query tables do not inflate the graph. They are created once per graph, data directory, and
+        split, and are not added to any variable collection, so that they are neither initialized by
+        `tf.global_variables_initializer` nor saved in checkpoints.
+        """
+        graph = tf.get_default_graph()
+        key = (os.path.abspath(directory), dataset_type)
+        for table in graph.get_collection(_QUERY_TABLES_COLLECTION):
+            if table.key == key:
+                return table.indptr, table.indices
+
+        variables, initializers, feed_dict = [], [], {}
+        # The variables are only read by the input pipeline, which runs on the CPU.
+        with tf.device('/CPU:0'), tf.name_scope('%s_query_table' % dataset_type):
+            for name, values in zip(['indptr', 'indices'], query_table):
+                placeholder = tf.placeholder(tf.int64, shape=values.shape, name=name + '_values')
+                variable = tf.Variable(
+                    placeholder, trainable=False, collections=[], name=name, use_resource=True)
+                variables.append(variable)
+                initializers.append(variable.initializer)
+                feed_dict[placeholder] = values
+        graph.add_to_collection(_QUERY_TABLES_COLLECTION, _QueryTableVariables(
+            key, variables[0], variables[1], tf.group(*initializers), feed_dict))
+        return tuple(variables)
+
+    @staticmethod
+    def _lookup_answers(query_table, query):
+        """Returns the answers of a single query from an `(indptr, indices)` query table."""
+        indptr, indices = query_table
+        start = tf.gather(indptr, query)
+        end = tf.gather(indptr, query + 1)
+        return tf.gather(indices, tf.range(start, end))
+
+    @staticmethod
+    def _lookup_answers_batch(query_table, queries):
+        """Returns the answers of a batch of queries from an `(indptr, indices)` query table, as a
+        `[batch_size, max_num_answers]` tensor padded with -1."""
+        indptr, indices = query_table
+        starts = tf.gather(indptr, queries)
+        lengths = tf.gather(indptr, queries + 1) - starts
+        max_length = tf.reduce_max(tf.concat([lengths, tf.zeros([1], dtype=tf.int64)], axis=0))
+        offsets = tf.range(max_length, dtype=tf.int64)[None, :]
+        valid = tf.less(offsets, lengths[:, None])
+        positions = tf.where(valid, starts[:, None] + offsets, tf.zeros_like(valid, dtype=tf.int64))
+        answers = tf.gather(indices, positions)
+        return tf.where(valid, answers, -tf.ones_like(answers))
+
+    def _answer_keys(self, e2_multi):
+        """Encodes the answers of each row of a padded `[batch_size, max_num_answers]` tensor as sorted
+        `row * num_ent + answer` keys, so that membership can be tested for all rows with a single search."""
+        valid = tf.greater_equal(e2_multi, 0)
+        rows = tf.range(tf.shape(e2_multi, out_type=tf.int64)[0], dtype=tf.int64)[:, None] + tf.zeros_like(e2_multi)
+        return tf.sort(tf.boolean_mask(rows * self.num_ent + e2_multi, valid))
+
+    def _contains_answers(self, answer_keys, rows, candidates):
+        """Returns `float32` labels indicating which `candidates` are answers of the corresponding `rows`."""
+        keys = rows[:, None] * self.num_ent + candidates
+        values = contains_sorted(answer_keys, tf.reshape(keys, [-1]))
+        return tf.reshape(tf.cast(values, tf.float32), tf.shape(candidates))
+
+    @staticmethod
+    def _shuffle_answers(e2_multi, num_answers):
+        """Returns the first `num_answers` answers of each row after shuffling the valid answers within each row,
+        padded with -1 if a row has fewer answers."""
+        valid = tf.greater_equal(e2_multi, 0)
+        random_keys = tf.where(valid, tf.random_uniform(tf.shape(e2_multi)), -tf.ones(tf.shape(e2_multi)))
+        k = tf.minimum(tf.shape(e2_multi)[1], num_answers)
+        _, order = tf.nn.top_k(random_keys, k=k)
+        shuffled = tf.batch_gather(e2_multi, order)
+        return tf.pad(shuffled, [[0, 0], [0, num_answers - k]], constant_values=-1)
+
+    def _sample_negatives_batch(self, batch, prop_negatives, num_labels, sampler):
+        # Batch version of `_sample_negatives`.
+        e2_multi = batch['e2_multi']
+        batch_size = tf.shape(e2_multi)[0]
+        num_positives_needed = int(1.0 / (1.0 + prop_negatives) * num_labels)
+
+        # We keep all positives if there are at most `num_positives_needed` of them and a random subset of
+        # `num_positives_needed` positives otherwise. The remaining labels are filled with negatives.
+        num_positives = tf.reduce_sum(tf.cast(tf.greater_equal(e2_multi, 0), tf.int32), axis=1)
+        num_positives = tf.minimum(num_positives, num_positives_needed)
+        correct_e2s = self._shuffle_answers(e2_multi, num_labels)
+        wrong_e2s = sampler.sample([batch_size, num_labels])
+        is_positive = tf.less(tf.range(num_labels)[None, :], num_positives[:, None])
+        indexes = tf.where(is_positive, correct_e2s, wrong_e2s)
+
+        rows = tf.range(batch_size, dtype=tf.int64)
+        return {
+                'e1': batch['e1'],
+                'e2': batch['e2'],
+                'rel': batch['rel'],
+                'e2_multi': self._contains_answers(self._answer_keys(e2_multi), rows, indexes),
+                'lookup_values': tf.cast(indexes, tf.int32)}
+
+    def _sample_negatives_one_positive_batch(self, batch, num_negative_labels, sampler):
+        # Batch version of `_create_negative_sampling_dataset`. It returns one row per positive answer.
+        e2_multi = batch['e2_multi']
+        positions = tf.where(tf.greater_equal(e2_multi, 0))
+        rows = positions[:, 0]
+        correct_e2s = tf.gather_nd(e2_multi, positions)
+        wrong_e2s = sampler.sample([tf.shape(correct_e2s)[0], num_negative_labels])
+        indexes = tf.concat([correct_e2s[:, None], wrong_e2s], axis=1)
+
+        return {
+                'e1': tf.gather(batch['e1'], rows),
+                'e2': tf.gather(batch['e2'], rows),
+                'rel': tf.gather(batch['rel'], rows),
+                'e2_multi': self._contains_answers(self._answer_keys(e2_multi), rows, indexes),
+                'lookup_values': tf.cast(indexes, tf.int32)}
+
+    def _sample_shared_negatives_batch(self, batch, num_negative_labels, sampler):
+        # All samples in the batch are scored against one random positive of each sample and a single set of
+        # sampled negatives.
+        e2_multi = batch['e2_multi']
+        batch_size = tf.shape(e2_multi)[0]
+        correct_e2s = self._shuffle_answers(e2_multi, 1)[:, 0]
+        wrong_e2s = sampler.sample([num_negative_labels])
+        indexes = tf.concat([correct_e2s, wrong_e2s], axis=0)
+
+        rows = tf.range(batch_size, dtype=tf.int64)
+        candidates = tf.tile(indexes[None, :], [batch_size, 1])
+        return {
+                'e1': batch['e1'],
+                'e2': batch['e2'],
+                'rel': batch['rel'],
+                'e2_multi': self._contains_answers(self._answer_keys(e2_multi), rows, candidates),
+                'lookup_values': tf.cast(indexes[None, :], tf.int32)}
+
+    def _sample_negatives(self, sample, prop_negatives, num_labels, sampler):
         correct_e2s = sample['e2_multi']
-        e2s_dense = tf.sparse_to_dense(
-            sparse_indices=correct_e2s[:, None],
-            sparse_values=tf.ones([tf.shape(correct_e2s)[0]]),
-            output_shape=[self.num_ent], 
-            validate_indices=False)
+        sorted_correct_e2s = tf.sort(correct_e2s)
 
         correct_e2s = tf.random_shuffle(correct_e2s)
         # To make the code fast, we pick as negatives at random some entities, without removing the positives from the
         # list. If some of these e2s happen to be positive, they will be supervised with their correct label.
-        wrong_e2s = tf.random_shuffle(tf.range(self.num_ent, dtype=tf.int64))
+        wrong_e2s = sampler.sample([num_labels])
 
         num_positives = tf.size(correct_e2s)
         num_negatives = tf.size(wrong_e2s)
 
         num_positives_needed = int(1.0 / (1.0 + prop_negatives) * num_labels)
-        print('num_positives_needed: ', num_positives_needed)
+        logger.debug('num_positives_needed: %d', num_positives_needed)
 
         def _less_positives():
             # We have less positives than requested, therefore fill with negatives up to `num_labels` elements.
@@ -273,36 +588,22 @@ class _DataLoader(Loader):
                 'e1': sample['e1'],
                 'e2': sample['e2'],
                 'rel': sample['rel'],
-                'e2_multi': tf.gather(e2s_dense, indexes),
+                'e2_multi': tf.cast(contains_sorted(sorted_correct_e2s, indexes), tf.float32),
                 'lookup_values': lookup_values}
 
-    def _create_negative_sampling_dataset(self, sample, num_negative_labels):
-        e2_multi_dense = tf.sparse_to_dense(
-            sparse_indices=sample['e2_multi'][:, None],
-            sparse_values=tf.ones([tf.shape(sample['e2_multi'])[0]]),
-            output_shape=[self.num_ent],
-            validate_indices=False)
+    def _create_negative_sampling_dataset(self, sample, num_negative_labels, sampler):
+        correct_e2s = sample['e2_multi']
 
         # To make the code fast, we pick as negatives at 
         # random some entities, without removing the 
         # positives from the list. If some of these e2s 
         # happen to be positive, they will be supervised 
         # with their correct label.
-        shuffled_e2s = tf.random_shuffle(
-            tf.range(self.num_ent, dtype=tf.int64))
-
-        correct_e2s_shape = tf.shape(sample['e2_multi'])
-        neg_start = tf.random_uniform(
-            shape=correct_e2s_shape,
-            maxval=self.num_ent-num_negative_labels,
-            dtype=tf.int32)
-        neg_indexes = tf.gather(
-            shuffled_e2s,
-            neg_start[:, None] + tf.range(num_negative_labels))
-        indexes = tf.concat([sample['e2_multi'][:, None], neg_indexes], axis=1)
-        values = tf.gather(e2_multi_dense, indexes)
-
-        num_correct_e2s = correct_e2s_shape[0]
+        num_correct_e2s = tf.shape(correct_e2s)[0]
+        neg_indexes = sampler.sample([num_correct_e2s, num_negative_labels])
+        indexes = tf.concat([correct_e2s[:, None], neg_indexes], axis=1)
+        values = contains_sorted(tf.sort(correct_e2s), tf.reshape(indexes, [-1]))
+        values = tf.reshape(tf.cast(values, tf.float32), tf.shape(indexes))
 
         return {
                 'e1': tf.tile(sample['e1'][None], [num_correct_e2s]),
@@ -330,82 +631,250 @@ class _DataLoader(Loader):
                 'lookup_values': lookup_values}
 
     def generate_json_files_and_ids(self, directory, buffer_size=1024 * 1024):
-        json_files = self.load_and_preprocess(directory, buffer_size)
-        entity_ids, relation_ids = self._assign_ids(json_files)
-        entity_ids['None'] = -1
-        relation_ids['None'] = -1
+        json_files, entity_ids, relation_ids, _ = self._generate_json_files_and_columns(directory, buffer_size)
+        return json_files, entity_ids, relation_ids
+
+    def _generate_json_files_and_columns(self, directory, buffer_size=1024 * 1024):
+        """Writes the preprocessed JSON files and returns them, along with the entity and relation ID maps and the
+        columns of each split (in the format of `load_columns`).
+
+        The IDs and the columns are computed from the loaded graphs, and so the JSON files are never parsed back.
+        """
+        directory, full_graph, graphs, allowed_entities, allowed_relations = self._load_graphs(
+            directory, buffer_size)
+        json_files = self._write_json_files(directory, full_graph, graphs, allowed_entities, allowed_relations)
+        entity_ids, relation_ids = self._assign_graph_ids(directory, full_graph, allowed_entities, allowed_relations)
         self.num_ent = len(entity_ids) - 1
         self.num_rel = len(relation_ids) - 1
-        return json_files, entity_ids, relation_ids
+        columns = {
+            filetype: self._samples_to_columns(samples, entity_ids, relation_ids)
+            for filetype, samples in six.iteritems(
+                self._split_samples(full_graph, graphs, allowed_entities, allowed_relations))}
+        return json_files, entity_ids, relation_ids, columns
+
+    def generate_columnar_files_and_ids(self, directory, buffer_size=1024 * 1024):
+        column_files, entity_ids, relation_ids = self.load_and_preprocess_columnar(directory, buffer_size)
+        self.num_ent = len(entity_ids) - 1
+        self.num_rel = len(relation_ids) - 1
+        return column_files, entity_ids, relation_ids
 
     def maybe_create_tf_record_files(self,
                                      directory,
                                      max_records_per_file=1000000,
-                                     buffer_size=1024 * 1024):
+                                     buffer_size=1024 * 1024,
+                                     num_shards=None,
+                                     num_workers=None):
+        """Creates the TF record files for all splits, unless up-to-date ones already exist.
+
+        The samples of each split are divided into balanced shards that are written in parallel by a process
+        pool. A manifest containing a hash of the raw input files, `entities.txt`, `relations.txt`, and the
+        sharding settings is stored next to the shards, and the shards are only recreated if that hash changes. The
+        input files are only hashed again if their sizes or modification times have changed since this loader last
+        hashed them.
+
+        Each record refers to the answers of its `(e1, rel)` query by ID. The answers of each query are stored only
+        once per split, in a CSR-encoded query table (i.e., `indptr` and `indices` arrays saved as `.npy` files).
+
+        Arguments:
+            directory (str): Directory in which to download and preprocess the dataset.
+            max_records_per_file (int, optional): Maximum number of records stored in each shard.
+            buffer_size (int, optional): Buffer size to use while downloading and hashing files.
+            num_shards (int, optional): Number of shards per split. If `None`, any existing up-to-date shards are
+                reused, and `_DEFAULT_NUM_TF_RECORD_SHARDS` shards are created otherwise.
+            num_workers (int, optional): Number of processes used to write the shards. Defaults to the number of
+                CPUs.
+
+        Returns:
+            Tuple containing the TF record parser, a dictionary mapping from split name to shard filenames, and a
+            dictionary mapping from split name to `(indptr, indices)` query table arrays.
+        """
         logger.info('Creating TF record files for the \'%s\' dataset.', self.dataset_name)
 
+        raw_directory = self._raw_data_directory(directory, buffer_size)
+        manifest = self._load_tf_record_manifest(raw_directory, num_shards, max_records_per_file, buffer_size)
+        if manifest is None:
+            raw_directory, manifest = self._create_tf_record_files(
+                directory, max_records_per_file, buffer_size, num_shards, num_workers)
+        else:
+            logger.info('Tfrecords files are up to date. We are not recreating them!')
+
+        self.num_ent = len(self._read_index_file(os.path.join(raw_directory, 'entities.txt')))
+        self.num_rel = len(self._read_index_file(os.path.join(raw_directory, 'relations.txt')))
+        self.entity_counts = np.load(os.path.join(raw_directory, manifest['entity_counts']))
+        tf_record_filenames = {
+            filetype: [os.path.join(raw_directory, f) for f in filenames]
+            for filetype, filenames in six.iteritems(manifest['files'])}
+        query_tables = {
+            filetype: tuple(np.load(os.path.join(raw_directory, f)) for f in filenames)
+            for filetype, filenames in six.iteritems(manifest['query_tables'])}
+
+        def conve_tf_record_parser(records):
+            # Parses a batch of serialized records with a single vectorized op.
+            features = {
+                'e1': tf.FixedLenFeature([], tf.int64),
+                'e2': tf.FixedLenFeature([], tf.int64),
+                'rel': tf.FixedLenFeature([], tf.int64),
+                'query': tf.FixedLenFeature([], tf.int64),
+                'is_inverse': tf.FixedLenFeature([], tf.int64)}
+            return tf.parse_example(records, features=features)
+
+        return conve_tf_record_parser, tf_record_filenames, query_tables
+
+    def _create_tf_record_files(self, directory, max_records_per_file, buffer_size, num_shards, num_workers):
         # We first load the entity and relation ID maps and handle missing
         # entries using -1 as their index.
-        json_files, entity_ids, relation_ids = self.generate_json_files_and_ids(directory, buffer_size)
-        directory = os.path.dirname(json_files['full'])
+        if self.use_columnar_store:
+            files, entity_ids, relation_ids = self.generate_columnar_files_and_ids(directory, buffer_size)
+            split_columns = None
+        else:
+            files, entity_ids, relation_ids, split_columns = self._generate_json_files_and_columns(
+                directory, buffer_size)
+        directory = os.path.dirname(files['train'])
         logger.info('The directory is {}'.format(directory))
 
+        relation_is_inverse = np.zeros([self.num_rel], dtype=np.bool_)
+        for relation, relation_id in six.iteritems(relation_ids):
+            if relation_id >= 0:
+                relation_is_inverse[relation_id] = relation.endswith('_reverse')
+
+        if num_shards is None:
+            num_shards = _DEFAULT_NUM_TF_RECORD_SHARDS
+
+        # Remove any stale shards before writing the new ones.
+        for filename in glob.glob(os.path.join(directory, '*.tfrecords')):
+            os.remove(filename)
+
         # Create tfrecords.
         filetypes = ['train', 'dev', 'test']
         tf_record_filenames = {}
+        query_table_filenames = {}
+        tasks = []
         for filetype in filetypes:
-            count = 0
-            total = 0
-            file_index = 0
-            filenames = glob.glob(os.path.join(directory, '{0}-{1}.tfrecords'.format(filetype, '*')))
-            tf_record_filenames[filetype] = filenames
-            # First check if they exist, and rewrite only if they don't.
-            if len(filenames) == 0:
-                filename = os.path.join(directory, '{0}-{1}.tfrecords'.format(filetype, file_index))
-                logger.info('Writing to file: {}'.format(filename))
-                tf_record_filenames[filetype] = [filename]
-                tf_records_writer = tf.python_io.TFRecordWriter(filename)
-                with open(json_files[filetype], 'r') as handle:
-                    for line in handle:
-                        sample = json.loads(line)
-                        record = self._encode_sample_as_tf_record(
-                            sample, entity_ids, relation_ids)
-                        tf_records_writer.write(record.SerializeToString())
-                        count += 1
-                        total += 1
-                        if count >= max_records_per_file:
-                            tf_records_writer.close()
-                            count = 0
-                            file_index += 1
-                            filename = os.path.join(
-                                directory,
-                                '{0}-{1}.tfrecords'.format(filetype, file_index))
-                            tf_record_filenames[filetype].append(filename)
-                            tf_records_writer = tf.python_io.TFRecordWriter(filename)
-                tf_records_writer.close()
-                print('Total records in %s: %d' % (filetype, total))
+            if split_columns is None:
+                columns = self.load_columns(files[filetype])
             else:
-                logger.info('Tfrecords files exist for `%s`. We are not recreating them!' % filetype)
-
-        def conve_tf_record_parser(r):
-            features = {
-                'e1': tf.FixedLenFeature([], tf.int64),
-                'e2': tf.FixedLenFeature([], tf.int64),
-                'rel': tf.FixedLenFeature([], tf.int64),
-                'e2_multi': tf.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
-                'is_inverse': tf.FixedLenFeature([], tf.int64)}
-            return tf.parse_single_example(r, features=features)
-
-        return conve_tf_record_parser, tf_record_filenames
+                columns = split_columns[filetype]
+            if filetype == 'train':
+                # Count how often each entity appears as an answer, for use in frequency-based negative sampling.
+                entity_counts = np.bincount(columns['e2_multi_indices'], minlength=self.num_ent)
+                np.save(os.path.join(directory, _ENTITY_COUNTS_FILENAME), entity_counts)
+            query_table_filenames[filetype] = []
+            for name in ['e2_multi_indptr', 'e2_multi_indices']:
+                filename = '{0}-queries-{1}.npy'.format(filetype, name)
+                np.save(os.path.join(directory, filename), np.asarray(columns[name], dtype=np.int64))
+                query_table_filenames[filetype].append(filename)
+            num_samples = len(columns['e1'])
+            num_split_shards = max(num_shards, -(-num_samples // max_records_per_file))
+            num_split_shards = max(min(num_split_shards, num_samples), 1)
+            boundaries = np.linspace(0, num_samples, num_split_shards + 1).astype(np.int64)
+            tf_record_filenames[filetype] = []
+            for shard in range(num_split_shards):
+                filename = '{0}-{1}.tfrecords'.format(filetype, shard)
+                tf_record_filenames[filetype].append(filename)
+                tasks.append((os.path.join(directory, filename), ) + self._slice_columns(
+                    columns, relation_is_inverse, boundaries[shard], boundaries[shard + 1]))
+            logger.info('Total records in %s: %d', filetype, num_samples)
+
+        logger.info('Writing %d TF record shards to: %s', len(tasks), directory)
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        num_workers = min(num_workers, len(tasks))
+        if num_workers > 1:
+            pool = multiprocessing.Pool(processes=num_workers)
+            try:
+                pool.map(_write_tf_record_shard, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                _write_tf_record_shard(task)
+
+        manifest = {
+            'inputs_hash': self._tf_record_inputs_hash(directory, num_shards, max_records_per_file, buffer_size),
+            'num_shards': num_shards,
+            'entity_counts': _ENTITY_COUNTS_FILENAME,
+            'files': tf_record_filenames,
+            'query_tables': query_table_filenames}
+        with open(os.path.join(directory, _TF_RECORD_MANIFEST_FILENAME), 'w') as handle:
+            json.dump(manifest, handle)
+
+        return directory, manifest
+
+    def _load_tf_record_manifest(self, directory, num_shards, max_records_per_file, buffer_size):
+        """Returns the TF record manifest, or `None` if the TF record files need to be recreated."""
+        manifest_path = os.path.join(directory, _TF_RECORD_MANIFEST_FILENAME)
+        entities_file = os.path.join(directory, 'entities.txt')
+        relations_file = os.path.join(directory, 'relations.txt')
+        if not all(os.path.exists(f) for f in [manifest_path, entities_file, relations_file]):
+            return None
+        with open(manifest_path, 'r') as handle:
+            manifest = json.load(handle)
+        if num_shards is not None and manifest['num_shards'] != num_shards:
+            return None
+        inputs_hash = self._tf_record_inputs_hash(
+            directory, manifest['num_shards'], max_records_per_file, buffer_size)
+        if manifest['inputs_hash'] != inputs_hash:
+            return None
+        filenames = [manifest['entity_counts']]
+        for filetype_filenames in list(manifest['files'].values()) + list(manifest['query_tables'].values()):
+            filenames.extend(filetype_filenames)
+        if not all(os.path.exists(os.path.join(directory, f)) for f in filenames):
+            return None
+        return manifest
+
+    def _tf_record_inputs_hash(self, directory, num_shards, max_records_per_file, buffer_size):
+        settings = json.dumps({
+            'version': _TF_RECORD_FORMAT_VERSION,
+            'filetypes': self.filetypes,
+            'add_reverse_per_filetype': self.add_reverse_per_filetype,
+            'needs_test_set_cleaning': self.needs_test_set_cleaning,
+            'num_shards': num_shards,
+            'max_records_per_file': max_records_per_file}, sort_keys=True)
+        filenames = ['%s.txt' % f for f in self.filetypes] + ['entities.txt', 'relations.txt']
+        paths = [os.path.join(directory, filename) for filename in filenames]
+
+        # The input files are only read again if their sizes or modification times have changed.
+        key = (os.path.abspath(directory), settings)
+        stats = [(os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+        if key in self._tf_record_inputs_hashes and self._tf_record_inputs_hashes[key][0] == stats:
+            return self._tf_record_inputs_hashes[key][1]
+
+        sha = hashlib.sha1(settings.encode('utf-8'))
+        for filename, path in zip(filenames, paths):
+            sha.update(filename.encode('utf-8'))
+            with open(path, 'rb') as handle:
+                for chunk in iter(lambda: handle.read(buffer_size), b''):
+                    sha.update(chunk)
+        self._tf_record_inputs_hashes[key] = (stats, sha.hexdigest())
+        return sha.hexdigest()
 
-    def load_and_preprocess(self, directory, buffer_size=1024 * 1024):
-        logger.info(
-            'Loading and preprocessing the \'%s\' dataset.', self.dataset_name)
+    @staticmethod
+    def _slice_columns(columns, relation_is_inverse, start, end):
+        """Extracts the `e1`, `e2`, `rel`, `is_inverse`, and `query` values of the samples in `[start, end)`."""
+        rel = np.asarray(columns['rel'][start:end])
+        return (np.asarray(columns['e1'][start:end]), np.asarray(columns['e2'][start:end]), rel,
+                relation_is_inverse[rel], np.asarray(columns['query'][start:end]))
 
+    def _raw_data_directory(self, directory, buffer_size=1024 * 1024):
         # Download and potentially extract all needed files.
         if self.maybe_extract(directory, buffer_size):
             # One more directory is created due to the archive extraction.
             directory = os.path.join(directory, self.dataset_name)
+        return directory
+
+    def _load_graphs(self, directory, buffer_size=1024 * 1024):
+        """Reads the raw dataset splits into dictionaries mapping from `(e1, rel)` to sets of `e2` values.
+
+        Returns:
+            Tuple containing the directory of the raw files, the full graph, a list with the graph of each file
+            type, and the sets of allowed entities and relations (which are `None` if no test set cleaning is
+            requested).
+        """
+        logger.info(
+            'Loading and preprocessing the \'%s\' dataset.', self.dataset_name)
+
+        directory = self._raw_data_directory(directory, buffer_size)
 
         # Load and preprocess the data.
         full_graph = {}  # Maps from (e1, rel) to set of e2 values.
@@ -438,12 +907,6 @@ class _DataLoader(Loader):
                     if self.add_reverse_per_filetype[i]:
                         graphs[f][(e2, rel_reverse)].add(e1)
 
-        # Write preprocessed files in a standardized JSON format.
-        e1rel_to_e2_train = os.path.join(directory, 'e1rel_to_e2_train.json')
-        e1rel_to_e2_dev = os.path.join(directory, 'e1rel_to_e2_dev.json')
-        e1rel_to_e2_test = os.path.join(directory, 'e1rel_to_e2_test.json')
-        e1rel_to_e2_full = os.path.join(directory, 'e1rel_to_e2_full.json')
-
         # Potentially remove from the test set the entities that do not appear in train.
         if self.needs_test_set_cleaning:
             assert 'train.txt' in graphs
@@ -460,10 +923,24 @@ class _DataLoader(Loader):
             allowed_entities = None
             allowed_relations = None
 
-        self._write_graph(e1rel_to_e2_train, graphs[files[0]])
-        self._write_graph(e1rel_to_e2_dev, graphs[files[1]], full_graph,
+        return directory, full_graph, [graphs[f] for f in files], allowed_entities, allowed_relations
+
+    def load_and_preprocess(self, directory, buffer_size=1024 * 1024):
+        directory, full_graph, graphs, allowed_entities, allowed_relations = self._load_graphs(
+            directory, buffer_size)
+        return self._write_json_files(directory, full_graph, graphs, allowed_entities, allowed_relations)
+
+    def _write_json_files(self, directory, full_graph, graphs, allowed_entities, allowed_relations):
+        # Write preprocessed files in a standardized JSON format.
+        e1rel_to_e2_train = os.path.join(directory, 'e1rel_to_e2_train.json')
+        e1rel_to_e2_dev = os.path.join(directory, 'e1rel_to_e2_dev.json')
+        e1rel_to_e2_test = os.path.join(directory, 'e1rel_to_e2_test.json')
+        e1rel_to_e2_full = os.path.join(directory, 'e1rel_to_e2_full.json')
+
+        self._write_graph(e1rel_to_e2_train, graphs[0])
+        self._write_graph(e1rel_to_e2_dev, graphs[1], full_graph,
                           allowed_entities=allowed_entities, allowed_relations=allowed_relations)
-        self._write_graph(e1rel_to_e2_test, graphs[files[2]], full_graph,
+        self._write_graph(e1rel_to_e2_test, graphs[2], full_graph,
                           allowed_entities=allowed_entities, allowed_relations=allowed_relations)
         self._write_graph(e1rel_to_e2_full, full_graph, full_graph,
                           allowed_entities=allowed_entities, allowed_relations=allowed_relations)
@@ -474,225 +951,286 @@ class _DataLoader(Loader):
             'test': e1rel_to_e2_test,
             'full': e1rel_to_e2_full}
 
+    def load_and_preprocess_columnar(self, directory, buffer_size=1024 * 1024):
+        """Preprocesses the dataset into integer-encoded `.npy` columns that can be memory-mapped.
+
+        For each split, we store the `e1`, `rel`, and `e2` columns (with `-1` used for missing `e2` values), along
+        with a `query` column that points into a CSR-encoded table of `e2_multi` answer lists, stored as the
+        `e2_multi_indptr` and `e2_multi_indices` columns. Entity and relation IDs are assigned during this pass,
+        so no later stage needs to parse strings.
+        """
+        directory, full_graph, graphs, allowed_entities, allowed_relations = self._load_graphs(
+            directory, buffer_size)
+        entity_ids, relation_ids = self._assign_graph_ids(directory, full_graph, allowed_entities, allowed_relations)
+
+        column_files = {}
+        for filetype, samples in six.iteritems(
+                self._split_samples(full_graph, graphs, allowed_entities, allowed_relations)):
+            column_files[filetype] = os.path.join(directory, 'columns_%s' % filetype)
+            self._write_columns(column_files[filetype], samples, entity_ids, relation_ids)
+        return column_files, entity_ids, relation_ids
+
+    def _assign_graph_ids(self, directory, full_graph, allowed_entities, allowed_relations):
+        """Assigns IDs to the entities and relations of `full_graph` (see `_assign_ids_from_samples`), with -1
+        used as the ID of missing entries."""
+        entity_ids, relation_ids = self._assign_ids_from_samples(
+            directory, self._graph_samples(full_graph, full_graph, allowed_entities, allowed_relations))
+        entity_ids['None'] = -1
+        relation_ids['None'] = -1
+        return entity_ids, relation_ids
+
+    def _split_samples(self, full_graph, graphs, allowed_entities, allowed_relations):
+        """Returns a dictionary mapping from split name to the `_graph_samples` of that split."""
+        return {
+            'train': self._graph_samples(graphs[0]),
+            'dev': self._graph_samples(graphs[1], full_graph, allowed_entities, allowed_relations),
+            'test': self._graph_samples(graphs[2], full_graph, allowed_entities, allowed_relations)}
+
+    @staticmethod
+    def _graph_samples(graph, labels=None, allowed_entities=None, allowed_relations=None):
+        """Yields `(e1, rel, e2s, e2_multi)` tuples, one per `(e1, rel)` key of `graph`.
+
+        If `labels` is `None`, `e2s` is `['None']` and `e2_multi` contains the values of `graph`. Otherwise, `e2s`
+        contains the values of `graph` and `e2_multi` contains the corresponding values of `labels`. Keys and `e2`
+        values that are not allowed are skipped.
+        """
+        for key, value in six.iteritems(graph):
+            e1, rel = key
+            if labels is None:
+                yield e1, rel, ['None'], list(value)
+            else:
+                if allowed_entities is not None and e1 not in allowed_entities:
+                    continue
+                if allowed_relations is not None and rel not in allowed_relations:
+                    continue
+                e2s = [e2 for e2 in value if allowed_entities is None or e2 in allowed_entities]
+                if len(e2s) > 0:
+                    yield e1, rel, e2s, list(labels[key])
+
     @staticmethod
     def _write_graph(filename, graph, labels=None, allowed_entities=None, allowed_relations=None):
         with open(filename, 'w') as handle:
-            for key, value in six.iteritems(graph):
-                e1, rel = key
-                if labels is None:
+            for e1, rel, e2s, e2_multi in _DataLoader._graph_samples(
+                    graph, labels, allowed_entities, allowed_relations):
+                e2_multi = ' '.join(e2_multi)
+                for e2 in e2s:
                     sample = {
                         'e1': e1,
-                        'e2': 'None',
+                        'e2': e2,
                         'rel': rel,
-                        'e2_multi': ' '.join(list(value))}
+                        'e2_multi': e2_multi}
                     handle.write(json.dumps(sample) + '\n')
-                else:
-                    if allowed_entities is not None and e1 not in allowed_entities:
-                        continue
-                    if allowed_relations is not None and rel not in allowed_relations:
-                        continue
-                    e2_multi = ' '.join(list(labels[key]))
-                    for e2 in value:
-                        if allowed_entities is not None and e2 not in allowed_entities:
-                            continue
-                        sample = {
-                            'e1': e1,
-                            'e2': e2,
-                            'rel': rel,
-                            'e2_multi': e2_multi}
-                        handle.write(json.dumps(sample) + '\n')
             handle.flush()
 
     @staticmethod
-    def _assign_ids(json_files):
-        directory = os.path.dirname(json_files['full'])
-        entities_file = os.path.join(directory, 'entities.txt')
-        relations_file = os.path.join(directory, 'relations.txt')
+    def _samples_to_columns(samples, entity_ids, relation_ids):
+        """Converts `_graph_samples` to the columns format of `load_columns`."""
+        e1s, rels, e2s, queries = [], [], [], []
+        indptr, indices = [0], []
+        for e1, rel, sample_e2s, e2_multi in samples:
+            query = len(indptr) - 1
+            indices.extend(entity_ids[e] for e in e2_multi)
+            indptr.append(len(indices))
+            for e2 in sample_e2s:
+                e1s.append(entity_ids[e1])
+                rels.append(relation_ids[rel])
+                e2s.append(entity_ids[e2])
+                queries.append(query)
+        columns = {
+            'e1': e1s,
+            'rel': rels,
+            'e2': e2s,
+            'query': queries,
+            'e2_multi_indptr': indptr,
+            'e2_multi_indices': indices}
+        return {name: np.asarray(values, dtype=np.int64) for name, values in six.iteritems(columns)}
+
+    @staticmethod
+    def _write_columns(prefix, samples, entity_ids, relation_ids):
+        columns = _DataLoader._samples_to_columns(samples, entity_ids, relation_ids)
+        for name, values in six.iteritems(columns):
+            np.save('%s_%s.npy' % (prefix, name), values)
+
+    @staticmethod
+    def load_columns(prefix, mmap_mode='r'):
+        """Loads the columns written by `load_and_preprocess_columnar` for a single split.
+
+        Arguments:
+            prefix (str): Path prefix of the split columns (e.g., `<directory>/columns_train`).
+            mmap_mode (str, optional): Memory-mapping mode passed to `np.load`.
 
-        entities_exist = os.path.exists(entities_file)
-        relations_exist = os.path.exists(relations_file)
+        Returns:
+            Dictionary mapping from column name to array.
+        """
+        names = ['e1', 'rel', 'e2', 'query', 'e2_multi_indptr', 'e2_multi_indices']
+        return {name: np.load('%s_%s.npy' % (prefix, name), mmap_mode=mmap_mode) for name in names}
+
+    @staticmethod
+    def _read_index_file(path):
+        ids = {}
+        with open(path, 'r') as handle:
+            for i, line in enumerate(handle):
+                ids[line.strip()] = i
+        return ids
+
+    @staticmethod
+    def _write_index_file(path, ids):
+        names = sorted(ids, key=ids.get)
+        with open(path, 'w') as handle:
+            for name in names:
+                handle.write(name + '\n')
 
-        entity_names = {}
+    @staticmethod
+    def _assign_ids_from_samples(directory, samples):
+        """Creates the entity and relation index maps of the entities and relations in `samples`, and stores them
+        in `directory`, replacing any existing maps. The maps are regenerated (rather than extended) so that
+        entities and relations of previous inputs do not remain in the ID space."""
         entity_ids = {}
-        relation_names = {}
         relation_ids = {}
+        for e1, rel, e2s, e2_multi in samples:
+            for entity in [e1] + e2s + e2_multi:
+                if entity != 'None' and entity not in entity_ids:
+                    entity_ids[entity] = len(entity_ids)
+            if rel != 'None' and rel not in relation_ids:
+                relation_ids[rel] = len(relation_ids)
 
-        # Check if any of the index files already exist.
-        if entities_exist:
-            with open(entities_file, 'r') as handle:
-                for i, line in enumerate(handle):
-                    line = line.strip()
-                    entity_names[i] = line
-                    entity_ids[line] = i
-        if relations_exist:
-            with open(relations_file, 'r') as handle:
-                for i, line in enumerate(handle):
-                    line = line.strip()
-                    relation_names[i] = line
-                    relation_ids[line] = i
-
-        # Create any of the entity and relation index maps, if needed.
-        if not entities_exist or not relations_exist:
-            with open(json_files['full'], 'r') as handle:
-                full_data = []
-                for line in handle:
-                    full_data.append(json.loads(line))
-            num_ent = 0
-            num_rel = 0
-            for sample in full_data:
-                if not entities_exist:
-                    entities = set()
-                    entities.add(sample['e1'])
-                    entities.add(sample['e2'])
-                    entities.update(sample['e2_multi'].split(' '))
-                    for entity in entities:
-                        if entity != 'None' and entity not in entity_ids:
-                            entity_names[num_ent] = entity
-                            entity_ids[entity] = num_ent
-                            num_ent += 1
-                if not relations_exist:
-                    relation = sample['rel']
-                    if relation != 'None' and \
-                            relation not in relation_ids:
-                        relation_names[num_rel] = relation
-                        relation_ids[relation] = num_rel
-                        num_rel += 1
-
-        # Store the index maps in text files, if needed.
-        # TODO: Can be done more efficiently using ordered dictionaries.
-        if not entities_exist:
-            with open(entities_file, 'w') as handle:
-                for entity_id in range(num_ent):
-                    handle.write(entity_names[entity_id] + '\n')
-        if not relations_exist:
-            with open(relations_file, 'w') as handle:
-                for relation_id in range(num_rel):
-                    handle.write(relation_names[relation_id] + '\n')
+        # Store the index maps in text files.
+        _DataLoader._write_index_file(os.path.join(directory, 'entities.txt'), entity_ids)
+        _DataLoader._write_index_file(os.path.join(directory, 'relations.txt'), relation_ids)
 
         return entity_ids, relation_ids
 
     @staticmethod
-    def _encode_sample_as_tf_record(sample, entity_ids, relation_ids):
-        e1 = entity_ids[sample['e1']]
-        e2 = entity_ids[sample['e2']]
-        rel = relation_ids[sample['rel']]
-        e2_multi = [entity_ids[e]
-                     for e in sample['e2_multi'].split(' ')
-                     if e != 'None']
-
+    def _encode_ids_as_tf_record(e1, e2, rel, query, is_inverse):
         def _int64(values):
             return tf.train.Feature(
                 int64_list=tf.train.Int64List(value=values))
 
         features = tf.train.Features(feature={
-            'e1': _int64([e1]),
-            'e2': _int64([e2]),
-            'rel': _int64([rel]),
-            'e2_multi': _int64(e2_multi),
-            'is_inverse': _int64([sample['rel'].endswith('_reverse')])})
+            'e1': _int64([int(e1)]),
+            'e2': _int64([int(e2)]),
+            'rel': _int64([int(rel)]),
+            'query': _int64([int(query)]),
+            'is_inverse': _int64([int(is_inverse)])})
 
         return tf.train.Example(features=features)
 
 
+def _write_tf_record_shard(task):
+    """Writes a single TF record shard. This is a module-level function so that it can be used by a process pool."""
+    filename, e1, e2, rel, is_inverse, query = task
+    tf_records_writer = tf.python_io.TFRecordWriter(filename)
+    for i in range(len(e1)):
+        record = _DataLoader._encode_ids_as_tf_record(e1[i], e2[i], rel[i], query[i], is_inverse[i])
+        tf_records_writer.write(record.SerializeToString())
+    tf_records_writer.close()
+    return len(e1)
+
+
 class _ConvEDataLoader(_DataLoader):
-    def __init__(self, dataset_name, needs_test_set_cleaning=False):
+    def __init__(self, dataset_name, needs_test_set_cleaning=False, use_columnar_store=False):
         url = 'https://github.com/TimDettmers/ConvE/raw/master'
         filetypes = ['train', 'valid', 'test']
         add_reverse_per_filetype = [True, False, False]
         super(_ConvEDataLoader, self).__init__(url, [dataset_name + '.tar.gz'], dataset_name, filetypes,
                                                add_reverse_per_filetype=add_reverse_per_filetype, 
-                                               needs_test_set_cleaning=needs_test_set_cleaning)
+                                               needs_test_set_cleaning=needs_test_set_cleaning,
+                                               use_columnar_store=use_columnar_store)
 
 
 class _MinervaDataLoader(_DataLoader):
-    def __init__(self, dataset_name, needs_test_set_cleaning=False):
+    def __init__(self, dataset_name, needs_test_set_cleaning=False, use_columnar_store=False):
         url = 'https://raw.githubusercontent.com/shehzaadzd/MINERVA/master/datasets/data_preprocessed/%s' % dataset_name
         filenames = ['train.txt', 'dev.txt', 'test.txt']
         filetypes = ['train', 'dev', 'test']
         add_reverse_per_filetype = [True, False, False]
         super(_MinervaDataLoader, self).__init__(url, filenames, dataset_name, filetypes, needs_test_set_cleaning,
-                                                 add_reverse_per_filetype=add_reverse_per_filetype)
+                                                 add_reverse_per_filetype=add_reverse_per_filetype,
+                                                 use_columnar_store=use_columnar_store)
 
 
 class NationsLoader(_ConvEDataLoader):
-    def __init__(self):
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'nations'
-        super(NationsLoader, self).__init__(dataset_name)
+        super(NationsLoader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class UMLSLoader(_ConvEDataLoader):
-    def __init__(self):     
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'umls'
-        super(UMLSLoader, self).__init__(dataset_name)
+        super(UMLSLoader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class KinshipLoader(_ConvEDataLoader):
-    def __init__(self):
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'kinship'
-        super(KinshipLoader, self).__init__(dataset_name)
+        super(KinshipLoader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class WN18RRLoader(_ConvEDataLoader):
-    def __init__(self):
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'WN18RR'
-        super(WN18RRLoader, self).__init__(dataset_name)
+        super(WN18RRLoader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class YAGO310Loader(_ConvEDataLoader):
-    def __init__(self):
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'YAGO3-10'
-        super(YAGO310Loader, self).__init__(dataset_name)
+        super(YAGO310Loader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class FB15k237Loader(_ConvEDataLoader):
-    def __init__(self):
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'FB15k-237'
-        super(FB15k237Loader, self).__init__(dataset_name)
+        super(FB15k237Loader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class CountriesS1Loader(_MinervaDataLoader):
-    def __init__(self):
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'countries_S1'
-        super(CountriesS1Loader, self).__init__(dataset_name)
+        super(CountriesS1Loader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class CountriesS2Loader(_MinervaDataLoader):
-    def __init__(self):
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'countries_S2'
-        super(CountriesS2Loader, self).__init__(dataset_name)
+        super(CountriesS2Loader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class CountriesS3Loader(_MinervaDataLoader):
-    def __init__(self):
+    def __init__(self, use_columnar_store=False):
         dataset_name = 'countries_S3'
-        super(CountriesS3Loader, self).__init__(dataset_name)
+        super(CountriesS3Loader, self).__init__(dataset_name, use_columnar_store=use_columnar_store)
 
 
 class WN18Loader(_ConvEDataLoader):
-    def __init__(self, is_test=False, needs_test_set_cleaning=False):
+    def __init__(self, is_test=False, needs_test_set_cleaning=False, use_columnar_store=False):
         dataset_name = 'WN18'
         self.is_test = is_test
         self.needs_test_set_cleaning = needs_test_set_cleaning
         if is_test:
             dataset_name += '-test'
-        super(WN18Loader, self).__init__(dataset_name, needs_test_set_cleaning=needs_test_set_cleaning)
+        super(WN18Loader, self).__init__(dataset_name, needs_test_set_cleaning=needs_test_set_cleaning,
+                                         use_columnar_store=use_columnar_store)
 
 
 class FB15kLoader(_ConvEDataLoader):
-    def __init__(self, is_test=False, needs_test_set_cleaning=False):
+    def __init__(self, is_test=False, needs_test_set_cleaning=False, use_columnar_store=False):
         dataset_name = 'FB15k'
         self.is_test = is_test
         self.needs_test_set_cleaning = needs_test_set_cleaning
         if is_test:
             dataset_name += 'test'
-        super(FB15kLoader, self).__init__(dataset_name, needs_test_set_cleaning=needs_test_set_cleaning)
+        super(FB15kLoader, self).__init__(dataset_name, needs_test_set_cleaning=needs_test_set_cleaning,
+                                          use_columnar_store=use_columnar_store)
 
 class NELL995Loader(_MinervaDataLoader):
-    def __init__(self, is_test=False, needs_test_set_cleaning=False):
+    def __init__(self, is_test=False, needs_test_set_cleaning=False, use_columnar_store=False):
         dataset_name = 'nell-995'
         self.is_test = is_test
         self.needs_test_set_cleaning = needs_test_set_cleaning
         if is_test:
             dataset_name += '-test'
         # NELL contains some test entities that do not appear during training. We remove those.
-        super(NELL995Loader, self).__init__(dataset_name, needs_test_set_cleaning=needs_test_set_cleaning)
+        super(NELL995Loader, self).__init__(dataset_name, needs_test_set_cleaning=needs_test_set_cleaning,
+                                            use_columnar_store=use_columnar_store)
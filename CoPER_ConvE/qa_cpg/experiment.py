@@ -0,0 +1,114 @@
+"""Helpers that create the models and datasets of an experiment from its configuration.
+
+These are shared by the training script (`run_cpg`) and the tools that operate on its checkpoints (e.g., the
+background evaluator and the inference graph exporter), so that they all create identical graphs.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import logging
+import tensorflow as tf
+
+from .models import ConvE
+
+__all__ = [
+    'model_descriptors_from_config', 'create_model', 'train_dataset_options', 'create_train_dataset',
+    'create_eval_datasets']
+
+logger = logging.getLogger(__name__)
+
+
+def model_descriptors_from_config(cfg, num_ent, num_rel, use_parameter_lookup=False):
+    """Creates the `ConvE` model descriptors that correspond to an experiment configuration."""
+    return {
+        'use_negative_sampling': cfg.training.num_labels is not None,
+        'shared_negatives': getattr(cfg.training, 'share_negatives', False),
+        'label_smoothing_epsilon': cfg.model.label_smoothing_epsilon,
+        'num_ent': num_ent,
+        'num_rel': num_rel,
+        'ent_emb_size': cfg.model.entity_embedding_size,
+        'num_ent_partitions': getattr(cfg.model, 'num_entity_partitions', 1),
+        'rel_emb_size': cfg.model.relation_embedding_size,
+        'concat_rel': cfg.model.concat_rel,
+        'conv_impl': getattr(cfg.model, 'conv_impl', 'map_fn'),
+        'context_rel_conv': cfg.context.context_rel_conv,
+        'context_rel_out': cfg.context.context_rel_out,
+        'context_rel_dropout': cfg.context.context_rel_dropout,
+        'context_rel_use_batch_norm': cfg.context.context_rel_use_batch_norm,
+        'group_by_relation': getattr(cfg.context, 'context_rel_group_by_relation', False),
+        'input_dropout': cfg.model.input_dropout,
+        'hidden_dropout': cfg.model.feature_map_dropout,
+        'output_dropout': cfg.model.output_dropout,
+        'learning_rate': cfg.training.learning_rate,
+        'lazy_sparse_updates': getattr(cfg.training, 'lazy_sparse_updates', False),
+        'steps_per_run': getattr(cfg.training, 'steps_per_run', 1),
+        'use_xla': getattr(cfg.training, 'use_xla', False),
+        'batch_size': cfg.training.batch_size,
+        'add_loss_summaries': cfg.eval.add_loss_summaries,
+        'add_variable_summaries': cfg.eval.add_variable_summaries,
+        'add_tensor_summaries': cfg.eval.add_tensor_summaries,
+        'batch_norm_momentum': cfg.model.batch_norm_momentum,
+        'batch_norm_train_stats': cfg.model.batch_norm_train_stats,
+        'eval_chunk_size': getattr(cfg.eval, 'eval_chunk_size', None),
+        'eval_top_k': getattr(cfg.eval, 'eval_top_k', 10),
+        'do_parameter_lookup': use_parameter_lookup}
+
+
+def create_model(cfg, num_ent, num_rel, use_parameter_lookup=False, inputs=None, **model_descriptors):
+    """Creates the model of an experiment. Any provided `model_descriptors` override those of the configuration.
+
+    If `inputs` is provided (as returned by `models.create_model_inputs`), the model is fed by that shared input
+    iterator, instead of by its own.
+    """
+    descriptors = model_descriptors_from_config(cfg, num_ent, num_rel, use_parameter_lookup)
+    descriptors.update(model_descriptors)
+    with tf.device(cfg.training.device):
+        # We are using resource variables because due to some implementation details, this allows us to
+        # better utilize GPUs while training.
+        with tf.variable_scope('variables', use_resource=True):
+            return ConvE(model_descriptors=descriptors, inputs=inputs)
+
+
+def train_dataset_options(cfg):
+    """Returns the options of `_DataLoader.train_dataset` that are determined by an experiment configuration.
+
+    Experiments whose options are equal produce identical training batches, and so they can share an input pipeline.
+    """
+    return {
+        'batch_size': cfg.training.batch_size,
+        'prop_negatives': cfg.training.prop_negatives,
+        'num_labels': cfg.training.num_labels,
+        'cache': cfg.training.cache_data,
+        'one_positive_label_per_sample': cfg.training.one_positive_label_per_sample,
+        'negative_sampling_distribution': getattr(cfg.training, 'negative_sampling_distribution', 'uniform'),
+        'batch_negative_sampling': getattr(cfg.training, 'batch_negative_sampling', False),
+        'share_negatives': getattr(cfg.training, 'share_negatives', False),
+        'drop_remainder': getattr(cfg.training, 'use_xla', False)}
+
+
+def create_train_dataset(data_loader, data_dir, cfg, num_shards=1, shard_index=0):
+    """Creates the training dataset of an experiment, or only shard `shard_index` of `num_shards` of it."""
+    logger.info('Creating train dataset...')
+    return data_loader.train_dataset(
+        directory=data_dir,
+        include_inv_relations=True,
+        buffer_size=1024,
+        prefetch_buffer_size=16,
+        num_shards=num_shards,
+        shard_index=shard_index,
+        **train_dataset_options(cfg))
+
+
+def create_eval_datasets(data_loader, data_dir, cfg, dataset_types=('train', 'dev', 'test')):
+    """Creates the evaluation datasets of an experiment, in a dictionary keyed by dataset type."""
+    datasets = collections.OrderedDict()
+    for dataset_type in dataset_types:
+        logger.info('Creating %s eval dataset...', dataset_type)
+        datasets[dataset_type] = data_loader.eval_dataset(
+            directory=data_dir,
+            dataset_type=dataset_type,
+            batch_size=cfg.training.batch_size,
+            include_inv_relations=False,
+            buffer_size=1024,
+            prefetch_buffer_size=16)
+    return datasets
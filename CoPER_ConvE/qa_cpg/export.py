@@ -0,0 +1,266 @@
+"""Exports trained models as inference-only graphs.
+
+At inference time the set of relations is fixed, and so the parameters generated by each
+`ContextualParameterGenerator` can be computed once per relation. The exported model is a
+`ParameterLookup` model whose lookup tables contain these precomputed parameters, and so
+serving a CPG model costs the same as serving a plain ConvE model.
+
+With `--saved_model`, the model (CPG or not) is instead exported as a SavedModel with a pruned
+inference graph: the queries are fed through the `e1` and `rel` placeholders, dropout is removed,
+and the batch normalization layers are folded into the preceding convolution and fully connected
+layer parameters. The SavedModel does not contain the input pipeline, optimizer slots, or
+summaries of the training graph, and can optionally also output the top-k entities of each query.
+
+Usage:
+    python -m qa_cpg.export --config [config.yml] --data_dir [data_dir] --checkpoint [ckpt] --output_dir [dir]
+    python -m qa_cpg.export --config [config.yml] --data_dir [data_dir] --checkpoint [ckpt] --output_dir [dir] \
+        --saved_model --top_k 10
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import tensorflow as tf
+import time
+import yaml
+
+from .data import _DataLoader
+from .experiment import model_descriptors_from_config
+from .models import ConvE, ParameterLookup
+from .utils.dict_with_attributes import AttributeDict
+
+__all__ = ['export_inference_graph', 'export_saved_model']
+
+logger = logging.getLogger(__name__)
+
+_SIGNATURE_FILENAME = 'inference_signature.json'
+
+# Default epsilon of `tf.layers.batch_normalization`, which is used by `ConvE`.
+_BATCH_NORM_EPSILON = 1e-3
+
+# Batch normalization layers of `ConvE`, along with the parameters that precede them.
+_BATCH_NORM_LAYERS = [('Conv1BN', 'conv1_weights', 'conv1_bias'), ('FCBN', 'fc_weights', 'fc_bias')]
+
+
+def _create_model(model_descriptors):
+    # The variable scope must match the one used while training, so that the checkpoint variable names match.
+    with tf.variable_scope('variables', use_resource=True):
+        return ConvE(model_descriptors=model_descriptors)
+
+
+def _checkpoint_value(reader, variable):
+    # Partitions of partitioned variables are stored as slices of the full variable.
+    save_slice_info = variable._get_save_slice_info()
+    if save_slice_info is None:
+        return reader.get_tensor(variable.op.name)
+    value = reader.get_tensor(save_slice_info.full_name)
+    return value[tuple(
+        slice(offset, offset + size)
+        for offset, size in zip(save_slice_info.var_offset, save_slice_info.var_shape))]
+
+
+def _compute_parameter_tables(model_descriptors, checkpoint_path):
+    """Restores a CPG model and evaluates its parameter generators once for every relation."""
+    with tf.Graph().as_default():
+        model = _create_model(dict(model_descriptors, inference_only=True))
+        with tf.variable_scope('variables', use_resource=True):
+            tables = model.relation_parameter_tables()
+        saver = tf.train.Saver()
+        with tf.Session() as session:
+            saver.restore(session, checkpoint_path)
+            return session.run(tables)
+
+
+def _is_cpg(model_descriptors):
+    return model_descriptors['context_rel_conv'] is not None or model_descriptors['context_rel_out'] is not None
+
+
+def _lookup_variable(parameter):
+    if isinstance(parameter, ParameterLookup):
+        return parameter.param_lookup_matrix
+    return parameter
+
+
+def _fold_batch_norm(reader, layer_name, weights, bias):
+    """Folds the inference-time transformation of a batch normalization layer into the preceding layer.
+
+    Arguments:
+        reader (tf.train.CheckpointReader): Reader of the checkpoint containing the batch normalization variables.
+        layer_name (str): Name of the batch normalization layer (e.g., `'Conv1BN'`).
+        weights (np.ndarray): Weights of the preceding layer, with the output channels along the last axis. For
+            parameter lookup tables, this is a `[num_rel, param_size]` matrix whose rows are flattened weights.
+        bias (np.ndarray): Bias of the preceding layer, with the output channels along the last axis.
+
+    Returns:
+        Tuple containing the folded weights and bias.
+    """
+    def get(name):
+        return reader.get_tensor('variables/%s/%s' % (layer_name, name))
+
+    scale = get('gamma') / np.sqrt(get('moving_variance') + _BATCH_NORM_EPSILON)
+    offset = get('beta') - get('moving_mean') * scale
+    folded_weights = (weights.reshape(-1, scale.shape[0]) * scale).reshape(weights.shape)
+    return folded_weights, bias * scale + offset
+
+
+def export_inference_graph(model_descriptors, checkpoint_path, output_dir):
+    """Exports a trained CPG model as an inference-only `ParameterLookup` model.
+
+    The exported model is saved both as a checkpoint (along with its meta graph) and as a frozen graph, in which
+    all variables have been converted to constants. The names of the input and output tensors are stored in
+    `inference_signature.json`.
+
+    Arguments:
+        model_descriptors (dict): Descriptors of the trained model (e.g., from `model_descriptors_from_config`).
+        checkpoint_path (str): Path to the checkpoint of the trained model.
+        output_dir (str): Directory in which to save the exported model.
+
+    Returns:
+        Path to the exported checkpoint.
+    """
+    assert _is_cpg(model_descriptors), 'Only CPG models can be exported as parameter lookup models.'
+    assert not model_descriptors.get('do_parameter_lookup', False), \
+        'The provided model already uses parameter lookup.'
+    assert not model_descriptors.get('concat_rel', False), \
+        'Parameter lookup models do not support `concat_rel`.'
+
+    logger.info('Computing the parameter tables for %d relations...', model_descriptors['num_rel'])
+    tables = _compute_parameter_tables(model_descriptors, checkpoint_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    export_path = os.path.join(output_dir, 'model.ckpt')
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    with tf.Graph().as_default():
+        model = _create_model(dict(model_descriptors, do_parameter_lookup=True, inference_only=True))
+        scores = tf.identity(model.predictions_all, name='scores')
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            table_variables = {
+                model.variables[name].param_lookup_matrix.op.name: table
+                for name, table in tables.items()}
+            for variable in tf.global_variables():
+                name = variable.op.name
+                if name in table_variables:
+                    variable.load(table_variables[name], session)
+                else:
+                    variable.load(_checkpoint_value(reader, variable), session)
+
+            saver = tf.train.Saver()
+            saver.save(session, export_path)
+            logger.info('Saved the inference model at: %s', export_path)
+
+            frozen_graph_def = tf.graph_util.convert_variables_to_constants(
+                session, session.graph.as_graph_def(), [scores.op.name])
+            tf.train.write_graph(frozen_graph_def, output_dir, 'frozen_graph.pb', as_text=False)
+            logger.info('Saved the frozen inference graph at: %s', os.path.join(output_dir, 'frozen_graph.pb'))
+
+        signature = {'e1': model.e1.name, 'rel': model.rel.name, 'scores': scores.name}
+        with open(os.path.join(output_dir, _SIGNATURE_FILENAME), 'w') as handle:
+            json.dump(signature, handle)
+
+    return export_path
+
+
+def export_saved_model(model_descriptors, checkpoint_path, output_dir, top_k=None):
+    """Exports a trained model as a SavedModel with a pruned inference graph.
+
+    The queries are fed through the `e1` and `rel` placeholders, dropout is removed, and the batch normalization
+    layers are folded into the preceding convolution and fully connected layer parameters. CPG models are exported
+    as `ParameterLookup` models (see `export_inference_graph`). The serving signature outputs the `scores` of all
+    entities (before the sigmoid) and, if `top_k` is provided, the `top_k_scores` and `top_k_indices` of each query.
+
+    Arguments:
+        model_descriptors (dict): Descriptors of the trained model (e.g., from `model_descriptors_from_config`).
+        checkpoint_path (str): Path to the checkpoint of the trained model.
+        output_dir (str): Directory in which to save the SavedModel. It must not already exist.
+        top_k (int, optional): Number of highest scoring entities to output for each query.
+
+    Returns:
+        Path to the exported SavedModel.
+    """
+    is_parameter_lookup = model_descriptors.get('do_parameter_lookup', False)
+    tables = {}
+    if _is_cpg(model_descriptors) and not is_parameter_lookup:
+        assert not model_descriptors.get('concat_rel', False), \
+            'Parameter lookup models do not support `concat_rel`.'
+        logger.info('Computing the parameter tables for %d relations...', model_descriptors['num_rel'])
+        tables = _compute_parameter_tables(model_descriptors, checkpoint_path)
+        is_parameter_lookup = True
+
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    with tf.Graph().as_default():
+        model = _create_model(dict(
+            model_descriptors, do_parameter_lookup=is_parameter_lookup, inference_only=True, fold_batch_norm=True))
+        outputs = {'scores': tf.identity(model.predictions_all, name='scores')}
+        if top_k is not None:
+            top_k_scores, top_k_indices = model.top_k_predictions(top_k)
+            outputs['top_k_scores'] = tf.identity(top_k_scores, name='top_k_scores')
+            outputs['top_k_indices'] = tf.identity(top_k_indices, name='top_k_indices')
+
+        # Values of the lookup tables and of the checkpoint variables, with the batch normalization layers folded.
+        values = {}
+        for layer_name, weights_name, bias_name in _BATCH_NORM_LAYERS:
+            weights = _lookup_variable(model.variables[weights_name])
+            bias = _lookup_variable(model.variables[bias_name])
+            folded_weights, folded_bias = _fold_batch_norm(
+                reader, layer_name,
+                tables[weights_name] if weights_name in tables else _checkpoint_value(reader, weights),
+                tables[bias_name] if bias_name in tables else _checkpoint_value(reader, bias))
+            values[weights.op.name] = folded_weights
+            values[bias.op.name] = folded_bias
+
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            for variable in tf.global_variables():
+                name = variable.op.name
+                variable.load(values[name] if name in values else _checkpoint_value(reader, variable), session)
+
+            builder = tf.saved_model.builder.SavedModelBuilder(output_dir)
+            signature = tf.saved_model.signature_def_utils.predict_signature_def(
+                inputs={'e1': model.e1, 'rel': model.rel}, outputs=outputs)
+            builder.add_meta_graph_and_variables(
+                session, [tf.saved_model.tag_constants.SERVING],
+                signature_def_map={tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature},
+                clear_devices=True, strip_default_attrs=True)
+            builder.save()
+    logger.info('Saved the SavedModel at: %s', output_dir)
+
+    with tf.Graph().as_default():
+        with tf.Session() as session:
+            start_time = time.time()
+            tf.saved_model.loader.load(session, [tf.saved_model.tag_constants.SERVING], output_dir)
+            logger.info('Loading the SavedModel took %.3f seconds.', time.time() - start_time)
+
+    return output_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', required=True, help='Path to the config file saved while training.')
+    parser.add_argument('--data_dir', required=True, help='Directory containing `entities.txt` and `relations.txt`.')
+    parser.add_argument('--checkpoint', required=True, help='Path to the checkpoint of the trained model.')
+    parser.add_argument('--output_dir', required=True, help='Directory in which to save the exported model.')
+    parser.add_argument('--saved_model', action='store_true',
+                        help='Export a SavedModel with a pruned inference graph, instead of a parameter lookup model.')
+    parser.add_argument('--top_k', type=int, default=None,
+                        help='Number of highest scoring entities to output for each query, for SavedModel exports.')
+    parser.add_argument('--use_parameter_lookup', action='store_true',
+                        help='Whether the trained model uses parameter lookup (e.g., if it was exported before).')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as handle:
+        cfg = AttributeDict(yaml.safe_load(handle))
+    num_ent = len(_DataLoader._read_index_file(os.path.join(args.data_dir, 'entities.txt')))
+    num_rel = len(_DataLoader._read_index_file(os.path.join(args.data_dir, 'relations.txt')))
+    model_descriptors = model_descriptors_from_config(cfg, num_ent, num_rel, args.use_parameter_lookup)
+    if args.saved_model:
+        export_saved_model(model_descriptors, args.checkpoint, args.output_dir, top_k=args.top_k)
+    else:
+        export_inference_graph(model_descriptors, args.checkpoint, args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division, print_function
 
+import collections
 import logging
 import os
 import numpy as np
@@ -7,7 +8,7 @@ import tensorflow as tf
 import wandb
 
 
-__all__ = ['ranking_and_hits']
+__all__ = ['MultiSplitEvaluator', 'is_better', 'ranking_and_hits']
 
 logger = logging.getLogger(__name__)
 
@@ -30,43 +31,43 @@ def ranking_and_hits(model, results_dir, data_iterator_handle, name, session=Non
     logger.info('-' * 50)
     logger.info('')
 
-    hits = {hits_level: [] for hits_level in hits_to_compute}
-
     ranks = []
 
+    # The filtered ranks are computed in the graph, so that only the integer ranks are fetched.
     stopped = False
-    count = 0
     while not stopped:
         try:
-            e1, e2, rel, e2_multi, pred = session.run(
-                (model.e1, model.e2, model.rel, model.e2_multi, model.predictions_all),
-                feed_dict={model.input_iterator_handle: data_iterator_handle})
-
-            target_values = pred[np.arange(0, len(pred)), e2]
-            pred[e2_multi == 1] = -np.inf
-            pred[np.arange(0, len(pred)), e2] = target_values
-            count += e1.shape[0]
-            for i in range(len(e1)):
-                pred1_args = np.argsort(-pred[i])
-                rank = int(np.where(pred1_args == e2[i])[0]) + 1
-                ranks.append(rank)
-
-                for hits_level in hits_to_compute:
-                    if rank <= hits_level:
-                        hits[hits_level].append(1.0)
-                    else:
-                        hits[hits_level].append(0.0)
-
+            batch_ranks = session.run(
+                model.filtered_ranks, feed_dict={model.input_iterator_handle: data_iterator_handle})
+            ranks.append(batch_ranks)
         except tf.errors.OutOfRangeError:
             stopped = True
+    ranks = np.concatenate(ranks) if ranks else np.zeros([0], dtype=np.int64)
+    ranks = _target_ranks(ranks)
+
+    logger.info('Evaluated %d samples.' % len(ranks))
+
+    return _compute_metrics(ranks, results_dir, hits_to_compute, enable_write_to_file)
+
 
-    logger.info('Evaluated %d samples.' % count)
+def _target_ranks(ranks):
+    # The models rank samples without a target entity (i.e., with `e2 = -1`) as 0, and they are left out of the
+    # metrics.
+    return ranks[ranks > 0]
+
+
+def _compute_metrics(ranks, results_dir, hits_to_compute, enable_write_to_file):
+    if enable_write_to_file:
+        os.makedirs(results_dir, exist_ok=True)
+    hits = {hits_level: (ranks <= hits_level).astype(np.float64) for hits_level in hits_to_compute}
 
     # Save results.
     for hits_level in hits_to_compute:
         hits_value = np.mean(hits[hits_level])
         logger.info('Hits @%d: %10.6f', hits_level, hits_value)
-        wandb.log({'Hits @{0}'.format(hits_level):np.mean(hits_value)})
+        # Only processes that started a wandb run log to it (e.g., not the background evaluator or the benchmarks).
+        if wandb.run is not None:
+            wandb.log({'Hits @{0}'.format(hits_level):np.mean(hits_value)})
         hits[hits_level] = hits_value
         # Write hits to respective files.
         if enable_write_to_file:
@@ -86,3 +87,231 @@ def ranking_and_hits(model, results_dir, data_iterator_handle, name, session=Non
     logging.info('-' * 50)
 
     return mr, mrr, hits
+
+
+def is_better(metrics, best_metrics, validation_metric):
+    """Checks whether `metrics` improve on `best_metrics` (which may be `None`), in terms of `validation_metric`.
+    Lower values are better for the mean rank (`'mr'`), and higher values are better for all other metrics."""
+    if best_metrics is None:
+        return True
+    if validation_metric == 'mr':
+        return metrics[validation_metric] < best_metrics[validation_metric]
+    return metrics[validation_metric] > best_metrics[validation_metric]
+
+
+def _stratified_sample(groups, sample_size, seed):
+    """Samples `sample_size` indices without replacement, allocating the samples to groups in proportion to
+    the group sizes (using the largest remainder method). Returns the sorted sampled indices."""
+    if sample_size >= len(groups):
+        return np.arange(len(groups))
+    rng = np.random.RandomState(seed)
+    unique_groups, group_indices, group_counts = np.unique(groups, return_inverse=True, return_counts=True)
+    quotas = sample_size * group_counts / float(len(groups))
+    allocation = np.floor(quotas).astype(np.int64)
+    remainder_order = np.argsort(-(quotas - allocation), kind='stable')
+    allocation[remainder_order[:sample_size - np.sum(allocation)]] += 1
+    order = np.argsort(group_indices, kind='stable')
+    group_starts = np.concatenate([[0], np.cumsum(group_counts)])
+    sampled = [
+        rng.choice(order[group_starts[g]:group_starts[g + 1]], allocation[g], replace=False)
+        for g in range(len(unique_groups))]
+    return np.sort(np.concatenate(sampled))
+
+
+def _take_samples(split, rows):
+    """Returns the cached samples of a split at `rows`, along with their answers."""
+    starts = split['indptr'][rows]
+    lengths = split['indptr'][rows + 1] - starts
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+    return {
+        'e1': split['e1'][rows],
+        'rel': split['rel'][rows],
+        'e2': split['e2'][rows],
+        'indices': split['indices'][positions],
+        'indptr': indptr}
+
+
+def _bootstrap_confidence_intervals(ranks, hits_to_compute, num_bootstrap_samples, confidence, seed):
+    """Computes percentile bootstrap confidence intervals for the MR, the MRR, and the hits metrics. The intervals
+    are NaN if there are no ranks."""
+    if len(ranks) == 0:
+        metrics = ['mr', 'mrr'] + ['hits@%d' % hits_level for hits_level in hits_to_compute]
+        return {metric: (np.nan, np.nan) for metric in metrics}
+    rng = np.random.RandomState(seed)
+    resampled_ranks = ranks[rng.randint(0, len(ranks), size=[num_bootstrap_samples, len(ranks)])]
+    statistics = {
+        'mr': np.mean(resampled_ranks, axis=1),
+        'mrr': np.mean(1.0 / resampled_ranks, axis=1)}
+    for hits_level in hits_to_compute:
+        statistics['hits@%d' % hits_level] = np.mean(resampled_ranks <= hits_level, axis=1)
+    percentile = 50.0 * (1.0 - confidence)
+    intervals = {}
+    for metric, values in statistics.items():
+        intervals[metric] = (np.percentile(values, percentile), np.percentile(values, 100.0 - percentile))
+        logger.info('%s %.0f%% confidence interval: [%10.6f, %10.6f]',
+                    metric, 100 * confidence, intervals[metric][0], intervals[metric][1])
+    return intervals
+
+
+class MultiSplitEvaluator(object):
+    """Evaluates a model on multiple data splits in a single pass.
+
+    The evaluation samples of each split are read from their dataset iterator only once, and are then cached in
+    memory as numpy arrays, with the answers of each query stored in CSR format. All requested splits are scored
+    together, by feeding the cached batches directly to the model inputs.
+
+    Optionally, only a fixed subset of the samples of each split can be evaluated. The subset is drawn once (with a
+    fixed seed) and stratified by relation, and the metrics are then reported along with bootstrap confidence
+    intervals.
+
+    Arguments:
+        model (ConvE): Model to evaluate.
+        batch_size (int): Number of samples scored per `session.run` call.
+        hits_to_compute (tuple, optional): Hits levels to compute.
+        pad_batches (bool, optional): If `True`, all batches are padded to `batch_size` samples and the answers of
+            each batch are padded to a power of two, so that the model only sees a few distinct input shapes. This
+            avoids recompilations when the model is compiled with XLA.
+    """
+
+    def __init__(self, model, batch_size, hits_to_compute=(1, 3, 5, 10, 20), pad_batches=False):
+        self.model = model
+        self.batch_size = batch_size
+        self.hits_to_compute = hits_to_compute
+        self.pad_batches = pad_batches
+        self._iterators = collections.OrderedDict()
+        self._cache = {}
+        self._sample_indices = {}
+
+    def add_split(self, name, data_iterator, data_iterator_handle):
+        """Registers a split. Its samples are only read (and cached) the first time it is evaluated."""
+        self._iterators[name] = (data_iterator, data_iterator_handle)
+
+    def _cache_split(self, name, session):
+        data_iterator, data_iterator_handle = self._iterators[name]
+        logger.info('Caching the %s samples...', name)
+        session.run(data_iterator.initializer)
+        columns = {'e1': [], 'rel': [], 'e2': [], 'lengths': [], 'indices': []}
+        fetches = (self.model.e1, self.model.rel, self.model.e2, self.model.e2_answers)
+        while True:
+            try:
+                e1, rel, e2, e2_answers = session.run(
+                    fetches, feed_dict={self.model.input_iterator_handle: data_iterator_handle})
+            except tf.errors.OutOfRangeError:
+                break
+            valid = e2_answers >= 0
+            columns['e1'].append(e1)
+            columns['rel'].append(rel)
+            columns['e2'].append(e2)
+            columns['lengths'].append(np.sum(valid, axis=1))
+            columns['indices'].append(e2_answers[valid])
+        columns = {
+            key: np.concatenate(values) if values else np.zeros([0], dtype=np.int64)
+            for key, values in columns.items()}
+        columns['indptr'] = np.concatenate([[0], np.cumsum(columns.pop('lengths'))]).astype(np.int64)
+        self._cache[name] = columns
+        logger.info('Cached %d %s samples.', len(columns['e1']), name)
+
+    def _split_samples(self, name, sample_size, seed):
+        # Returns the cached samples of a split, or a stratified subset of them if `sample_size` is provided.
+        split = self._cache[name]
+        if sample_size is None:
+            return split
+        key = (name, sample_size, seed)
+        if key not in self._sample_indices:
+            self._sample_indices[key] = _stratified_sample(split['rel'], sample_size, seed)
+        return _take_samples(split, self._sample_indices[key])
+
+    def _merged_samples(self, names, sample_size, seed):
+        # Concatenates the (possibly sampled) cached samples of all requested splits.
+        splits = [self._split_samples(name, sample_size, seed) for name in names]
+        offsets = np.cumsum([0] + [len(split['e1']) for split in splits])
+        indptr = [splits[0]['indptr']] if splits else [np.zeros([1], dtype=np.int64)]
+        for split in splits[1:]:
+            indptr.append(split['indptr'][1:] + indptr[-1][-1])
+        merged = {
+            key: np.concatenate([split[key] for split in splits])
+            for key in ['e1', 'rel', 'e2', 'indices']}
+        merged['indptr'] = np.concatenate(indptr)
+        return merged, offsets
+
+    def _feed_dict(self, samples, start, end):
+        indptr = samples['indptr']
+        lengths = indptr[start + 1:end + 1] - indptr[start:end]
+        max_length = int(np.max(lengths)) if end > start else 0
+        num_rows = end - start
+        if self.pad_batches:
+            # The padding samples have no answers, and their ranks are discarded.
+            num_rows = self.batch_size
+            max_length = 1 << (max_length - 1).bit_length() if max_length > 0 else 0
+        e2_answers = np.full([num_rows, max_length], -1, dtype=np.int64)
+        e2_answers[:end - start][np.arange(max_length)[None, :] < lengths[:, None]] = \
+            samples['indices'][indptr[start]:indptr[end]]
+
+        def pad(values):
+            return np.pad(values, (0, num_rows - len(values)), 'constant')
+
+        return {
+            self.model.e1: pad(samples['e1'][start:end]),
+            self.model.rel: pad(samples['rel'][start:end]),
+            self.model.e2: pad(samples['e2'][start:end]),
+            self.model.e2_answers: e2_answers}
+
+    def evaluate(self, session, names, results_dir, enable_write_to_file=False, sample_size=None, seed=0,
+                 num_bootstrap_samples=1000, confidence=0.95, model=None):
+        """Evaluates the model on the requested splits.
+
+        Arguments:
+            session (tf.Session): Session to use.
+            names (list): Names of the splits to evaluate.
+            results_dir (str): Directory in which to write the results, if `enable_write_to_file` is `True`.
+            enable_write_to_file (bool, optional): Whether to write the results to files.
+            sample_size (int, optional): If provided, only this many samples of each split are evaluated, drawn
+                using stratified sampling by relation. The same samples are used for all evaluations that use the
+                same `sample_size` and `seed`.
+            seed (int, optional): Random seed used for sampling.
+            num_bootstrap_samples (int, optional): Number of bootstrap samples used to compute the confidence
+                intervals, when `sample_size` is provided.
+            confidence (float, optional): Confidence level of the confidence intervals.
+            model (ConvE, optional): Model to evaluate instead of `self.model`. It must share the inputs of
+                `self.model` (e.g., another model fed by the same `create_model_inputs`), so that the cached
+                samples can be reused.
+
+        Returns:
+            Ordered dictionary mapping from split name to a `(mr, mrr, hits, confidence_intervals)` tuple, where
+            `confidence_intervals` maps from metric name (e.g., `'hits@1'`) to a `(lower, upper)` tuple, and is
+            `None` unless `sample_size` is provided.
+        """
+        model = model if model is not None else self.model
+        names = list(names)
+        for name in names:
+            if name not in self._cache:
+                self._cache_split(name, session)
+
+        samples, offsets = self._merged_samples(names, sample_size, seed)
+        num_samples = offsets[-1]
+        ranks = []
+        for start in range(0, num_samples, self.batch_size):
+            end = min(start + self.batch_size, num_samples)
+            batch_ranks = session.run(model.filtered_ranks, feed_dict=self._feed_dict(samples, start, end))
+            ranks.append(batch_ranks[:end - start])
+        ranks = np.concatenate(ranks) if ranks else np.zeros([0], dtype=np.int64)
+
+        results = collections.OrderedDict()
+        for i, name in enumerate(names):
+            logger.info('')
+            logger.info('-' * 50)
+            logger.info(name if sample_size is None else '%s (sampled)' % name)
+            logger.info('-' * 50)
+            logger.info('')
+            split_ranks = _target_ranks(ranks[offsets[i]:offsets[i + 1]])
+            logger.info('Evaluated %d samples.' % len(split_ranks))
+            mr, mrr, hits = _compute_metrics(
+                split_ranks, os.path.join(results_dir, name), self.hits_to_compute, enable_write_to_file)
+            if sample_size is not None:
+                confidence_intervals = _bootstrap_confidence_intervals(
+                    split_ranks, self.hits_to_compute, num_bootstrap_samples, confidence, seed)
+            else:
+                confidence_intervals = None
+            results[name] = (mr, mrr, hits, confidence_intervals)
+        return results
@@ -1,18 +1,52 @@
 from __future__ import absolute_import, division, print_function
 
+import collections
+import contextlib
 import logging
 import math
 import tensorflow as tf
 
 from functools import reduce
 from operator import mul
+from tensorflow.python.ops.variables import PartitionedVariable
 
-from .utils.amsgrad import AMSGradOptimizer
+from .sampling import contains_sorted
+from .utils.amsgrad import AMSGradOptimizer, LazyAMSGradOptimizer
 
-__all__ = ['ConvE']
+__all__ = ['ConvE', 'ModelInputs', 'create_model_inputs']
 
 LOGGER = logging.getLogger(__name__)
 
+# Feedable input iterator of a model, along with the placeholder of its handle and its next samples.
+ModelInputs = collections.namedtuple('ModelInputs', ['iterator_handle', 'iterator', 'next_sample'])
+
+
+def create_model_inputs():
+    """Creates a feedable input iterator, whose next samples can be shared by multiple models."""
+    with tf.device('/CPU:0'):
+        iterator_handle = tf.placeholder(tf.string, shape=[], name='input_iterator_handle')
+        iterator = tf.data.Iterator.from_string_handle(
+            iterator_handle,
+            output_types={
+                'e1': tf.int64,
+                'e2': tf.int64,
+                'rel': tf.int64,
+                'e2_multi': tf.float32,
+                'e2_answers': tf.int64,
+                'lookup_values': tf.int32
+            },
+            output_shapes={
+                'e1': [None],
+                'e2': [None],
+                'rel': [None],
+                'e2_multi': [None, None],
+                'e2_answers': [None, None],
+                'lookup_values': [None, None]
+            })
+
+    # Get the next samples from the training and the evaluation iterators.
+    return ModelInputs(iterator_handle, iterator, iterator.get_next())
+
 
 def _create_summaries(name, tensor):
     """Creates various summaries for the provided tensor,
@@ -29,6 +63,107 @@ def _create_summaries(name, tensor):
         tf.summary.histogram('histogram', tensor)
 
 
+@contextlib.contextmanager
+def _maybe_jit_scope(enabled):
+    """Compiles the ops created in this scope (and their gradients) with XLA, if `enabled` is `True`."""
+    if enabled:
+        with tf.contrib.compiler.jit.experimental_jit_scope():
+            yield
+    else:
+        yield
+
+
+def _partitions(variable):
+    """Returns the partitions of a variable that may be partitioned along its first axis, and their offsets."""
+    partitions = list(variable) if isinstance(variable, PartitionedVariable) else [variable]
+    offsets = [0]
+    for partition in partitions[:-1]:
+        offsets.append(offsets[-1] + partition.get_shape()[0].value)
+    return partitions, offsets
+
+
+def _gather_rows(variable, indices):
+    """Gathers rows of a variable that may be partitioned along its first axis (using the `'div'` strategy)."""
+    if isinstance(variable, PartitionedVariable):
+        return tf.nn.embedding_lookup(list(variable), indices, partition_strategy='div')
+    return tf.gather(variable, indices)
+
+
+def _merge_top_k(scores, indices, k):
+    """Merges lists of top-k scores (and the corresponding indices) of disjoint sets of entities."""
+    scores = tf.concat(scores, axis=1)
+    indices = tf.concat(indices, axis=1)
+    top_k_scores, top_k_positions = tf.nn.top_k(scores, k=k)
+    return top_k_scores, tf.batch_gather(indices, top_k_positions)
+
+
+def _per_sample_conv2d(inputs, filters, impl='map_fn'):
+    """Convolves each sample in `inputs` with its own filter, using `'VALID'` padding and unit strides.
+
+    Arguments:
+        inputs (tf.Tensor): Tensor with shape `[batch_size, height, width, in_channels]`.
+        filters (tf.Tensor): Tensor with shape `[batch_size, filter_height, filter_width, in_channels, out_channels]`.
+        impl (str, optional): Either `'map_fn'`, which runs a separate convolution for each sample, or `'im2col'`,
+            which extracts all image patches and applies a single batched matrix multiplication. `'im2col'` is
+            usually faster for large batches, but it materializes all patches and sums in a different order, and so
+            its outputs differ from those of `'map_fn'` by floating point rounding.
+
+    Returns:
+        Tensor with shape `[batch_size, out_height, out_width, out_channels]`.
+    """
+    if impl == 'map_fn':
+        def conv(pair):
+            return (tf.nn.conv2d(
+                input=pair[0][None], filter=pair[1],
+                strides=[1, 1, 1, 1], padding='VALID')[0], tf.zeros([]))
+        return tf.map_fn(fn=conv, elems=(inputs, filters))[0]
+    if impl != 'im2col':
+        raise ValueError('Unsupported convolution implementation: %s' % impl)
+
+    # The patches are flattened in (row, column, channel) order, which matches the layout of the filters.
+    filter_shape = filters.shape.as_list()
+    patch_size = filter_shape[1] * filter_shape[2] * filter_shape[3]
+    patches = tf.extract_image_patches(
+        inputs, ksizes=[1, filter_shape[1], filter_shape[2], 1],
+        strides=[1, 1, 1, 1], rates=[1, 1, 1, 1], padding='VALID')
+    patches_shape = tf.shape(patches)
+    patches = tf.reshape(patches, [patches_shape[0], -1, patch_size])
+    filters = tf.reshape(filters, [-1, patch_size, filter_shape[4]])
+    outputs = tf.matmul(patches, filters)
+    return tf.reshape(outputs, tf.stack([patches_shape[0], patches_shape[1], patches_shape[2], filter_shape[4]]))
+
+
+def _grouped_matmul(inputs, weights, groups):
+    """Multiplies each row of `inputs` with the weight matrix of its group.
+
+    The rows are packed into a padded `[num_groups, max_group_size, input_size]` tensor, so that a single batched
+    matrix multiplication is needed and the weights are never copied per row.
+
+    Arguments:
+        inputs (tf.Tensor): Tensor with shape `[batch_size, input_size]`.
+        weights (tf.Tensor): Tensor with shape `[num_groups, input_size, output_size]`.
+        groups (tf.Tensor): `int32` tensor with shape `[batch_size]`, containing the group of each row.
+
+    Returns:
+        Tensor with shape `[batch_size, output_size]`.
+    """
+    num_groups = tf.shape(weights)[0]
+    batch_size = tf.shape(groups)[0]
+
+    # Compute the position of each row within its group, using a stable sort by group.
+    order = tf.argsort(groups, stable=True)
+    group_sizes = tf.unsorted_segment_sum(tf.ones_like(groups), groups, num_groups)
+    group_starts = tf.cumsum(group_sizes, exclusive=True)
+    sorted_positions = tf.range(batch_size) - tf.gather(group_starts, tf.gather(groups, order))
+    positions = tf.gather(sorted_positions, tf.invert_permutation(order))
+
+    indices = tf.stack([groups, positions], axis=1)
+    packed_inputs = tf.scatter_nd(
+        indices, inputs, tf.stack([num_groups, tf.reduce_max(group_sizes), tf.shape(inputs)[1]]))
+    packed_outputs = tf.matmul(packed_inputs, weights)
+    return tf.gather_nd(packed_outputs, indices)
+
+
 class ContextualParameterGenerator(object):
     def __init__(self, context_size, name, dtype, shape, initializer, dropout=0.5, use_batch_norm=False,
                  batch_norm_momentum=0.99, batch_norm_train_stats=False):
@@ -54,24 +189,27 @@ class ContextualParameterGenerator(object):
             in_size = n
 
     def generate(self, context, is_train):
-        # Generate the parameter values.
-        generated_value = context
-        for i, projection in enumerate(self.projections[:-1]):
-            generated_value = tf.matmul(generated_value, projection)
-            if self.use_batch_norm:
-                is_train_batch_norm = is_train if self.batch_norm_train_stats else False
-                generated_value = tf.layers.batch_normalization(
-                    generated_value, momentum=self.batch_norm_momentum, reuse=tf.AUTO_REUSE,
-                    training=is_train_batch_norm, fused=True, name='%s/CPG/Projection%d/BatchNorm' % (self.name, i))
-            generated_value = tf.nn.relu(generated_value)
-            generated_value = tf.nn.dropout(
-                generated_value, 1 - (self.dropout * tf.cast(is_train, tf.float32)))
-
-        generated_value = tf.matmul(generated_value, self.projections[-1])
-
-        # Reshape and cast to the requested type.
-        generated_value = tf.reshape(generated_value, [-1] + self.shape)
-        generated_value = tf.cast(generated_value, self.dtype)
+        # The generator ops are placed in their own name scope, so that they can be told apart when profiling.
+        with tf.name_scope('cpg'):
+            # Generate the parameter values.
+            generated_value = context
+            for i, projection in enumerate(self.projections[:-1]):
+                generated_value = tf.matmul(generated_value, projection)
+                if self.use_batch_norm:
+                    is_train_batch_norm = is_train if self.batch_norm_train_stats else False
+                    generated_value = tf.layers.batch_normalization(
+                        generated_value, momentum=self.batch_norm_momentum, reuse=tf.AUTO_REUSE,
+                        training=is_train_batch_norm, fused=True,
+                        name='%s/CPG/Projection%d/BatchNorm' % (self.name, i))
+                generated_value = tf.nn.relu(generated_value)
+                generated_value = tf.nn.dropout(
+                    generated_value, 1 - (self.dropout * tf.cast(is_train, tf.float32)))
+
+            generated_value = tf.matmul(generated_value, self.projections[-1])
+
+            # Reshape and cast to the requested type.
+            generated_value = tf.reshape(generated_value, [-1] + self.shape)
+            generated_value = tf.cast(generated_value, self.dtype)
 
         return generated_value
 
@@ -95,8 +233,9 @@ class ParameterLookup(object):
 
 
 class ConvE(object):
-    def __init__(self, model_descriptors):
+    def __init__(self, model_descriptors, inputs=None):
         self.use_negative_sampling = model_descriptors['use_negative_sampling']
+        self.shared_negatives = model_descriptors.get('shared_negatives', False)
         self.label_smoothing_epsilon = model_descriptors['label_smoothing_epsilon']
 
         self.num_ent = model_descriptors['num_ent']
@@ -109,6 +248,7 @@ class ConvE(object):
         self.conv_filter_height = model_descriptors.get('conv_filter_height', 3)
         self.conv_filter_width = model_descriptors.get('conv_filter_width', 3)
         self.conv_num_channels = model_descriptors.get('conv_num_channels', 32)
+        self.conv_impl = model_descriptors.get('conv_impl', 'map_fn')
 
         self.concat_rel = model_descriptors.get('concat_rel', False)
         self.context_rel_conv = model_descriptors.get('context_rel_conv', None)
@@ -116,6 +256,14 @@ class ConvE(object):
         self.context_rel_dropout = model_descriptors.get('context_rel_dropout', 0.0)
         self.context_rel_use_batch_norm = model_descriptors.get('context_rel_use_batch_norm', False)
 
+        # If enabled, the relation-specific parameters are generated once per unique relation in each batch. The
+        # outputs are then the same as without grouping at inference time, but during training the batch
+        # normalization statistics and the dropout masks of the parameter generators are computed over the unique
+        # relations of each batch, rather than over its samples. Relations that appear in many samples of a batch
+        # therefore have less weight in the batch statistics, and all their samples share the same dropout mask.
+        self.group_by_relation = model_descriptors.get('group_by_relation', False) and (
+            self.context_rel_conv is not None or self.context_rel_out is not None)
+
         self.input_dropout = model_descriptors['input_dropout']
         self.hidden_dropout = model_descriptors['hidden_dropout']
         self.output_dropout = model_descriptors['output_dropout']
@@ -123,89 +271,272 @@ class ConvE(object):
         self.batch_norm_momentum = model_descriptors.get('batch_norm_momentum', 0.1)
         self.batch_norm_train_stats = model_descriptors.get('batch_norm_train_stats', False)
 
+        # If `eval_chunk_size` is set, evaluation scores the entities in blocks of that size and only keeps the
+        # filtered rank of the target entity and the `eval_top_k` highest scoring entities of each sample.
+        self.eval_chunk_size = model_descriptors.get('eval_chunk_size', None)
+        self.eval_top_k = min(model_descriptors.get('eval_top_k', 10), self.num_ent)
+
+        # If `num_ent_partitions` is larger than 1, `ent_emb` and `pred_bias` are partitioned along the entity axis
+        # (e.g., so that they can be placed on multiple parameter servers). Entities are then scored and ranked per
+        # partition, on the device of each partition, and only the top-k entities of each partition are merged.
+        self.num_ent_partitions = model_descriptors.get('num_ent_partitions', 1)
+
         self._loss_summaries = model_descriptors['add_loss_summaries']
         self._variable_summaries = model_descriptors['add_variable_summaries']
         self._tensor_summaries = model_descriptors['add_tensor_summaries']
 
-        learning_rate = model_descriptors['learning_rate']
-        optimizer = AMSGradOptimizer(learning_rate)
+        # If enabled, the forward pass, the loss, and their gradients are compiled with XLA. The batch shapes should
+        # then be fixed (e.g., using `drop_remainder` for training and padded evaluation batches), so that the
+        # compiled graphs are not recompiled for every new shape.
+        self.use_xla = model_descriptors.get('use_xla', False)
+
+        # If enabled, the queries are fed through placeholders, dropout is omitted, and no loss or optimizer is
+        # created.
+        self.inference_only = model_descriptors.get('inference_only', False)
+
+        # If enabled, the batch normalization layers are omitted, because their inference-time transformation has
+        # been folded into the preceding convolution and fully connected layer parameters (e.g., by `qa_cpg.export`).
+        self.fold_batch_norm = model_descriptors.get('fold_batch_norm', False)
+        assert not self.fold_batch_norm or self.inference_only, \
+            'Parameter `fold_batch_norm` is only supported for inference-only models.'
+
+        # Multiple models (e.g., with different configurations) can be built in the same graph, each in its own
+        # variable scope. Only the variables, batch normalization updates, and summaries of this model (i.e., those
+        # under the current scopes) are then used for training it.
+        self._variable_scope = tf.get_variable_scope().name
+        self._name_scope = tf.get_default_graph().get_name_scope()
+
+        # If `inputs` is provided (as returned by `create_model_inputs`), this model is fed by an input iterator that
+        # is shared with other models, and so all of them are trained on the same batches.
+        self._shares_inputs = inputs is not None
 
         # Build the graph.
-        with tf.device('/CPU:0'):
-            self.input_iterator_handle = tf.placeholder(
-                tf.string, shape=[], name='input_iterator_handle')
-            self.input_iterator = tf.data.Iterator.from_string_handle(
-                self.input_iterator_handle,
-                output_types={
-                    'e1': tf.int64,
-                    'e2': tf.int64,
-                    'rel': tf.int64,
-                    'e2_multi': tf.float32,
-                    'lookup_values': tf.int32
-                },
-                output_shapes={
-                    'e1': [None],
-                    'e2': [None],
-                    'rel': [None],
-                    'e2_multi': [None, None],
-                    'lookup_values': [None, None]
-                })
-
-        # Get the next samples from the training and the evaluation iterators.
-        self.next_input_sample = self.input_iterator.get_next()
-
-        # Training Data.
         self.is_train = tf.placeholder_with_default(False, shape=[], name='is_train')
-        self.e1 = self.next_input_sample['e1']
-        self.rel = self.next_input_sample['rel']
-        self.e2 = self.next_input_sample['e2']
-        self.e2_multi = self.next_input_sample['e2_multi']
-
-        if self.use_negative_sampling:
-            self.obj_lookup_values = self.next_input_sample['lookup_values']
-        else:
+        if self.inference_only:
+            self.input_iterator_handle = None
+            self.e1 = tf.placeholder(tf.int64, shape=[None], name='e1')
+            self.rel = tf.placeholder(tf.int64, shape=[None], name='rel')
+            self.e2 = None
+            self.e2_multi = None
+            self.e2_answers = None
             self.obj_lookup_values = None
+        else:
+            if inputs is None:
+                inputs = create_model_inputs()
+            self.input_iterator_handle = inputs.iterator_handle
+            self.input_iterator = inputs.iterator
+            self.next_input_sample = inputs.next_sample
+
+            # Training Data.
+            self.e1 = self.next_input_sample['e1']
+            self.rel = self.next_input_sample['rel']
+            self.e2 = self.next_input_sample['e2']
+            self.e2_multi = self.next_input_sample['e2_multi']
+            self.e2_answers = self.next_input_sample['e2_answers']
+
+            if self.use_negative_sampling:
+                self.obj_lookup_values = self.next_input_sample['lookup_values']
+            else:
+                self.obj_lookup_values = None
 
         with tf.variable_scope('variables', use_resource=True):
             self.variables = self._create_variables()
 
-        ent_emb = self.variables['ent_emb']
-        if not self.is_parameter_lookup:
-            rel_emb = self.variables['rel_emb']
-
-        conve_e1_emb = tf.nn.embedding_lookup(ent_emb, self.e1, name='e1_emb')
-        if not self.is_parameter_lookup:
-            conve_rel_emb = tf.nn.embedding_lookup(rel_emb, self.rel, name='rel_emb')
+        # The full entity embeddings table (e.g., for saving the embeddings), even if `ent_emb` is partitioned.
+        if self.num_ent_partitions > 1:
+            self.ent_emb_table = tf.convert_to_tensor(self.variables['ent_emb'])
         else:
-            conve_rel_emb = self.rel
-
-        # Use the model to predict the embedding of the correct answer e2.
-        self.predicted_e2_emb = self._create_predictions(conve_e1_emb, conve_rel_emb)
+            self.ent_emb_table = self.variables['ent_emb']
 
-        # Compare the predicted e2 embedding with the embeddings of all e2 provided in the `obj_lookup_values`.
-        self.predictions_lookup = self._compute_likelihoods(
-            self.predicted_e2_emb, 'predictions_lookup', self.obj_lookup_values)
+        with _maybe_jit_scope(self.use_xla):
+            # Use the model to predict the embedding of the correct answer e2.
+            self.predicted_e2_emb = self._predict(self.e1, self.rel)
 
-        # Compare the predicted e2 embedding with the embeddings of all e2 in the vocabulary.
-        self.predictions_all = self._compute_likelihoods(self.predicted_e2_emb, 'predictions')
+            # Compare the predicted e2 embedding with the embeddings of all e2 provided in the `obj_lookup_values`.
+            if not self.inference_only:
+                self.predictions_lookup = self._compute_likelihoods(
+                    self.predicted_e2_emb, 'predictions_lookup', self.obj_lookup_values)
+            else:
+                self.predictions_lookup = None
+
+            # Compare the predicted e2 embedding with the embeddings of all e2 in the vocabulary.
+            self.predictions_all = self._compute_likelihoods(self.predicted_e2_emb, 'predictions')
+
+        if self.inference_only:
+            self.target_scores = None
+            self.filtered_ranks = None
+            self.top_k_scores = None
+            self.top_k_indices = None
+        elif self.num_ent_partitions > 1:
+            self.target_scores, self.filtered_ranks, self.top_k_scores, self.top_k_indices = \
+                self._rank_in_partitions(self.predicted_e2_emb, self.e2, self.e2_answers)
+        elif self.eval_chunk_size is not None:
+            self.target_scores, self.filtered_ranks, self.top_k_scores, self.top_k_indices = \
+                self._rank_in_chunks(self.predicted_e2_emb, self.e2, self.e2_answers)
+        else:
+            self.target_scores, self.filtered_ranks, self.top_k_scores, self.top_k_indices = \
+                self._rank(self.predictions_all, self.e2, self.e2_answers)
+
+        if self.inference_only:
+            self.loss = None
+            self.train_op = None
+            self.summaries = None
+            self.optimizer = None
+            self.global_step = None
+            self.num_steps = None
+            self.multi_step_loss = None
+            self.multi_step_train_op = None
+            return
+
+        with _maybe_jit_scope(self.use_xla):
+            self.loss = self._create_loss(self.predictions_lookup, self.e2_multi)
 
-        self.loss = self._create_loss(self.predictions_lookup, self.e2_multi)
+        learning_rate = model_descriptors['learning_rate']
+        if model_descriptors.get('lazy_sparse_updates', False):
+            optimizer = LazyAMSGradOptimizer(learning_rate)
+        else:
+            optimizer = AMSGradOptimizer(learning_rate)
+
+        # If `num_replicas` is larger than 1, the model is trained by that many data-parallel workers, and the
+        # gradients of all workers (which are sparse for the entity embeddings) are aggregated before each update.
+        # The workers must then run the session run hook returned by `optimizer.make_session_run_hook`.
+        num_replicas = model_descriptors.get('num_replicas', 1)
+        if num_replicas > 1:
+            optimizer = tf.train.SyncReplicasOptimizer(
+                optimizer, replicas_to_aggregate=num_replicas, total_num_replicas=num_replicas)
+            self.global_step = tf.train.get_or_create_global_step()
+        else:
+            self.global_step = None
+        self.optimizer = optimizer
 
         # The following control dependency is needed in order for batch
         # normalization to work correctly.
-        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope=self._scope_prefix(self._name_scope))
+        self.train_op = self._minimize(optimizer, self.loss, update_ops, self.global_step)
+        self.summaries = tf.summary.merge_all(scope=self._scope_prefix(self._name_scope))
+
+        # If `steps_per_run` is larger than 1, `multi_step_train_op` runs up to that many training steps (as set by
+        # `num_steps`) in a single `session.run` call, and `multi_step_loss` is their average loss. This is built
+        # after the single-step train op, so that the optimizer slots already exist.
+        steps_per_run = model_descriptors.get('steps_per_run', 1)
+        if steps_per_run > 1:
+            assert num_replicas == 1, 'Parameter `steps_per_run` is not supported with multiple replicas.'
+            assert not self._shares_inputs, 'Parameter `steps_per_run` is not supported with shared inputs.'
+            self.num_steps = tf.placeholder_with_default(steps_per_run, shape=[], name='num_steps')
+            self.multi_step_loss, self.multi_step_train_op = self._build_multi_step_train_op(
+                optimizer, self.num_steps)
+        else:
+            self.num_steps = None
+            self.multi_step_loss = None
+            self.multi_step_train_op = None
+
+    def relation_parameter_tables(self):
+        """Evaluates every contextual parameter generator once per relation, with dropout disabled.
+
+        Returns:
+            Dictionary mapping from parameter name (e.g., `'fc_weights'`) to a `[num_rel, param_size]` tensor, for
+            each parameter that is generated by a `ContextualParameterGenerator`. These tables can be loaded in a
+            `ParameterLookup` model with the same configuration.
+        """
+        tables = {}
+        if self.is_parameter_lookup:
+            return tables
+        rel_emb = self.variables['rel_emb']
+        for name in ['conv1_weights', 'conv1_bias', 'fc_weights', 'fc_bias']:
+            generator = self.variables[name]
+            if isinstance(generator, ContextualParameterGenerator):
+                tables[name] = tf.reshape(generator.generate(rel_emb, is_train=False), [self.num_rel, -1])
+        return tables
+
+    @staticmethod
+    def _scope_prefix(scope):
+        # Collections are filtered by prefix, and so the trailing slash excludes scopes such as `tower_10` when
+        # filtering by `tower_1`.
+        return scope + '/' if scope else None
+
+    def _minimize(self, optimizer, loss, update_ops, global_step=None):
+        var_list = tf.get_collection(
+            tf.GraphKeys.TRAINABLE_VARIABLES, scope=self._scope_prefix(self._variable_scope))
         with tf.control_dependencies(update_ops):
-            gradients, variables = zip(*optimizer.compute_gradients(self.loss))
+            gradients, variables = zip(*optimizer.compute_gradients(loss, var_list=var_list))
             gradients, _ = tf.clip_by_global_norm(gradients, 5.0)
-            self.train_op = optimizer.apply_gradients(zip(gradients, variables))
-        self.summaries = tf.summary.merge_all()
+            return optimizer.apply_gradients(zip(gradients, variables), global_step=global_step)
+
+    def _build_train_step(self, optimizer, inputs):
+        """Builds a training step for a batch of samples, without any summaries.
+
+        Arguments:
+            optimizer (tf.train.Optimizer): Optimizer used to update the model variables.
+            inputs (dict): Training batch, as produced by the input iterator.
+
+        Returns:
+            Tuple containing the loss and the train op.
+        """
+        # Only the batch normalization updates of this step must run along with it.
+        update_ops = set(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+        with _maybe_jit_scope(self.use_xla):
+            predicted_e2_emb = self._predict(inputs['e1'], inputs['rel'], add_summaries=False)
+            lookup_values = inputs['lookup_values'] if self.use_negative_sampling else None
+            predictions = self._compute_likelihoods(
+                predicted_e2_emb, 'predictions_lookup', lookup_values, add_summaries=False)
+            loss = self._create_loss(predictions, inputs['e2_multi'], add_summaries=False)
+        update_ops_ref = tf.get_collection_ref(tf.GraphKeys.UPDATE_OPS)
+        step_update_ops = [op for op in update_ops_ref if op not in update_ops]
+        update_ops_ref[:] = [op for op in update_ops_ref if op in update_ops]
+        return loss, self._minimize(optimizer, loss, step_update_ops)
+
+    def _build_multi_step_train_op(self, optimizer, num_steps):
+        """Runs `num_steps` training steps in a `tf.while_loop`, each on a new batch from the input iterator.
+
+        Returns:
+            Tuple containing the average loss over the steps and the train op.
+        """
+        with tf.name_scope('multi_step_train'):
+            def body(step, total_loss):
+                loss, train_op = self._build_train_step(optimizer, self.input_iterator.get_next())
+                # The next iteration must only start after the variables have been updated.
+                with tf.control_dependencies([train_op]):
+                    return step + 1, total_loss + loss
+
+            _, total_loss = tf.while_loop(
+                cond=lambda step, _: tf.less(step, num_steps),
+                body=body,
+                loop_vars=(tf.constant(0), tf.constant(0.0)),
+                parallel_iterations=1)
+            loss = total_loss / tf.cast(num_steps, tf.float32)
+        return loss, loss.op
+
+    def top_k_predictions(self, k):
+        """Returns the scores and indices of the `k` highest scoring entities for each query.
+
+        For partitioned entity embeddings, the top-k entities are computed on the device of each partition and then
+        merged, and so the scores of all entities are never gathered on a single device.
+        """
+        if self.num_ent_partitions == 1:
+            top_k_scores, top_k_indices = tf.nn.top_k(self.predictions_all, k=k)
+            return top_k_scores, tf.cast(top_k_indices, tf.int64)
+        all_scores, all_indices = [], []
+        ent_embs, offsets = _partitions(self.variables['ent_emb'])
+        pred_biases, _ = _partitions(self.variables['pred_bias'])
+        for ent_emb, pred_bias, offset in zip(ent_embs, pred_biases, offsets):
+            with tf.device(ent_emb.device):
+                scores = tf.matmul(self.predicted_e2_emb, ent_emb, transpose_b=True) + pred_bias
+                scores, indices = tf.nn.top_k(scores, k=min(k, ent_emb.get_shape()[0].value))
+                all_scores.append(scores)
+                all_indices.append(offset + tf.cast(indices, tf.int64))
+        return _merge_top_k(all_scores, all_indices, k)
 
     def _create_variables(self):
         """Creates the network variables and returns them in a dictionary."""
+        if self.num_ent_partitions > 1:
+            ent_partitioner = tf.fixed_size_partitioner(self.num_ent_partitions)
+        else:
+            ent_partitioner = None
         ent_emb = tf.get_variable(
             name='ent_emb', dtype=tf.float32,
             shape=[self.num_ent, self.ent_emb_size],
-            initializer=tf.contrib.layers.xavier_initializer())
+            initializer=tf.contrib.layers.xavier_initializer(),
+            partitioner=ent_partitioner)
 
         if not self.is_parameter_lookup:
             rel_emb = tf.get_variable(
@@ -311,7 +642,8 @@ class ConvE(object):
                 shape=[self.ent_emb_size], initializer=tf.zeros_initializer())
         pred_bias = tf.get_variable(
             name='pred_bias', dtype=tf.float32,
-            shape=[self.num_ent], initializer=tf.zeros_initializer())
+            shape=[self.num_ent], initializer=tf.zeros_initializer(),
+            partitioner=ent_partitioner)
 
         variables = {
             'ent_emb': ent_emb,
@@ -351,7 +683,41 @@ class ConvE(object):
             bias = bias.generate(rel_emb, is_train)
         return (weights, bias)
 
-    def _create_predictions(self, e1_emb, rel_emb):
+    def _predict(self, e1, rel, add_summaries=True):
+        """Predicts the embeddings of the answers to the queries `(e1, rel)`."""
+        ent_emb = self.variables['ent_emb']
+        if not self.is_parameter_lookup:
+            rel_emb = self.variables['rel_emb']
+
+        conve_e1_emb = tf.nn.embedding_lookup(ent_emb, e1, partition_strategy='div', name='e1_emb')
+        if not self.is_parameter_lookup:
+            conve_rel_emb = tf.nn.embedding_lookup(rel_emb, rel, name='rel_emb')
+        else:
+            conve_rel_emb = rel
+
+        if self.group_by_relation:
+            unique_rel, rel_groups = tf.unique(rel)
+            if not self.is_parameter_lookup:
+                param_context = tf.nn.embedding_lookup(rel_emb, unique_rel, name='unique_rel_emb')
+            else:
+                param_context = unique_rel
+        else:
+            param_context = conve_rel_emb
+            rel_groups = None
+
+        return self._create_predictions(conve_e1_emb, conve_rel_emb, param_context, rel_groups, add_summaries)
+
+    def _create_predictions(self, e1_emb, rel_emb, param_context, rel_groups=None, add_summaries=True):
+        """Predicts the embedding of the answer entity.
+
+        Arguments:
+            e1_emb (tf.Tensor): Embeddings of the subject entities.
+            rel_emb (tf.Tensor): Embeddings of the relations (or the relation indices, for parameter lookup).
+            param_context (tf.Tensor): Context from which the relation-specific parameters are generated. If
+                `rel_groups` is provided, this contains one row per unique relation in the batch.
+            rel_groups (tf.Tensor, optional): Index of the `param_context` row corresponding to each sample.
+            add_summaries (bool, optional): Whether to add the tensor summaries, if they are enabled.
+        """
         e1_emb = tf.reshape(e1_emb, [-1, 10, self.ent_emb_size // 10, 1])
 
         is_train_float = tf.cast(self.is_train, tf.float32)
@@ -370,27 +736,33 @@ class ConvE(object):
         #     stacked_emb, 1 - (self.input_dropout * is_train_float))
 
         with tf.name_scope('conv1'):
-            weights, bias = self._get_conv_params(rel_emb, self.is_train)
+            weights, bias = self._get_conv_params(param_context, self.is_train)
             if self.context_rel_conv is not None:
-                def conv(pair):
-                    return (tf.nn.conv2d(
-                        input=pair[0][None], filter=pair[1],
-                        strides=[1, 1, 1, 1], padding='VALID')[0], tf.zeros([]))
-                conv1 = tf.map_fn(fn=conv, elems=(stacked_emb, weights))[0]
+                if rel_groups is not None:
+                    weights = tf.gather(weights, rel_groups)
+                    bias = tf.gather(bias, rel_groups)
+                with tf.name_scope('per_sample_conv'):
+                    conv1 = _per_sample_conv2d(stacked_emb, weights, impl=self.conv_impl)
                 conv1_plus_bias = conv1 + bias[:, None, None, :]
             else:
                 conv1 = tf.nn.conv2d(
                     input=stacked_emb, filter=weights,
                     strides=[1, 1, 1, 1], padding='VALID')
                 conv1_plus_bias = conv1 + bias
-            conv1_bn = tf.layers.batch_normalization(
-                conv1_plus_bias, momentum=self.batch_norm_momentum, reuse=tf.AUTO_REUSE,
-                training=is_train_batch_norm, fused=True, name='Conv1BN')
+            if self.fold_batch_norm:
+                conv1_bn = conv1_plus_bias
+            else:
+                conv1_bn = tf.layers.batch_normalization(
+                    conv1_plus_bias, momentum=self.batch_norm_momentum, reuse=tf.AUTO_REUSE,
+                    training=is_train_batch_norm, fused=True, name='Conv1BN')
             conv1_relu = tf.nn.relu(conv1_bn)
-            conv1_dropout = tf.nn.dropout(
-                conv1_relu, 1 - (self.hidden_dropout * is_train_float))
+            if self.inference_only:
+                conv1_dropout = conv1_relu
+            else:
+                conv1_dropout = tf.nn.dropout(
+                    conv1_relu, 1 - (self.hidden_dropout * is_train_float))
 
-            if self._tensor_summaries:
+            if self._tensor_summaries and add_summaries:
                 _create_summaries('conv1', conv1)
                 _create_summaries('conv1_plus_bias', conv1_plus_bias)
                 _create_summaries('conv1_bn', conv1_bn)
@@ -398,7 +770,7 @@ class ConvE(object):
                 _create_summaries('conv1_with_dropout', conv1_dropout)
 
         with tf.name_scope('fc_layer'):
-            weights, bias = self._get_fc_params(rel_emb, self.is_train)
+            weights, bias = self._get_fc_params(param_context, self.is_train)
             batch_size = tf.shape(conv1_dropout)[0]
 
             fc_input = tf.reshape(conv1_dropout, [batch_size, -1])
@@ -408,50 +780,198 @@ class ConvE(object):
 
             if self.context_rel_out is None:
                 fc = tf.matmul(fc_input, weights) + bias
+            elif rel_groups is not None:
+                fc = _grouped_matmul(fc_input, weights, rel_groups) + tf.gather(bias, rel_groups)
             else:
                 fc = tf.matmul(fc_input[:, None, :], weights)[:, 0, :] + bias
 
-            fc_dropout = tf.nn.dropout(
-                fc, 1 - (self.output_dropout * is_train_float))
-            fc_bn = tf.layers.batch_normalization(
-                fc_dropout, momentum=self.batch_norm_momentum, reuse=tf.AUTO_REUSE,
-                training=is_train_batch_norm, fused=True, name='FCBN')
+            if self.inference_only:
+                fc_dropout = fc
+            else:
+                fc_dropout = tf.nn.dropout(
+                    fc, 1 - (self.output_dropout * is_train_float))
+            if self.fold_batch_norm:
+                fc_bn = fc_dropout
+            else:
+                fc_bn = tf.layers.batch_normalization(
+                    fc_dropout, momentum=self.batch_norm_momentum, reuse=tf.AUTO_REUSE,
+                    training=is_train_batch_norm, fused=True, name='FCBN')
             fc_bn = tf.nn.relu(fc_bn)
 
-            if self._tensor_summaries:
+            if self._tensor_summaries and add_summaries:
                 _create_summaries('fc_result', fc)
                 _create_summaries('fc_with_dropout', fc_dropout)
                 _create_summaries('fc_with_batch_norm', fc_bn)
 
         return fc_bn
 
-    def _compute_likelihoods(self, predicted_e2_emb, name, ent_indices=None):
-        if self._tensor_summaries:
+    def _compute_likelihoods(self, predicted_e2_emb, name, ent_indices=None, add_summaries=True):
+        if self._tensor_summaries and add_summaries:
             _create_summaries('fc_with_activation', predicted_e2_emb)
 
         with tf.name_scope('output_layer'):
-            if ent_indices is None:
+            if ent_indices is None and self.num_ent_partitions > 1:
+                # The entities of each partition are scored separately, and the scores are then concatenated.
+                ent_embs, _ = _partitions(self.variables['ent_emb'])
+                pred_biases, _ = _partitions(self.variables['pred_bias'])
+                predictions = tf.concat([
+                    tf.matmul(predicted_e2_emb, ent_emb, transpose_b=True) + pred_bias
+                    for ent_emb, pred_bias in zip(ent_embs, pred_biases)], axis=1, name=name)
+            elif ent_indices is None:
                 ent_emb = self.variables['ent_emb']
                 ent_emb_t = tf.transpose(ent_emb)
                 predictions = tf.matmul(predicted_e2_emb, ent_emb_t, name=name)
                 predictions += self.variables['pred_bias']
+            elif self.shared_negatives:
+                # All samples in the batch are scored against the same entities, so a single lookup is needed.
+                ent_indices = ent_indices[0]
+                ent_emb = _gather_rows(self.variables['ent_emb'], ent_indices)
+                predictions = tf.matmul(predicted_e2_emb, ent_emb, transpose_b=True, name=name)
+                predictions += _gather_rows(self.variables['pred_bias'], ent_indices)
             else:
-                ent_emb = tf.gather(self.variables['ent_emb'], ent_indices) # Returns shape [BatchSize, NumSamples, EmbSize]
+                ent_emb = _gather_rows(self.variables['ent_emb'], ent_indices) # Returns shape [BatchSize, NumSamples, EmbSize]
                 ent_emb_t = tf.transpose(ent_emb, [0, 2, 1])
                 predictions = tf.matmul(predicted_e2_emb[:, None, :], ent_emb_t, name=name)[:, 0, :]
-                pred_bias = tf.gather(self.variables['pred_bias'], ent_indices)
+                pred_bias = _gather_rows(self.variables['pred_bias'], ent_indices)
                 predictions += pred_bias
-            if self._tensor_summaries:
+            if self._tensor_summaries and add_summaries:
                 _create_summaries('predictions', predictions)
         return predictions
 
-    def _create_loss(self, predictions, targets):
+    def _rank(self, predictions, e2, e2_answers):
+        """Computes the filtered ranks of the targets, given the scores of all entities.
+
+        Rather than masking the scores of the other correct answers, this counts all entities that score higher than
+        the target and subtracts the number of correct answers among them. The returned values are the same as those
+        of `_rank_in_chunks`.
+        """
+        with tf.name_scope('ranking'):
+            # Samples without a target (i.e., with `e2 = -1`) are scored against entity 0 and get rank 0, so that
+            # they can be left out of the metrics.
+            has_target = tf.greater_equal(e2, 0)
+            target_scores = tf.batch_gather(predictions, tf.maximum(e2, 0)[:, None])[:, 0]
+            num_higher = tf.reduce_sum(tf.cast(tf.greater(predictions, target_scores[:, None]), tf.int64), axis=1)
+            is_answer = tf.greater_equal(e2_answers, 0)
+            answer_scores = tf.batch_gather(predictions, tf.maximum(e2_answers, 0))
+            is_higher_answer = tf.logical_and(is_answer, tf.greater(answer_scores, target_scores[:, None]))
+            num_higher_answers = tf.reduce_sum(tf.cast(is_higher_answer, tf.int64), axis=1)
+            ranks = tf.where(has_target, 1 + num_higher - num_higher_answers, tf.zeros_like(num_higher))
+            top_k_scores, top_k_indices = tf.nn.top_k(predictions, k=self.eval_top_k)
+        return target_scores, ranks, top_k_scores, tf.cast(top_k_indices, tf.int64)
+
+    def _rank_in_chunks(self, predicted_e2_emb, e2, e2_answers):
+        """Scores all entities in blocks of `eval_chunk_size`, without materializing all the scores at once.
+
+        Arguments:
+            predicted_e2_emb (tf.Tensor): Predicted embeddings, with shape `[batch_size, ent_emb_size]`.
+            e2 (tf.Tensor): Target entities, with shape `[batch_size]`.
+            e2_answers (tf.Tensor): All correct answers of each query, with shape `[batch_size, max_num_answers]`,
+                padded with -1. These are filtered out when computing the ranks.
+
+        Returns:
+            Tuple containing the target scores, the filtered ranks of the targets (starting at 1, or 0 for samples
+            without a target), and the scores and indices of the `eval_top_k` highest scoring entities (before
+            filtering).
+        """
+        with tf.name_scope('chunked_ranking'):
+            ent_emb = self.variables['ent_emb']
+            pred_bias = self.variables['pred_bias']
+            batch_size = tf.shape(predicted_e2_emb)[0]
+            chunk_size = self.eval_chunk_size
+            num_chunks = (self.num_ent + chunk_size - 1) // chunk_size
+            k = self.eval_top_k
+
+            # Samples without a target are scored against entity 0 and get rank 0, as in `_rank`.
+            has_target = tf.greater_equal(e2, 0)
+            targets = tf.maximum(e2, 0)
+            target_scores = tf.reduce_sum(predicted_e2_emb * tf.gather(ent_emb, targets), axis=1)
+            target_scores += tf.gather(pred_bias, targets)
+            sorted_answers = tf.sort(e2_answers, axis=1)
+
+            def body(chunk, ranks, top_k_scores, top_k_indices):
+                start = tf.cast(chunk * chunk_size, tf.int64)
+                num_higher, chunk_top_k_scores, chunk_top_k_indices = self._score_block(
+                    predicted_e2_emb, ent_emb[start:start + chunk_size], pred_bias[start:start + chunk_size], start,
+                    target_scores, sorted_answers)
+
+                # Merge the top-k of this chunk with the running top-k.
+                top_k_scores, top_k_indices = _merge_top_k(
+                    [top_k_scores, chunk_top_k_scores], [top_k_indices, chunk_top_k_indices], k)
+                return chunk + 1, ranks + num_higher, top_k_scores, top_k_indices
+
+            _, ranks, top_k_scores, top_k_indices = tf.while_loop(
+                cond=lambda chunk, *_: tf.less(chunk, num_chunks),
+                body=body,
+                loop_vars=(
+                    tf.constant(0),
+                    tf.ones([batch_size], dtype=tf.int64),
+                    tf.fill(tf.stack([batch_size, k]), -float('inf')),
+                    tf.fill(tf.stack([batch_size, k]), tf.constant(-1, dtype=tf.int64))),
+                back_prop=False)
+            ranks = tf.where(has_target, ranks, tf.zeros_like(ranks))
+        return target_scores, ranks, top_k_scores, top_k_indices
+
+    def _rank_in_partitions(self, predicted_e2_emb, e2, e2_answers):
+        """Scores and ranks the entities of each partition of `ent_emb` on the device of that partition.
+
+        Only the number of non-answer entities that score higher than the target and the top-k entities of each
+        partition leave its device. The arguments and the returned values are the same as for `_rank_in_chunks`.
+        """
+        with tf.name_scope('partitioned_ranking'):
+            # Samples without a target are scored against entity 0 and get rank 0, as in `_rank`. A negative `e2`
+            # would also be routed to the wrong partition by the `'div'` partition strategy.
+            has_target = tf.greater_equal(e2, 0)
+            targets = tf.maximum(e2, 0)
+            target_scores = tf.reduce_sum(
+                predicted_e2_emb * _gather_rows(self.variables['ent_emb'], targets), axis=1)
+            target_scores += _gather_rows(self.variables['pred_bias'], targets)
+            sorted_answers = tf.sort(e2_answers, axis=1)
+
+            ranks = tf.ones([tf.shape(predicted_e2_emb)[0]], dtype=tf.int64)
+            all_top_k_scores, all_top_k_indices = [], []
+            ent_embs, offsets = _partitions(self.variables['ent_emb'])
+            pred_biases, _ = _partitions(self.variables['pred_bias'])
+            for ent_emb, pred_bias, offset in zip(ent_embs, pred_biases, offsets):
+                with tf.device(ent_emb.device):
+                    num_higher, top_k_scores, top_k_indices = self._score_block(
+                        predicted_e2_emb, ent_emb, pred_bias, tf.constant(offset, dtype=tf.int64), target_scores,
+                        sorted_answers)
+                ranks += num_higher
+                all_top_k_scores.append(top_k_scores)
+                all_top_k_indices.append(top_k_indices)
+            ranks = tf.where(has_target, ranks, tf.zeros_like(ranks))
+            top_k_scores, top_k_indices = _merge_top_k(all_top_k_scores, all_top_k_indices, self.eval_top_k)
+        return target_scores, ranks, top_k_scores, top_k_indices
+
+    def _score_block(self, predicted_e2_emb, block_emb, block_bias, start, target_scores, sorted_answers):
+        """Scores a contiguous block of entities, starting at entity `start`.
+
+        Returns:
+            Tuple containing the number of entities in the block that score higher than the target and are not
+            correct answers, and the scores and indices of the (at most) `eval_top_k` highest scoring entities.
+        """
+        batch_size = tf.shape(predicted_e2_emb)[0]
+        scores = tf.matmul(predicted_e2_emb, block_emb, transpose_b=True)
+        scores += block_bias
+        candidates = start + tf.range(tf.shape(block_emb, out_type=tf.int64)[0], dtype=tf.int64)
+        candidates = tf.tile(candidates[None, :], [batch_size, 1])
+
+        # Entities that score higher than the target and are not correct answers count towards the rank.
+        is_answer = contains_sorted(sorted_answers, candidates)
+        is_higher = tf.logical_and(tf.greater(scores, target_scores[:, None]), tf.logical_not(is_answer))
+        num_higher = tf.reduce_sum(tf.cast(is_higher, tf.int64), axis=1)
+
+        block_k = tf.minimum(self.eval_top_k, tf.shape(scores)[1])
+        top_k_scores, top_k_positions = tf.nn.top_k(scores, k=block_k)
+        return num_higher, top_k_scores, tf.batch_gather(candidates, top_k_positions)
+
+    def _create_loss(self, predictions, targets, add_summaries=True):
         with tf.name_scope('loss'):
             targets = ((1 - self.label_smoothing_epsilon) * targets) + (1.0 / self.num_ent)
             loss = tf.reduce_sum(
                 tf.losses.sigmoid_cross_entropy(targets, predictions),
                 name='loss')
 
-            if self._loss_summaries:
+            if self._loss_summaries and add_summaries:
                 tf.summary.scalar('loss', loss)
         return loss
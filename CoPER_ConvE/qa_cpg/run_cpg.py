@@ -4,37 +4,68 @@ import logging
 import numpy as np
 import os
 import pickle
+import subprocess
+import sys
 import tensorflow as tf
 import yaml
 import wandb
 
 from qa_cpg import data
-from qa_cpg.models import ConvE
-from qa_cpg.metrics import ranking_and_hits
+from qa_cpg.experiment import create_eval_datasets, create_model, create_train_dataset
+from qa_cpg.metrics import MultiSplitEvaluator
 from qa_cpg.utils.dict_with_attributes import AttributeDict
+from qa_cpg.utils.profiling import StepProfiler
 
 logger = logging.getLogger(__name__)
 
 
-def _evaluate(data_iterator, data_iterator_handle, name, summary_writer, step):
-    logger.info('Running %s at step %d...', name, step)
-    session.run(data_iterator.initializer)
-    mr, mrr, hits = ranking_and_hits(model, eval_path, data_iterator_handle, name, session)
+def _evaluate(names, summary_writer, step, sample_size=None):
+    logger.info('Running %s at step %d...', ', '.join(names), step)
+    results = evaluator.evaluate(
+        session, names, eval_path,
+        sample_size=sample_size,
+        seed=getattr(cfg.eval, 'eval_sample_seed', 0),
+        num_bootstrap_samples=getattr(cfg.eval, 'eval_num_bootstrap_samples', 1000))
+
+    all_metrics = {}
+    for name, (mr, mrr, hits, confidence_intervals) in results.items():
+        metrics = {'mr': mr, 'mrr': mrr}
+        if sample_size is not None:
+            metrics['confidence_intervals'] = confidence_intervals
+            name += '_sampled'
+
+        if cfg.eval.summary_steps is not None:
+            summary = tf.Summary()
+            for hits_level, hits_value in hits.items():
+                summary.value.add(tag=name+'/hits@'+str(hits_level), simple_value=hits_value)
+                metrics['hits@'+str(hits_level)] = hits_value;wandb.log({'hits@'+str(hits_level):hits_value})
+            summary.value.add(tag=name+'/mrr',simple_value=mrr)
+            summary.value.add(tag=name+'/mr', simple_value=mr)
+            if confidence_intervals is not None:
+                for metric, (lower, upper) in confidence_intervals.items():
+                    summary.value.add(tag=name+'/'+metric+'_lower', simple_value=lower)
+                    summary.value.add(tag=name+'/'+metric+'_upper', simple_value=upper)
+            wandb.log({name+'/mrr': mrr,name+'/mr':mr})
+            summary_writer.add_summary(summary, step)
+            summary_writer.flush()
+
+        all_metrics[name] = metrics
+
+    return all_metrics
 
-    metrics = {'mr': mr, 'mrr': mrr}
 
-    if cfg.eval.summary_steps is not None:
-        summary = tf.Summary()
-        for hits_level, hits_value in hits.items():
-            summary.value.add(tag=name+'/hits@'+str(hits_level), simple_value=hits_value)
-            metrics['hits@'+str(hits_level)] = hits_value;wandb.log({'hits@'+str(hits_level):hits_value})
-        summary.value.add(tag=name+'/mrr',simple_value=mrr)
-        summary.value.add(tag=name+'/mr', simple_value=mr)
-        wandb.log({name+'/mrr': mrr,name+'/mr':mr})
-        summary_writer.add_summary(summary, step)
-        summary_writer.flush()
+def _is_due(step, num_steps, frequency):
+    # Checks whether a multiple of `frequency` lies within the steps `[step, step + num_steps)`.
+    return frequency is not None and (-step) % frequency < num_steps
 
-    return metrics
+
+def _is_candidate(sampled_metrics, best_metrics, metric):
+    # A checkpoint is a candidate if the confidence interval of its sampled metric does not rule out an
+    # improvement over the best metric so far.
+    lower, upper = sampled_metrics['confidence_intervals'][metric]
+    if metric == 'mr':
+        return lower < best_metrics[metric]
+    return upper > best_metrics[metric]
 
 
 		
@@ -108,6 +139,7 @@ os.makedirs(eval_path, exist_ok=True)
 config_save_dir = os.path.join(working_dir, 'configs', model_name)
 os.makedirs(config_save_dir, exist_ok=True)
 config_save_path = os.path.join(config_save_dir, 'config.yml')
+trace_dir = os.path.join(working_dir, 'traces', model_name)
 if save_best_embeddings:
     embed_file = os.path.join(eval_path, 'best_embeddings.ckpt')
 
@@ -119,72 +151,16 @@ if __name__ == '__main__':
     data_loader.maybe_create_tf_record_files(data_dir)
 
     # Create the model.
-    with tf.device(cfg.training.device):
-        # We are using resource variables because due to some implementation details, this allows us to
-        # better utilize GPUs while training.
-        with tf.variable_scope('variables', use_resource=True):
-            model = ConvE(model_descriptors={
-                'use_negative_sampling': cfg.training.num_labels is not None,
-                'label_smoothing_epsilon': cfg.model.label_smoothing_epsilon,
-                'num_ent': data_loader.num_ent,
-                'num_rel': data_loader.num_rel,
-                'ent_emb_size': cfg.model.entity_embedding_size,
-                'rel_emb_size': cfg.model.relation_embedding_size,
-                'concat_rel': cfg.model.concat_rel,
-                'context_rel_conv': cfg.context.context_rel_conv,
-                'context_rel_out':  cfg.context.context_rel_out,
-                'context_rel_dropout': cfg.context.context_rel_dropout,
-                'context_rel_use_batch_norm': cfg.context.context_rel_use_batch_norm,
-                'input_dropout': cfg.model.input_dropout,
-                'hidden_dropout': cfg.model.feature_map_dropout,
-                'output_dropout': cfg.model.output_dropout,
-                'learning_rate': cfg.training.learning_rate,
-                'batch_size': cfg.training.batch_size,
-                'add_loss_summaries': cfg.eval.add_loss_summaries,
-                'add_variable_summaries': cfg.eval.add_variable_summaries,
-                'add_tensor_summaries': cfg.eval.add_tensor_summaries,
-                'batch_norm_momentum': cfg.model.batch_norm_momentum,
-                'batch_norm_train_stats': cfg.model.batch_norm_train_stats,
-                'do_parameter_lookup': use_parameter_lookup})
+    model = create_model(cfg, data_loader.num_ent, data_loader.num_rel, use_parameter_lookup=use_parameter_lookup)
 
     # Create dataset iterator initializers.
-    logger.info('Creating train dataset...')
-    train_dataset = data_loader.train_dataset(
-        directory=data_dir,
-        batch_size=cfg.training.batch_size,
-        include_inv_relations=True,
-        buffer_size=1024,
-        prefetch_buffer_size=16,
-        prop_negatives=cfg.training.prop_negatives,
-        num_labels=cfg.training.num_labels,
-        cache=cfg.training.cache_data,
-        one_positive_label_per_sample=cfg.training.one_positive_label_per_sample)
-    logger.info('Creating train eval dataset...')
-    train_eval_dataset = data_loader.eval_dataset(
-        directory=data_dir,
-        dataset_type='train',
-        batch_size=cfg.training.batch_size,
-        include_inv_relations=False,
-        buffer_size=1024,
-        prefetch_buffer_size=16)
-    logger.info('Creating dev dataset...')
-    dev_eval_dataset = data_loader.eval_dataset(
-        directory=data_dir,
-        dataset_type='dev',
-        batch_size=cfg.training.batch_size,
-        include_inv_relations=False,
-        buffer_size=1024,
-        prefetch_buffer_size=16)
-    logger.info('Creating test dataset...')
-    test_eval_dataset = data_loader.eval_dataset(
-        directory=data_dir,
-        dataset_type='test',
-        batch_size=cfg.training.batch_size,
-        include_inv_relations=False,
-        buffer_size=1024,
-        prefetch_buffer_size=16)
-
-    train_iterator = train_dataset.make_one_shot_iterator()
+    train_dataset = create_train_dataset(data_loader, data_dir, cfg)
+    eval_datasets = create_eval_datasets(data_loader, data_dir, cfg)
+    train_eval_dataset = eval_datasets['train']
+    dev_eval_dataset = eval_datasets['dev']
+    test_eval_dataset = eval_datasets['test']
+
+    train_iterator = train_dataset.make_initializable_iterator()
     train_eval_iterator = train_eval_dataset.make_initializable_iterator()
     dev_eval_iterator = dev_eval_dataset.make_initializable_iterator()
     test_eval_iterator = test_eval_dataset.make_initializable_iterator()
@@ -197,11 +173,15 @@ if __name__ == '__main__':
     config = tf.ConfigProto(allow_soft_placement=True)
     config.gpu_options.allow_growth = True
     session = tf.Session(config=config)
-    saver = tf.train.Saver()
+    # In the background evaluation mode, `max_checkpoints_to_keep` needs to be large enough that checkpoints are not
+    # deleted before the evaluator gets to them.
+    saver = tf.train.Saver(max_to_keep=getattr(cfg.eval, 'max_checkpoints_to_keep', 5))
     summary_writer = tf.summary.FileWriter(summaries_dir, session.graph)
 
     # Initialize the values of all variables and the train dataset iterator.
     session.run(tf.global_variables_initializer())
+    data.initialize_query_tables(session)
+    session.run(train_iterator.initializer)
 
     # Obtain the dataset iterator handles.
     train_iterator_handle = session.run(train_iterator.string_handle())
@@ -209,42 +189,116 @@ if __name__ == '__main__':
     dev_eval_iterator_handle = session.run(dev_eval_iterator.string_handle())
     test_eval_iterator_handle = session.run(test_eval_iterator.string_handle())
 
+    # The evaluation samples are cached in memory the first time that each split is evaluated.
+    evaluator = MultiSplitEvaluator(
+        model, batch_size=cfg.training.batch_size, pad_batches=getattr(cfg.training, 'use_xla', False))
+    evaluator.add_split('train_evaluation', train_eval_iterator, train_eval_iterator_handle)
+    evaluator.add_split('dev_evaluation', dev_eval_iterator, dev_eval_iterator_handle)
+    evaluator.add_split('test_evaluation', test_eval_iterator, test_eval_iterator_handle)
+
     validation_metric = cfg.eval.validation_metric
     best_metrics_dev = {validation_metric: -np.inf if validation_metric != 'mr' else np.inf}
     metrics_test_at_best_dev = {validation_metric: -np.inf if validation_metric != 'mrr' else np.inf}
     best_iter = None
     if model_load_path is not None:
         saver.restore(session, model_load_path)
-        _evaluate(test_eval_iterator, test_eval_iterator_handle, 'test', summary_writer, 0)
+        _evaluate(['test_evaluation'], summary_writer, 0)
         exit()
-    for step in range(cfg.training.max_steps):
+
+    # In the background evaluation mode, the training process only writes checkpoints, which are evaluated by a
+    # separate evaluator process.
+    background_eval = getattr(cfg.eval, 'background', False)
+    if background_eval:
+        data_loader_path = os.path.join(config_save_dir, 'data_loader.pkl')
+        with open(data_loader_path, 'wb') as handle:
+            pickle.dump(data_loader, handle)
+        evaluator_command = [
+            sys.executable, '-m', 'qa_cpg.run_evaluator',
+            '--config', config_save_path,
+            '--data_loader', data_loader_path,
+            '--data_dir', data_dir,
+            '--checkpoint_dir', ckpt_dir,
+            '--eval_dir', eval_path,
+            '--summaries_dir', os.path.join(summaries_dir, 'evaluator'),
+            '--last_step', str(cfg.training.max_steps),
+            '--trainer_pid', str(os.getpid())]
+        if use_parameter_lookup:
+            evaluator_command.append('--use_parameter_lookup')
+        logger.info('Starting the background evaluator...')
+        evaluator_process = subprocess.Popen(evaluator_command)
+    # If `steps_per_run` is larger than 1, multiple training steps are run in each `session.run` call, and the loss
+    # that is logged is their average.
+    steps_per_run = getattr(cfg.training, 'steps_per_run', 1)
+    # If `trace_steps` is set, every `trace_steps` steps are traced, and their timelines and per-op profiles are
+    # written to `trace_dir`.
+    trace_steps = getattr(cfg.eval, 'trace_steps', None)
+    profiler = StepProfiler(trace_dir) if trace_steps is not None else None
+    step = 0
+    while step < cfg.training.max_steps:
         feed_dict = {
             model.is_train: True,
             model.input_iterator_handle: train_iterator_handle}
-
-        if model.summaries is not None and cfg.eval.summary_steps is not None and step % cfg.eval.summary_steps == 0:
-            summaries, loss, _ = session.run((model.summaries, model.loss, model.train_op), feed_dict)
+        trace = _is_due(step, 1, trace_steps)
+        run_options = profiler.run_options() if trace else None
+        run_metadata = tf.RunMetadata() if trace else None
+
+        if model.summaries is not None and _is_due(step, 1, cfg.eval.summary_steps):
+            num_steps = 1
+            summaries, loss, _ = session.run(
+                (model.summaries, model.loss, model.train_op), feed_dict,
+                options=run_options, run_metadata=run_metadata)
             summary_writer.add_summary(summaries, step)
             summary_writer.flush()
+        elif steps_per_run > 1 and not trace:
+            num_steps = min(steps_per_run, cfg.training.max_steps - step)
+            if model.summaries is not None and cfg.eval.summary_steps is not None:
+                # Stop at the next summary step, so that it runs as a single step.
+                num_steps = min(num_steps, (-step) % cfg.eval.summary_steps)
+            if trace_steps is not None:
+                # Similarly, traced steps run as single steps.
+                num_steps = min(num_steps, (-step) % trace_steps)
+            feed_dict[model.num_steps] = num_steps
+            loss, _ = session.run((model.multi_step_loss, model.multi_step_train_op), feed_dict)
         else:
-            loss, _ = session.run((model.loss, model.train_op), feed_dict)
+            num_steps = 1
+            loss, _ = session.run(
+                (model.loss, model.train_op), feed_dict, options=run_options, run_metadata=run_metadata)
+
+        if trace:
+            profiler.record(step, run_metadata)
+            summary_writer.add_run_metadata(run_metadata, 'step_%d' % step, step)
 
         # Log the loss, if necessary.
-        if step % cfg.eval.log_steps == 0:
+        if _is_due(step, num_steps, cfg.eval.log_steps):
             logger.info('Step %6d | Loss: %10.4f', step, loss);wandb.log({'loss':loss})
         # Evaluate, if necessary.
-        if step % cfg.eval.eval_steps == 0:
+        if background_eval and _is_due(step, num_steps, cfg.eval.eval_steps):
+            logger.info('Step %d. Saving checkpoint at %s...', step, ckpt_path)
+            saver.save(session, ckpt_path, global_step=step)
+        elif _is_due(step, num_steps, cfg.eval.eval_steps):
             # Perform evaluation.
             logger.info('Evaluating model with name %s ...', model_name)
+            eval_splits = []
             if cfg.eval.eval_on_train:
-                _evaluate(train_eval_iterator, train_eval_iterator_handle, 'train_evaluation', summary_writer, step)
+                eval_splits.append('train_evaluation')
             if cfg.eval.eval_on_dev:
-                metrics_dev = _evaluate(
-                    dev_eval_iterator, dev_eval_iterator_handle, 'dev_evaluation', summary_writer, step)
+                eval_splits.append('dev_evaluation')
             if cfg.eval.eval_on_test:
-                metrics_test = _evaluate(
-                    test_eval_iterator, test_eval_iterator_handle, 'test_evaluation', summary_writer, step)
-            if cfg.eval.eval_on_dev and cfg.eval.eval_on_test:
+                eval_splits.append('test_evaluation')
+            eval_sample_size = getattr(cfg.eval, 'eval_sample_size', None)
+            eval_metrics = _evaluate(eval_splits, summary_writer, step, sample_size=eval_sample_size)
+            if eval_sample_size is None:
+                metrics_dev = eval_metrics.get('dev_evaluation')
+                metrics_test = eval_metrics.get('test_evaluation')
+            elif cfg.eval.eval_on_dev and cfg.eval.eval_on_test:
+                # The full evaluation is only run for candidate checkpoints.
+                metrics_dev = None
+                if _is_candidate(eval_metrics['dev_evaluation_sampled'], best_metrics_dev, validation_metric):
+                    logger.info('Step %d is a candidate. Running the full evaluation...', step)
+                    eval_metrics = _evaluate(['dev_evaluation', 'test_evaluation'], summary_writer, step)
+                    metrics_dev = eval_metrics['dev_evaluation']
+                    metrics_test = eval_metrics['test_evaluation']
+            if cfg.eval.eval_on_dev and cfg.eval.eval_on_test and metrics_dev is not None:
                 if (best_metrics_dev[validation_metric] < metrics_dev[validation_metric]):
                     best_metrics_dev = metrics_dev
                     metrics_test_at_best_dev = metrics_test
@@ -252,10 +306,10 @@ if __name__ == '__main__':
                     if save_best_embeddings:
                         # Save relation and entity embeddings at the best validation point
                         if not use_parameter_lookup:
-                            rel_embed, ent_embed = session.run([model.variables['rel_emb'], model.variables['ent_emb']])
+                            rel_embed, ent_embed = session.run([model.variables['rel_emb'], model.ent_emb_table])
                             pickle.dump([rel_embed, ent_embed], open(embed_file, 'wb'))
                         else:
-                            ent_embed = session.run(model.variables['ent_emb'])
+                            ent_embed = session.run(model.ent_emb_table)
                             pickle.dump(ent_embed, open(embed_file, 'wb'))
 
                     logger.info('Step %d. Saving checkpoint at %s...', step, ckpt_path)
@@ -269,7 +323,13 @@ if __name__ == '__main__':
 #             logger.info('Step %d. Saving checkpoint at %s...', step, ckpt_path)
 #             saver.save(session, ckpt_path)
 
-    if cfg.eval.eval_on_dev and cfg.eval.eval_on_test:
+        step += num_steps
+
+    if background_eval:
+        saver.save(session, ckpt_path, global_step=cfg.training.max_steps)
+        logger.info('Waiting for the background evaluator to finish...')
+        evaluator_process.wait()
+    elif cfg.eval.eval_on_dev and cfg.eval.eval_on_test:
         logger.info('Best dev %s so far is at step %d. Best dev metrics: %s',
 			validation_metric, best_iter, str(best_metrics_dev));wandb.log({'best_metrics_dev':best_metrics_dev})
         logger.info('Test metrics at best dev: %s', str(metrics_test_at_best_dev));wandb.log({'metrics_test_at_best_dev':metrics_test_at_best_dev})
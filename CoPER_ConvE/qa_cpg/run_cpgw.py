@@ -190,7 +190,7 @@ if __name__ == '__main__':
         buffer_size=1024,
         prefetch_buffer_size=16)
 
-    train_iterator = train_dataset.make_one_shot_iterator()
+    train_iterator = train_dataset.make_initializable_iterator()
     train_eval_iterator = train_eval_dataset.make_initializable_iterator()
     dev_eval_iterator = dev_eval_dataset.make_initializable_iterator()
     test_eval_iterator = test_eval_dataset.make_initializable_iterator()
@@ -208,6 +208,8 @@ if __name__ == '__main__':
 
     # Initialize the values of all variables and the train dataset iterator.
     session.run(tf.global_variables_initializer())
+    data.initialize_query_tables(session)
+    session.run(train_iterator.initializer)
 
     # Obtain the dataset iterator handles.
     train_iterator_handle = session.run(train_iterator.string_handle())
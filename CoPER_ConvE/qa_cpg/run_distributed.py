@@ -0,0 +1,275 @@
+"""Trains ConvE models with synchronous data-parallel workers on a single (CPU) node.
+
+The launcher starts a cluster of local processes: `num_ps` parameter servers, which hold the model variables, and
+`num_workers` workers, each of which reads a disjoint shard of the training TFRecords. The gradients of all workers
+are aggregated by a `SyncReplicasOptimizer` before each update. The entity embedding gradients are sparse, and so
+only the rows used by each worker are sent to and accumulated on the parameter servers.
+
+The chief worker saves checkpoints every `eval.ckpt_steps` steps and after the last step, in a subdirectory of
+`checkpoint_dir` per number of workers. If that subdirectory already contains checkpoints, training resumes from the
+latest one.
+
+Multiple numbers of workers can be provided, in which case the launcher trains with each of them in turn, and
+reports the throughput (in samples per second) along with the scaling efficiency relative to the first one.
+
+Usage:
+    python -m qa_cpg.run_distributed --config [config.yml] --loader [KinshipLoader] --data_dir [data_dir] \
+        --checkpoint_dir [ckpt_dir] --num_workers 1 2 4 --num_steps 200
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tensorflow as tf
+import yaml
+
+from . import data
+from .experiment import create_model, create_train_dataset
+from .utils.dict_with_attributes import AttributeDict
+
+logger = logging.getLogger(__name__)
+
+
+def _free_ports(num_ports):
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def _session_config(num_threads):
+    config = tf.ConfigProto(
+        allow_soft_placement=True,
+        intra_op_parallelism_threads=num_threads,
+        inter_op_parallelism_threads=num_threads)
+    config.gpu_options.allow_growth = True
+    return config
+
+
+class _InputInitializerHook(tf.train.SessionRunHook):
+    """Loads the query tables of the input pipeline and initializes the train dataset iterator of a worker, whenever
+    its session is created."""
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+
+    def after_create_session(self, session, coord):
+        data.initialize_query_tables(session)
+        session.run(self._iterator.initializer)
+
+
+def run_ps(cluster, task_index, num_threads):
+    """Runs a parameter server until the process is terminated."""
+    server = tf.train.Server(
+        cluster, job_name='ps', task_index=task_index, config=_session_config(num_threads))
+    server.join()
+
+
+def run_worker(cfg, data_loader, data_dir, checkpoint_dir, cluster, task_index, num_steps, num_warmup_steps,
+               num_threads, use_parameter_lookup=False):
+    """Runs a training worker.
+
+    Arguments:
+        cfg (AttributeDict): Experiment configuration.
+        data_loader (_DataLoader): Data loader of the experiment.
+        data_dir (str): Data directory of the experiment.
+        checkpoint_dir (str): Directory in which the chief saves the checkpoints, and from which training resumes.
+        cluster (tf.train.ClusterSpec): Cluster specification.
+        task_index (int): Index of this worker. Worker 0 is the chief.
+        num_steps (int): Number of (synchronous) training steps.
+        num_warmup_steps (int): Number of initial steps that are excluded from the throughput measurement.
+        num_threads (int): Number of threads used by this worker.
+        use_parameter_lookup (bool, optional): Whether the model uses parameter lookup.
+
+    Returns:
+        Throughput of the whole cluster, in samples per second, as measured by this worker, or `None` if fewer
+        than `num_warmup_steps` steps were run (e.g., because training resumed from a later checkpoint).
+    """
+    server = tf.train.Server(
+        cluster, job_name='worker', task_index=task_index, config=_session_config(num_threads))
+    num_workers = cluster.num_tasks('worker')
+    is_chief = task_index == 0
+    worker_device = '/job:worker/task:%d' % task_index
+
+    data_loader.maybe_create_tf_record_files(data_dir)
+    with tf.device(tf.train.replica_device_setter(worker_device=worker_device, cluster=cluster)):
+        model = create_model(
+            cfg, data_loader.num_ent, data_loader.num_rel, use_parameter_lookup=use_parameter_lookup,
+            num_replicas=num_workers)
+    with tf.device(worker_device + '/CPU:0'):
+        train_dataset = create_train_dataset(
+            data_loader, data_dir, cfg, num_shards=num_workers, shard_index=task_index)
+        train_iterator = train_dataset.make_initializable_iterator()
+        train_iterator_handle = train_iterator.string_handle()
+
+    hooks = [
+        model.optimizer.make_session_run_hook(is_chief),
+        tf.train.StopAtStepHook(last_step=num_steps),
+        _InputInitializerHook(train_iterator)]
+    # Only the chief saves checkpoints, every `ckpt_steps` steps and once training stops.
+    scaffold = tf.train.Scaffold(saver=tf.train.Saver(
+        sharded=True, max_to_keep=getattr(cfg.eval, 'max_checkpoints_to_keep', 5)))
+    with tf.train.MonitoredTrainingSession(
+            master=server.target, is_chief=is_chief, checkpoint_dir=checkpoint_dir, scaffold=scaffold, hooks=hooks,
+            config=_session_config(num_threads), save_checkpoint_secs=None,
+            save_checkpoint_steps=getattr(cfg.eval, 'ckpt_steps', None) or num_steps, save_summaries_steps=None,
+            log_step_count_steps=None) as session:
+        feed_dict = {
+            model.is_train: True,
+            model.input_iterator_handle: session.run(train_iterator_handle)}
+        start_step, start_time = None, None
+        step = 0
+        while not session.should_stop():
+            loss, step, _ = session.run((model.loss, model.global_step, model.train_op), feed_dict)
+            if start_step is None and step >= num_warmup_steps:
+                start_step, start_time = step, time.time()
+            if step % cfg.eval.log_steps == 0:
+                logger.info('Worker %d | Step %6d | Loss: %10.4f', task_index, step, loss)
+        end_time = time.time()
+    if is_chief and checkpoint_dir is not None:
+        logger.info('Saved the checkpoints of step %d in %s.', step, checkpoint_dir)
+
+    if start_step is None or step <= start_step:
+        return None
+    # Every synchronous step consumes one batch from each worker.
+    return (step - start_step) * cfg.training.batch_size * num_workers / (end_time - start_time)
+
+
+def _launch_cluster(args, num_workers):
+    """Trains with `num_workers` local worker processes and returns the throughput measured by the chief, or `None`
+    if the chief did not measure it."""
+    ports = _free_ports(args.num_ps + num_workers)
+    cluster = {
+        'ps': ['localhost:%d' % port for port in ports[:args.num_ps]],
+        'worker': ['localhost:%d' % port for port in ports[args.num_ps:]]}
+    num_threads = args.num_threads or max(1, multiprocessing.cpu_count() // num_workers)
+    result_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+
+    def start(job_name, task_index):
+        command = [
+            sys.executable, '-m', 'qa_cpg.run_distributed',
+            '--config', args.config,
+            '--loader', args.loader,
+            '--data_dir', args.data_dir,
+            '--checkpoint_dir', os.path.join(args.checkpoint_dir, 'workers_%d' % num_workers),
+            '--num_steps', str(args.num_steps),
+            '--num_warmup_steps', str(args.num_warmup_steps),
+            '--num_threads', str(num_threads),
+            '--cluster', json.dumps(cluster),
+            '--job_name', job_name,
+            '--task_index', str(task_index),
+            '--result_file', result_file]
+        if args.use_parameter_lookup:
+            command.append('--use_parameter_lookup')
+        return subprocess.Popen(command)
+
+    logger.info('Starting %d parameter servers and %d workers...', args.num_ps, num_workers)
+    ps_processes = [start('ps', i) for i in range(args.num_ps)]
+    worker_processes = [start('worker', i) for i in range(num_workers)]
+    try:
+        return_codes = [process.wait() for process in worker_processes]
+    finally:
+        for process in ps_processes + worker_processes:
+            if process.poll() is None:
+                process.terminate()
+    if any(return_codes):
+        raise RuntimeError('Workers exited with return codes: %s' % str(return_codes))
+
+    try:
+        with open(result_file, 'r') as handle:
+            return json.load(handle)['throughput']
+    except (IOError, ValueError, KeyError):
+        logger.warning('The chief did not write its throughput to %s.', result_file)
+        return None
+    finally:
+        if os.path.exists(result_file):
+            os.remove(result_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', required=True, help='Path to the experiment config file.')
+    parser.add_argument('--loader', required=True, help='Name of the data loader class (e.g., `KinshipLoader`).')
+    parser.add_argument('--data_dir', required=True)
+    parser.add_argument('--checkpoint_dir', default=None,
+                        help='Directory in which to save the checkpoints. Defaults to `temp/[dataset]/distributed`.')
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--num_ps', type=int, default=1)
+    parser.add_argument('--num_steps', type=int, default=200)
+    parser.add_argument('--num_warmup_steps', type=int, default=20)
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='Number of threads per process. Defaults to the number of cores per worker.')
+    parser.add_argument('--use_parameter_lookup', action='store_true')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to.')
+    # The following arguments are set by the launcher for the processes that it starts.
+    parser.add_argument('--cluster', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--job_name', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--task_index', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.num_warmup_steps < 0:
+        parser.error('Parameter `num_warmup_steps` must be non-negative.')
+    if args.num_steps <= args.num_warmup_steps:
+        parser.error('Parameter `num_steps` must be larger than `num_warmup_steps`.')
+    if args.num_ps < 1 or min(args.num_workers) < 1:
+        parser.error('Parameters `num_ps` and `num_workers` must be positive.')
+
+    if args.job_name is not None:
+        cluster = tf.train.ClusterSpec(json.loads(args.cluster))
+        if args.job_name == 'ps':
+            run_ps(cluster, args.task_index, args.num_threads)
+            return
+        with open(args.config, 'r') as handle:
+            cfg = AttributeDict(yaml.safe_load(handle))
+        throughput = run_worker(
+            cfg, getattr(data, args.loader)(), args.data_dir, args.checkpoint_dir, cluster, args.task_index,
+            args.num_steps, args.num_warmup_steps, args.num_threads, use_parameter_lookup=args.use_parameter_lookup)
+        if args.task_index == 0:
+            with open(args.result_file, 'w') as handle:
+                json.dump({'throughput': throughput}, handle)
+        return
+
+    # Create the TFRecord files once, before the workers start reading them.
+    data_loader = getattr(data, args.loader)()
+    data_loader.maybe_create_tf_record_files(args.data_dir)
+    if args.checkpoint_dir is None:
+        args.checkpoint_dir = os.path.join(os.getcwd(), 'temp', data_loader.dataset_name, 'distributed')
+
+    results = []
+    for num_workers in args.num_workers:
+        throughput = _launch_cluster(args, num_workers)
+        result = {'num_workers': num_workers, 'samples_per_second': throughput, 'scaling_efficiency': None}
+        if throughput is None:
+            logger.warning('Workers: %3d | No throughput was measured.', num_workers)
+            results.append(result)
+            continue
+        baseline = results[0] if results else result
+        if baseline['samples_per_second'] is not None:
+            per_worker_baseline = baseline['samples_per_second'] / baseline['num_workers']
+            result['scaling_efficiency'] = throughput / (num_workers * per_worker_baseline)
+            logger.info(
+                'Workers: %3d | Throughput: %10.1f samples/s | Scaling efficiency: %6.2f%%',
+                num_workers, throughput, 100.0 * result['scaling_efficiency'])
+        else:
+            logger.info('Workers: %3d | Throughput: %10.1f samples/s', num_workers, throughput)
+        results.append(result)
+
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+        logger.info('Results written to: %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
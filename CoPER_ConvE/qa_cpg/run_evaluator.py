@@ -0,0 +1,182 @@
+"""Evaluates the checkpoints written by a training run, in a separate process.
+
+When `eval.background` is enabled, `run_cpg` only writes checkpoints every `eval_steps` steps and starts this
+evaluator, which watches the checkpoint directory, ranks the dev and test splits for each new checkpoint, keeps
+track of the best validation metric, and exports the embeddings of the best checkpoint. Training throughput is
+then not affected by how often the model is evaluated. The best checkpoint is also copied to the evaluation
+directory, so that it is kept even after the training process deletes it. If the training process exits before
+writing its last checkpoint (e.g., because it crashed), the evaluator stops once all remaining checkpoints have
+been evaluated.
+
+Usage:
+    python -m qa_cpg.run_evaluator --config [config.yml] --data_loader [data_loader.pkl] --data_dir [data_dir] \
+        --checkpoint_dir [ckpt_dir] --eval_dir [eval_dir] --summaries_dir [summaries_dir] --last_step [max_steps] \
+        --trainer_pid [pid]
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import os
+import pickle
+import tensorflow as tf
+import yaml
+
+from . import data
+from .experiment import create_eval_datasets, create_model
+from .metrics import MultiSplitEvaluator, is_better
+from .utils.dict_with_attributes import AttributeDict
+
+logger = logging.getLogger(__name__)
+
+# Number of seconds to wait for a new checkpoint before checking whether the training process is still running.
+_TRAINER_POLL_SECONDS = 60
+
+
+def _checkpoint_step(checkpoint_path):
+    return int(checkpoint_path.rsplit('-', 1)[-1])
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user.
+        return True
+    return True
+
+
+def run_evaluator(cfg, data_loader, data_dir, checkpoint_dir, eval_dir, summaries_dir, last_step=None,
+                  use_parameter_lookup=False, timeout=None, trainer_pid=None):
+    """Evaluates every new checkpoint in `checkpoint_dir`, until the checkpoint of `last_step` is evaluated.
+
+    Arguments:
+        cfg (AttributeDict): Experiment configuration.
+        data_loader (_DataLoader): Data loader of the experiment.
+        data_dir (str): Data directory of the experiment.
+        checkpoint_dir (str): Directory in which the training process writes its checkpoints.
+        eval_dir (str): Directory in which to write the evaluation results and the best embeddings.
+        summaries_dir (str): Directory in which to write the evaluation summaries.
+        last_step (int, optional): Step of the last checkpoint that the training process writes.
+        use_parameter_lookup (bool, optional): Whether the model uses parameter lookup.
+        timeout (float, optional): Maximum number of seconds to wait for a new checkpoint. If `trainer_pid` is
+            provided, this is instead how often to check whether the training process is still running while
+            waiting, and defaults to `_TRAINER_POLL_SECONDS`.
+        trainer_pid (int, optional): Process ID of the training process. If provided, the evaluator stops waiting
+            for new checkpoints once that process has exited.
+
+    Returns:
+        Tuple containing the best dev metrics, the test metrics at the best dev step, and the best dev step.
+    """
+    data_loader.maybe_create_tf_record_files(data_dir)
+    model = create_model(
+        cfg, data_loader.num_ent, data_loader.num_rel, use_parameter_lookup=use_parameter_lookup)
+    eval_datasets = create_eval_datasets(data_loader, data_dir, cfg, dataset_types=('dev', 'test'))
+    iterators = {
+        dataset_type: dataset.make_initializable_iterator()
+        for dataset_type, dataset in eval_datasets.items()}
+
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    session = tf.Session(config=config)
+    data.initialize_query_tables(session)
+    saver = tf.train.Saver()
+    summary_writer = tf.summary.FileWriter(summaries_dir)
+
+    evaluator = MultiSplitEvaluator(
+        model, batch_size=cfg.training.batch_size, pad_batches=getattr(cfg.training, 'use_xla', False))
+    for dataset_type, iterator in iterators.items():
+        evaluator.add_split(
+            '%s_evaluation' % dataset_type, iterator, session.run(iterator.string_handle()))
+
+    validation_metric = cfg.eval.validation_metric
+    embed_file = os.path.join(eval_dir, 'best_embeddings.ckpt')
+    best_checkpoint_path = os.path.join(eval_dir, 'best_model.ckpt')
+    best_metrics_dev = None
+    metrics_test_at_best_dev = None
+    best_step = None
+    timeout_fn = None
+    if trainer_pid is not None:
+        timeout = timeout if timeout is not None else _TRAINER_POLL_SECONDS
+        timeout_fn = lambda: not _is_running(trainer_pid)
+    step = None
+    for checkpoint_path in tf.train.checkpoints_iterator(checkpoint_dir, timeout=timeout, timeout_fn=timeout_fn):
+        step = _checkpoint_step(checkpoint_path)
+        logger.info('Evaluating checkpoint %s...', checkpoint_path)
+        try:
+            saver.restore(session, checkpoint_path)
+        except tf.errors.NotFoundError:
+            # The training process only keeps its most recent checkpoints (see `eval.max_checkpoints_to_keep`).
+            logger.warning('Checkpoint %s was deleted before it could be evaluated.', checkpoint_path)
+            continue
+        results = evaluator.evaluate(session, ['dev_evaluation', 'test_evaluation'], eval_dir)
+
+        all_metrics = {}
+        summary = tf.Summary()
+        for name, (mr, mrr, hits, _) in results.items():
+            metrics = {'mr': mr, 'mrr': mrr}
+            for hits_level, hits_value in hits.items():
+                summary.value.add(tag=name + '/hits@' + str(hits_level), simple_value=hits_value)
+                metrics['hits@' + str(hits_level)] = hits_value
+            summary.value.add(tag=name + '/mrr', simple_value=mrr)
+            summary.value.add(tag=name + '/mr', simple_value=mr)
+            all_metrics[name] = metrics
+        summary_writer.add_summary(summary, step)
+        summary_writer.flush()
+
+        if is_better(all_metrics['dev_evaluation'], best_metrics_dev, validation_metric):
+            best_metrics_dev = all_metrics['dev_evaluation']
+            metrics_test_at_best_dev = all_metrics['test_evaluation']
+            best_step = step
+            # Keep a copy of the best checkpoint, which the training process may delete later.
+            saver.save(session, best_checkpoint_path, latest_filename='best_checkpoint')
+            # Save relation and entity embeddings at the best validation point.
+            if not use_parameter_lookup:
+                rel_embed, ent_embed = session.run([model.variables['rel_emb'], model.ent_emb_table])
+                pickle.dump([rel_embed, ent_embed], open(embed_file, 'wb'))
+            else:
+                ent_embed = session.run(model.ent_emb_table)
+                pickle.dump(ent_embed, open(embed_file, 'wb'))
+
+        logger.info('Best dev %s so far is at step %d. Best dev metrics: %s',
+                    validation_metric, best_step, str(best_metrics_dev))
+        logger.info('Test metrics at best dev: %s', str(metrics_test_at_best_dev))
+
+        if last_step is not None and step >= last_step:
+            break
+    else:
+        if last_step is not None and (step is None or step < last_step):
+            logger.warning('Stopped waiting for checkpoints before the checkpoint of step %d was written.', last_step)
+
+    return best_metrics_dev, metrics_test_at_best_dev, best_step
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', required=True, help='Path to the config file saved by the training process.')
+    parser.add_argument('--data_loader', required=True, help='Path to the pickled data loader.')
+    parser.add_argument('--data_dir', required=True)
+    parser.add_argument('--checkpoint_dir', required=True)
+    parser.add_argument('--eval_dir', required=True)
+    parser.add_argument('--summaries_dir', required=True)
+    parser.add_argument('--last_step', type=int, default=None)
+    parser.add_argument('--use_parameter_lookup', action='store_true')
+    parser.add_argument('--timeout', type=float, default=None)
+    parser.add_argument('--trainer_pid', type=int, default=None,
+                        help='Process ID of the training process. The evaluator stops once it has exited.')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as handle:
+        cfg = AttributeDict(yaml.safe_load(handle))
+    with open(args.data_loader, 'rb') as handle:
+        data_loader = pickle.load(handle)
+    run_evaluator(
+        cfg, data_loader, args.data_dir, args.checkpoint_dir, args.eval_dir, args.summaries_dir,
+        last_step=args.last_step, use_parameter_lookup=args.use_parameter_lookup, timeout=args.timeout,
+        trainer_pid=args.trainer_pid)
+
+
+if __name__ == '__main__':
+    main()
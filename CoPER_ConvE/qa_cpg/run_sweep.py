@@ -0,0 +1,174 @@
+"""Trains the ConvE models of multiple configurations in a single process, sharing one input pipeline.
+
+Each configuration is built as a separate tower (i.e., a `ConvE` model in its own variable scope), and all towers are
+fed by the same training dataset iterator. Every `session.run` call trains all towers on the same batch, and so the
+TFRecords are parsed, and the negatives sampled, only once per step for the whole sweep. The configurations may
+differ in any model or optimization parameter, but their training dataset options (e.g., `batch_size` and
+`num_labels`, see `experiment.train_dataset_options`) must be equal.
+
+Each tower is evaluated on the dev and test splits every `eval_steps` steps of its configuration, and its checkpoint
+is saved whenever its validation metric improves. The checkpoints use the same variable names as those written by
+`run_cpg`, and so they can be used with `run_evaluator`, `export`, and `server`.
+
+Usage:
+    python -m qa_cpg.run_sweep --configs qa_cpg/configs/config_kinship_plain.yaml [config2.yaml ...] \
+        --loader KinshipLoader --data_dir [data_dir] --output_dir [output_dir]
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import json
+import logging
+import os
+import tensorflow as tf
+import yaml
+
+from . import data
+from .experiment import create_eval_datasets, create_model, create_train_dataset, train_dataset_options
+from .metrics import MultiSplitEvaluator, is_better
+from .models import create_model_inputs
+from .utils.dict_with_attributes import AttributeDict
+
+logger = logging.getLogger(__name__)
+
+
+def _tower_saver(scope):
+    """Creates a saver for the variables of a tower, which saves them without the `scope` prefix."""
+    var_list = collections.OrderedDict()
+    for variable in tf.global_variables(scope=scope + '/'):
+        save_slice_info = variable._get_save_slice_info()
+        if save_slice_info is None:
+            var_list[variable.op.name[len(scope) + 1:]] = variable
+        else:
+            # The partitions of partitioned variables are saved as slices of the full variable.
+            var_list.setdefault(save_slice_info.full_name[len(scope) + 1:], []).append(variable)
+    return tf.train.Saver(var_list)
+
+
+def _metrics(results):
+    all_metrics = {}
+    for name, (mr, mrr, hits, _) in results.items():
+        metrics = {'mr': mr, 'mrr': mrr}
+        for hits_level, hits_value in hits.items():
+            metrics['hits@' + str(hits_level)] = hits_value
+        all_metrics[name] = metrics
+    return all_metrics
+
+
+def run_sweep(cfgs, names, data_loader, data_dir, output_dir, use_parameter_lookup=False):
+    """Trains one tower per configuration, feeding all of them from a shared training dataset iterator.
+
+    Arguments:
+        cfgs (list): Experiment configurations (`AttributeDict`s).
+        names (list): Names of the configurations, used for logging and for the output directories.
+        data_loader (_DataLoader): Data loader of the experiments.
+        data_dir (str): Data directory of the experiments.
+        output_dir (str): Directory in which to write the checkpoints and the evaluation results of each tower.
+        use_parameter_lookup (bool, optional): Whether the models use parameter lookup.
+
+    Returns:
+        List containing, for each configuration, a dictionary with the best dev metrics, the test metrics at the
+        best dev step, and the best dev step.
+    """
+    options = train_dataset_options(cfgs[0])
+    for cfg, name in zip(cfgs[1:], names[1:]):
+        assert train_dataset_options(cfg) == options, \
+            'The training dataset options of %s differ from those of %s.' % (name, names[0])
+
+    data_loader.maybe_create_tf_record_files(data_dir)
+    inputs = create_model_inputs()
+    towers = []
+    for i, cfg in enumerate(cfgs):
+        with tf.variable_scope('tower_%d' % i):
+            towers.append(create_model(
+                cfg, data_loader.num_ent, data_loader.num_rel, use_parameter_lookup=use_parameter_lookup,
+                inputs=inputs))
+    savers = [_tower_saver('tower_%d' % i) for i in range(len(towers))]
+
+    # All towers are fed by the same iterators, and so the training and evaluation datasets are only created once.
+    train_iterator = create_train_dataset(data_loader, data_dir, cfgs[0]).make_initializable_iterator()
+    eval_datasets = create_eval_datasets(data_loader, data_dir, cfgs[0], dataset_types=('dev', 'test'))
+    eval_iterators = {
+        dataset_type: dataset.make_initializable_iterator()
+        for dataset_type, dataset in eval_datasets.items()}
+
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    session = tf.Session(config=config)
+    session.run(tf.global_variables_initializer())
+    data.initialize_query_tables(session)
+    session.run(train_iterator.initializer)
+    train_iterator_handle = session.run(train_iterator.string_handle())
+
+    # The evaluation samples are cached once and then used to evaluate every tower.
+    evaluator = MultiSplitEvaluator(
+        towers[0], batch_size=cfgs[0].training.batch_size, pad_batches=options['drop_remainder'])
+    for dataset_type, iterator in eval_iterators.items():
+        evaluator.add_split('%s_evaluation' % dataset_type, iterator, session.run(iterator.string_handle()))
+
+    results = [{'best_metrics_dev': None, 'metrics_test_at_best_dev': None, 'best_step': None} for _ in cfgs]
+    max_steps = max(cfg.training.max_steps for cfg in cfgs)
+    for step in range(max_steps):
+        # Towers stop training once they reach the `max_steps` of their configuration.
+        active = [i for i, cfg in enumerate(cfgs) if step < cfg.training.max_steps]
+        feed_dict = {inputs.iterator_handle: train_iterator_handle}
+        for i in active:
+            feed_dict[towers[i].is_train] = True
+        losses, _ = session.run(
+            ([towers[i].loss for i in active], [towers[i].train_op for i in active]), feed_dict)
+
+        for i, loss in zip(active, losses):
+            cfg = cfgs[i]
+            if cfg.eval.log_steps is not None and step % cfg.eval.log_steps == 0:
+                logger.info('%s | Step %6d | Loss: %10.4f', names[i], step, loss)
+            if cfg.eval.eval_steps is None or step % cfg.eval.eval_steps != 0:
+                continue
+            logger.info('Evaluating %s at step %d...', names[i], step)
+            eval_dir = os.path.join(output_dir, names[i], 'evaluation')
+            metrics = _metrics(evaluator.evaluate(
+                session, ['dev_evaluation', 'test_evaluation'], eval_dir, model=towers[i]))
+            result = results[i]
+            if is_better(metrics['dev_evaluation'], result['best_metrics_dev'], cfg.eval.validation_metric):
+                result['best_metrics_dev'] = metrics['dev_evaluation']
+                result['metrics_test_at_best_dev'] = metrics['test_evaluation']
+                result['best_step'] = step
+                ckpt_dir = os.path.join(output_dir, names[i], 'checkpoints')
+                os.makedirs(ckpt_dir, exist_ok=True)
+                savers[i].save(session, os.path.join(ckpt_dir, 'model_weights.ckpt'))
+            logger.info('%s | Best dev %s so far is at step %d. Best dev metrics: %s',
+                        names[i], cfg.eval.validation_metric, result['best_step'], str(result['best_metrics_dev']))
+
+    session.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--configs', nargs='+', required=True, help='Paths to the experiment config files.')
+    parser.add_argument('--loader', required=True, help='Name of the data loader class (e.g., `KinshipLoader`).')
+    parser.add_argument('--data_dir', required=True)
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--use_parameter_lookup', action='store_true')
+    args = parser.parse_args()
+
+    cfgs = []
+    for config_path in args.configs:
+        with open(config_path, 'r') as handle:
+            cfgs.append(AttributeDict(yaml.safe_load(handle)))
+    names = ['%d-%s' % (i, os.path.splitext(os.path.basename(path))[0]) for i, path in enumerate(args.configs)]
+
+    results = run_sweep(
+        cfgs, names, getattr(data, args.loader)(), args.data_dir, args.output_dir,
+        use_parameter_lookup=args.use_parameter_lookup)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, 'results.json')
+    with open(output_path, 'w') as handle:
+        json.dump([dict(result, config=path) for result, path in zip(results, args.configs)], handle, indent=2,
+                  sort_keys=True)
+    logger.info('Results written to: %s', output_path)
+
+
+if __name__ == '__main__':
+    main()
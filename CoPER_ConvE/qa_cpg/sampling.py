@@ -0,0 +1,97 @@
+from __future__ import absolute_import, division, print_function
+
+import logging
+import numpy as np
+import tensorflow as tf
+
+__all__ = ['NegativeSampler', 'build_alias_table', 'contains_sorted']
+
+logger = logging.getLogger(__name__)
+
+
+def build_alias_table(probabilities):
+    """Builds an alias table (using Vose's method) that allows sampling from a discrete distribution in O(1) time.
+
+    Arguments:
+        probabilities (np.ndarray): Unnormalized probabilities of the outcomes.
+
+    Returns:
+        Tuple containing the acceptance probability and the alias of each outcome.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    num_outcomes = len(probabilities)
+    scaled = probabilities * num_outcomes / np.sum(probabilities)
+    acceptance = np.ones([num_outcomes], dtype=np.float32)
+    alias = np.arange(num_outcomes, dtype=np.int64)
+    small = [i for i in range(num_outcomes) if scaled[i] < 1.0]
+    large = [i for i in range(num_outcomes) if scaled[i] >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        acceptance[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # Any remaining outcomes have an acceptance probability of 1 (up to numerical error).
+    return acceptance, alias
+
+
+def contains_sorted(sorted_values, queries):
+    """Checks which of the `queries` appear in `sorted_values`, in O(log(n)) time per query.
+
+    Arguments:
+        sorted_values (tf.Tensor): Sorted `int64` tensor. If it has rank 2, each row is searched separately.
+        queries (tf.Tensor): `int64` tensor with the same rank and leading dimension as `sorted_values`.
+
+    Returns:
+        Boolean tensor with the same shape as `queries`.
+    """
+    # We append a sentinel value that is larger than any entity index, so that the search position is always a
+    # valid index, even when `sorted_values` is empty.
+    sentinel = tf.fill(tf.concat([tf.shape(sorted_values)[:-1], [1]], axis=0), tf.constant(np.iinfo(np.int64).max))
+    sorted_values = tf.concat([sorted_values, sentinel], axis=-1)
+    positions = tf.searchsorted(sorted_values, queries, side='left')
+    if queries.shape.ndims == 1:
+        found = tf.gather(sorted_values, positions)
+    else:
+        found = tf.batch_gather(sorted_values, positions)
+    return tf.equal(found, queries)
+
+
+class NegativeSampler(object):
+    """Samples negative entities with a cost that does not depend on the number of entities.
+
+    Negatives are sampled with replacement, either uniformly or in proportion to the entity frequencies, in
+    which case sampling uses a precomputed alias table. The alias table is added to the default graph once, when the
+    sampler is created, and is shared by all `sample` calls, and so the sampler must be created in the graph in
+    which it is used.
+    """
+
+    def __init__(self, num_ent, distribution='uniform', entity_counts=None):
+        self.num_ent = num_ent
+        self.distribution = distribution
+        if distribution == 'uniform':
+            self._acceptance = None
+            self._alias = None
+        elif distribution == 'frequency':
+            assert entity_counts is not None, \
+                'Frequency-based negative sampling requires the entity counts.'
+            # We add one to all counts so that entities that never appear as answers can still be sampled.
+            acceptance, alias = build_alias_table(np.asarray(entity_counts) + 1.0)
+            # The alias table is only read by the input pipeline, which runs on the CPU.
+            with tf.device('/CPU:0'), tf.name_scope('negative_sampler'):
+                self._acceptance = tf.constant(acceptance, name='acceptance')
+                self._alias = tf.constant(alias, name='alias')
+        else:
+            raise ValueError('Unsupported negative sampling distribution: %s' % distribution)
+
+    def sample(self, shape):
+        """Returns an `int64` tensor with the provided shape, containing sampled entity indices."""
+        bins = tf.random_uniform(shape, maxval=self.num_ent, dtype=tf.int64)
+        if self.distribution == 'uniform':
+            return bins
+        coins = tf.random_uniform(shape, dtype=tf.float32)
+        return tf.where(tf.less(coins, tf.gather(self._acceptance, bins)), bins, tf.gather(self._alias, bins))
@@ -0,0 +1,282 @@
+"""Serves link predictions of a trained ConvE model over HTTP.
+
+The server loads a checkpoint along with the `entities.txt` and `relations.txt` files of its dataset, and answers
+`(e1, rel)` queries with the top-k `e2` entities and their scores. Concurrent queries are merged into micro-batches:
+a batch is run as soon as it contains `max_batch_size` queries, or once its oldest query has waited for
+`max_latency_ms` milliseconds.
+
+Endpoints:
+    POST /predict   Body: `{"queries": [{"e1": "...", "rel": "..."}, ...], "k": 10}`. Returns
+                    `{"results": [{"e2": [...], "scores": [...]}, ...]}`, with one result per query.
+    GET  /stats     Returns the number of queries and batches served, the mean batch size, the p50 and p99
+                    latencies (in milliseconds, over the most recent queries), and the throughput (in queries per
+                    second).
+
+Usage:
+    python -m qa_cpg.server --config [config.yml] --data_dir [data_dir] --checkpoint [ckpt] --port 8080
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import json
+import logging
+import numpy as np
+import os
+import queue
+import socketserver
+import tensorflow as tf
+import threading
+import time
+import yaml
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .ann import IVFPQIndex
+from .data import _DataLoader
+from .experiment import create_model
+from .utils.dict_with_attributes import AttributeDict
+
+__all__ = ['LinkPredictionServer']
+
+logger = logging.getLogger(__name__)
+
+
+class _Query(object):
+    def __init__(self, e1, rel, k):
+        self.e1 = e1
+        self.rel = rel
+        self.k = k
+        self.arrival_time = time.time()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _ServingStats(object):
+    """Keeps track of the latencies of the most recent queries and of the overall throughput."""
+
+    def __init__(self, window_size=10000):
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window_size)
+        self._start_time = time.time()
+        self._num_queries = 0
+        self._num_batches = 0
+
+    def record_batch(self, latencies):
+        with self._lock:
+            self._latencies.extend(latencies)
+            self._num_queries += len(latencies)
+            self._num_batches += 1
+
+    def summary(self):
+        with self._lock:
+            latencies = np.asarray(self._latencies) * 1000.0
+            num_queries = self._num_queries
+            num_batches = self._num_batches
+            elapsed_time = time.time() - self._start_time
+        return {
+            'num_queries': num_queries,
+            'num_batches': num_batches,
+            'mean_batch_size': num_queries / num_batches if num_batches > 0 else 0.0,
+            'p50_latency_ms': float(np.percentile(latencies, 50)) if len(latencies) > 0 else None,
+            'p99_latency_ms': float(np.percentile(latencies, 99)) if len(latencies) > 0 else None,
+            'queries_per_second': num_queries / elapsed_time}
+
+
+class LinkPredictionServer(object):
+    """Answers `(e1, rel)` queries using a trained ConvE model, merging concurrent queries into micro-batches.
+
+    Arguments:
+        cfg (AttributeDict): Configuration of the trained model.
+        data_dir (str): Directory containing the `entities.txt` and `relations.txt` files of the dataset.
+        checkpoint_path (str): Path to the checkpoint of the trained model.
+        use_parameter_lookup (bool, optional): Whether the model uses parameter lookup (e.g., if it was exported
+            using `qa_cpg.export`).
+        max_batch_size (int, optional): Maximum number of queries per batch.
+        max_latency_ms (float, optional): Maximum time that a query waits for other queries to be batched with.
+        max_k (int, optional): Maximum number of answers that can be requested per query.
+        ann_num_probes (int, optional): If provided, queries are answered approximately using an `IVFPQIndex`
+            that scans this many inverted lists per query, instead of scoring all entities.
+        ann_num_candidates (int, optional): Number of candidates that are re-scored exactly, when using the
+            approximate index.
+    """
+
+    def __init__(self, cfg, data_dir, checkpoint_path, use_parameter_lookup=False, max_batch_size=256,
+                 max_latency_ms=5.0, max_k=100, ann_num_probes=None, ann_num_candidates=100):
+        self.entity_ids = _DataLoader._read_index_file(os.path.join(data_dir, 'entities.txt'))
+        self.relation_ids = _DataLoader._read_index_file(os.path.join(data_dir, 'relations.txt'))
+        self.entity_names = sorted(self.entity_ids, key=self.entity_ids.get)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.max_k = min(max_k, len(self.entity_ids))
+        self.stats = _ServingStats()
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._model = create_model(
+                cfg, len(self.entity_ids), len(self.relation_ids), use_parameter_lookup=use_parameter_lookup,
+                inference_only=True)
+            top_k_scores, top_k_indices = self._model.top_k_predictions(self.max_k)
+            self._top_k = (tf.sigmoid(top_k_scores), top_k_indices)
+            config = tf.ConfigProto(allow_soft_placement=True)
+            config.gpu_options.allow_growth = True
+            self._session = tf.Session(config=config)
+            tf.train.Saver().restore(self._session, checkpoint_path)
+            logger.info('Restored the model from: %s', checkpoint_path)
+
+            self._ann_index = None
+            self.ann_num_probes = ann_num_probes
+            self.ann_num_candidates = ann_num_candidates
+            if ann_num_probes is not None:
+                logger.info('Building the approximate nearest neighbor index...')
+                ent_emb, pred_bias = self._session.run(
+                    [self._model.ent_emb_table, tf.convert_to_tensor(self._model.variables['pred_bias'])])
+                self._ann_index = IVFPQIndex(ent_emb, pred_bias)
+
+        self._queue = queue.Queue()
+        self._batching_thread = threading.Thread(target=self._run_batches)
+        self._batching_thread.daemon = True
+        self._batching_thread.start()
+
+    def predict(self, queries, k=10):
+        """Returns the top-`k` answers of each `(e1, rel)` query, as a list of `(entities, scores)` tuples.
+
+        This blocks until all the queries have been answered, and can be called from multiple threads.
+        """
+        if k < 1 or k > self.max_k:
+            raise ValueError('The number of answers must be between 1 and %d.' % self.max_k)
+        pending = []
+        for e1, rel in queries:
+            if e1 not in self.entity_ids:
+                raise KeyError('Unknown entity: %s' % e1)
+            if rel not in self.relation_ids:
+                raise KeyError('Unknown relation: %s' % rel)
+            pending.append(_Query(self.entity_ids[e1], self.relation_ids[rel], k))
+        for query in pending:
+            self._queue.put(query)
+        results = []
+        for query in pending:
+            query.done.wait()
+            if query.error is not None:
+                raise query.error
+            results.append(query.result)
+        return results
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].arrival_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_batches(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                feed_dict = {
+                    self._model.e1: np.array([query.e1 for query in batch], dtype=np.int64),
+                    self._model.rel: np.array([query.rel for query in batch], dtype=np.int64)}
+                if self._ann_index is None:
+                    scores, indices = self._session.run(self._top_k, feed_dict=feed_dict)
+                else:
+                    predicted_e2_emb = self._session.run(self._model.predicted_e2_emb, feed_dict=feed_dict)
+                    scores, indices = self._ann_index.search(
+                        predicted_e2_emb, self.max_k, num_probes=self.ann_num_probes,
+                        num_candidates=self.ann_num_candidates)
+                    scores = 1.0 / (1.0 + np.exp(-scores))
+                for query, query_scores, query_indices in zip(batch, scores, indices):
+                    # The ANN index pads the results with -1 when its probes find fewer than `max_k` candidates.
+                    found = query_indices >= 0
+                    query_scores, query_indices = query_scores[found], query_indices[found]
+                    query.result = (
+                        [self.entity_names[i] for i in query_indices[:query.k]],
+                        query_scores[:query.k].tolist())
+            except Exception as error:
+                logger.exception('Failed to run a batch of %d queries.', len(batch))
+                for query in batch:
+                    query.error = error
+            end_time = time.time()
+            self.stats.record_batch([end_time - query.arrival_time for query in batch])
+            for query in batch:
+                query.done.set()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _create_request_handler(server):
+    class RequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, server.stats.summary())
+            else:
+                self._send_json(404, {'error': 'Unknown endpoint: %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': 'Unknown endpoint: %s' % self.path})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                queries = [(query['e1'], query['rel']) for query in request['queries']]
+                results = server.predict(queries, k=int(request.get('k', 10)))
+            except (KeyError, ValueError, TypeError) as error:
+                self._send_json(400, {'error': str(error)})
+                return
+            except Exception as error:
+                self._send_json(500, {'error': str(error)})
+                return
+            self._send_json(200, {'results': [{'e2': e2, 'scores': scores} for e2, scores in results]})
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return RequestHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', required=True, help='Path to the config file saved while training.')
+    parser.add_argument('--data_dir', required=True, help='Directory containing `entities.txt` and `relations.txt`.')
+    parser.add_argument('--checkpoint', required=True, help='Path to the checkpoint of the trained model.')
+    parser.add_argument('--use_parameter_lookup', action='store_true')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max_batch_size', type=int, default=256)
+    parser.add_argument('--max_latency_ms', type=float, default=5.0)
+    parser.add_argument('--max_k', type=int, default=100)
+    parser.add_argument('--ann_num_probes', type=int, default=None,
+                        help='If provided, queries are answered using an approximate nearest neighbor index.')
+    parser.add_argument('--ann_num_candidates', type=int, default=100)
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as handle:
+        cfg = AttributeDict(yaml.safe_load(handle))
+    server = LinkPredictionServer(
+        cfg, args.data_dir, args.checkpoint, use_parameter_lookup=args.use_parameter_lookup,
+        max_batch_size=args.max_batch_size, max_latency_ms=args.max_latency_ms, max_k=args.max_k,
+        ann_num_probes=args.ann_num_probes, ann_num_candidates=args.ann_num_candidates)
+    http_server = _ThreadingHTTPServer((args.host, args.port), _create_request_handler(server))
+    logger.info('Serving on http://%s:%d...', args.host, args.port)
+    http_server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
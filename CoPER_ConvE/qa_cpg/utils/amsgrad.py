@@ -5,7 +5,9 @@ from __future__ import absolute_import, division, print_function
 import tensorflow as tf
 
 from tensorflow.python.framework import ops
+from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.ops import init_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import resource_variable_ops
 from tensorflow.python.ops import state_ops
@@ -13,7 +15,7 @@ from tensorflow.python.ops import variable_scope
 from tensorflow.python.training import optimizer
 from tensorflow.python.training import training_ops
 
-__all__ = ['AMSGradOptimizer']
+__all__ = ['AMSGradOptimizer', 'LazyAMSGradOptimizer']
 
 
 class AMSGradOptimizer(optimizer.Optimizer):
@@ -239,3 +241,105 @@ class AMSGradOptimizer(optimizer.Optimizer):
                     use_locking=self._use_locking)
         return control_flow_ops.group(*update_ops + [update_beta1, update_beta2],
                                       name=name_scope)
+
+
+class LazyAMSGradOptimizer(AMSGradOptimizer):
+    """Optimizer that implements a lazy version of the AMSGrad algorithm.
+
+    For variables with sparse gradients (e.g., embedding matrices), only the rows
+    that appear in the gradient are updated, along with their moment
+    accumulators. Each row keeps track of its own step count in a "step" slot,
+    which is used for bias correction, and which is only created for the
+    variables that receive `IndexedSlices` gradients. The cost of a step
+    therefore does not depend on the number of rows of the variable. Dense gradients are handled in
+    the same way as in `AMSGradOptimizer`.
+
+    Note that, unlike `AMSGradOptimizer`, the sparse behavior is not equivalent
+    to the dense behavior, because momentum decay is only applied to the rows
+    that are used.
+    """
+
+    def __init__(self, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8,
+                 use_locking=False, name="LazyAMSGrad"):
+        super(LazyAMSGradOptimizer, self).__init__(
+            learning_rate, beta1, beta2, epsilon, use_locking, name)
+
+        # Names of the variables that receive sparse gradients, set in apply_gradients().
+        self._sparse_var_names = set()
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = tuple(grads_and_vars)
+        self._sparse_var_names = set(
+            v.name for g, v in grads_and_vars if isinstance(g, ops.IndexedSlices))
+        return super(LazyAMSGradOptimizer, self).apply_gradients(grads_and_vars, global_step, name)
+
+    def _create_slots(self, var_list):
+        super(LazyAMSGradOptimizer, self)._create_slots(var_list)
+        # Create the per-row step counters, which are only used by the sparse updates.
+        for v in var_list:
+            if v.name in self._sparse_var_names and v.shape.ndims:
+                self._get_or_make_slot_with_initializer(
+                    v, init_ops.zeros_initializer(), v.shape[:1],
+                    v.dtype.base_dtype, "step", self._name)
+
+    def _apply_sparse_shared(self, grad, var, indices, scatter_update, scatter_sub):
+        lr_t = math_ops.cast(self._lr_t, var.dtype.base_dtype)
+        beta1_t = math_ops.cast(self._beta1_t, var.dtype.base_dtype)
+        beta2_t = math_ops.cast(self._beta2_t, var.dtype.base_dtype)
+        epsilon_t = math_ops.cast(self._epsilon_t, var.dtype.base_dtype)
+
+        # t <- t + 1 (for the updated rows only)
+        step = self.get_slot(var, "step")
+        step_t = array_ops.gather(step, indices) + 1
+        step_update = scatter_update(step, indices, step_t)
+
+        # Reshape the per-row step counters so that they broadcast over the
+        # remaining dimensions of the variable.
+        row_shape = array_ops.concat(
+            [array_ops.shape(indices),
+             array_ops.ones([array_ops.rank(grad) - 1], dtype=indices.dtype)], 0)
+        step_t = array_ops.reshape(step_t, row_shape)
+        lr = (lr_t * math_ops.sqrt(1 - math_ops.pow(beta2_t, step_t)) /
+              (1 - math_ops.pow(beta1_t, step_t)))
+
+        # m_t = beta1 * m + (1 - beta1) * g_t
+        m = self.get_slot(var, "m")
+        m_t = array_ops.gather(m, indices) * beta1_t + grad * (1 - beta1_t)
+        m_update = scatter_update(m, indices, m_t)
+
+        # v_t = beta2 * v + (1 - beta2) * (g_t * g_t)
+        v = self.get_slot(var, "v")
+        v_t = array_ops.gather(v, indices) * beta2_t + (grad * grad) * (1 - beta2_t)
+        v_update = scatter_update(v, indices, v_t)
+
+        v_hat = self.get_slot(var, "v_hat")
+        v_hat_t = math_ops.maximum(array_ops.gather(v_hat, indices), v_t)
+        v_hat_update = scatter_update(v_hat, indices, v_hat_t)
+
+        var_update = scatter_sub(
+            var, indices, lr * m_t / (math_ops.sqrt(v_hat_t) + epsilon_t))
+        return control_flow_ops.group(
+            *[var_update, m_update, v_update, v_hat_update, step_update])
+
+    def _apply_sparse(self, grad, var):
+        return self._apply_sparse_shared(
+            grad.values, var, grad.indices,
+            lambda x, i, v: state_ops.scatter_update(  # pylint: disable=g-long-lambda
+                x, i, v, use_locking=self._use_locking),
+            lambda x, i, v: state_ops.scatter_sub(  # pylint: disable=g-long-lambda
+                x, i, v, use_locking=self._use_locking))
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        return self._apply_sparse_shared(
+            grad, var, indices,
+            lambda x, i, v: resource_variable_ops.resource_scatter_update(  # pylint: disable=g-long-lambda
+                x.handle, i, v),
+            lambda x, i, v: resource_variable_ops.resource_scatter_sub(  # pylint: disable=g-long-lambda
+                x.handle, i, v))
+
+    def _resource_apply_sparse_duplicate_indices(self, grad, handle, indices):
+        # The lazy updates overwrite the gathered rows, and so repeated indices
+        # must be summed first.
+        summed_grad, unique_indices = self._deduplicate_indexed_slices(
+            values=grad, indices=indices)
+        return self._resource_apply_sparse(summed_grad, handle, unique_indices)
@@ -0,0 +1,110 @@
+"""Timeline tracing and per-op profiling of training steps."""
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import json
+import logging
+import os
+import re
+import tensorflow as tf
+
+from tensorflow.python.client import timeline
+
+__all__ = ['StepProfiler']
+
+logger = logging.getLogger(__name__)
+
+# Name scopes by which the op times and memory are aggregated. Ops in nested scopes (e.g., the parameter generators of
+# CPG models, which run in the `conv1` and `fc_layer` scopes) are aggregated by the path of all matching scopes
+# (e.g., `conv1/cpg`), and gradient ops by the scope of the ops they differentiate, prefixed by `gradients/`.
+DEFAULT_SCOPES = ('cpg', 'per_sample_conv', 'conv1', 'fc_layer', 'output_layer', 'loss', 'ranking')
+
+# Name of the ops that produce the next input batch. Their run time is the time that a step waited for the input
+# pipeline.
+_INPUT_OP_NAME = 'IteratorGetNext'
+
+
+class StepProfiler(object):
+    """Traces training steps and summarizes where their time goes.
+
+    For each traced step, this writes a Chrome trace (which can be opened at `chrome://tracing`) and a JSON summary
+    containing, for each device, the total run time, the number of ops, and the bytes allocated for the outputs of
+    the ops in each name scope, along with the peak memory of each allocator and the time that the step waited for
+    the input pipeline (i.e., the run time of `IteratorGetNext`).
+
+    Arguments:
+        output_dir (str): Directory in which to write the traces and the summaries.
+        scopes (tuple, optional): Name scopes by which the op times and memory are aggregated.
+    """
+
+    def __init__(self, output_dir, scopes=DEFAULT_SCOPES):
+        self.output_dir = output_dir
+        self.scopes = set(scopes)
+        os.makedirs(output_dir, exist_ok=True)
+
+    @staticmethod
+    def run_options():
+        """Returns the `tf.RunOptions` that enable full tracing."""
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+
+    def _scope(self, node_name):
+        # Some devices (e.g., GPU streams) append the op type to the node name.
+        components = node_name.split(':')[0].split('/')
+        if components[-1].startswith(_INPUT_OP_NAME):
+            return 'input'
+        # Repeated name scopes are made unique by appending a suffix (e.g., `conv1_1`).
+        matching = [c for c in (re.sub(r'_\d+$', '', c) for c in components[:-1]) if c in self.scopes]
+        scope = '/'.join(matching) if matching else 'other'
+        if 'gradients' in components:
+            scope = 'gradients/' + scope
+        return scope
+
+    def summarize(self, run_metadata):
+        """Aggregates the op times and memory of a traced step by device and name scope.
+
+        Returns:
+            Dictionary containing the `input_stall_ms` (the maximum over devices), and the per-device `scopes`
+            statistics (`time_ms`, `num_ops`, and `output_bytes`) and allocator `peak_bytes`.
+        """
+        devices = {}
+        input_stall_ms = 0.0
+        for device_stats in run_metadata.step_stats.dev_stats:
+            scopes = collections.defaultdict(lambda: {'time_ms': 0.0, 'num_ops': 0, 'output_bytes': 0})
+            peak_bytes = {}
+            for node_stats in device_stats.node_stats:
+                stats = scopes[self._scope(node_stats.node_name)]
+                stats['time_ms'] += node_stats.all_end_rel_micros / 1000.0
+                stats['num_ops'] += 1
+                stats['output_bytes'] += sum(
+                    output.tensor_description.allocation_description.allocated_bytes
+                    for output in node_stats.output)
+                for memory in node_stats.memory:
+                    peak_bytes[memory.allocator_name] = max(
+                        peak_bytes.get(memory.allocator_name, 0), memory.peak_bytes)
+            if 'input' in scopes:
+                input_stall_ms = max(input_stall_ms, scopes['input']['time_ms'])
+            devices[device_stats.device] = {'scopes': dict(scopes), 'peak_bytes': peak_bytes}
+        return {'input_stall_ms': input_stall_ms, 'devices': devices}
+
+    def record(self, step, run_metadata):
+        """Writes the Chrome trace and the summary of a traced step, and returns the summary."""
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True)
+        trace_path = os.path.join(self.output_dir, 'timeline_step_%d.json' % step)
+        with open(trace_path, 'w') as handle:
+            handle.write(trace)
+
+        summary = self.summarize(run_metadata)
+        summary['step'] = step
+        with open(os.path.join(self.output_dir, 'profile_step_%d.json' % step), 'w') as handle:
+            json.dump(summary, handle, indent=2, sort_keys=True)
+
+        scope_times = collections.defaultdict(float)
+        for device_summary in summary['devices'].values():
+            for scope, stats in device_summary['scopes'].items():
+                scope_times[scope] += stats['time_ms']
+        logger.info(
+            'Step %6d | Input stall: %8.2f ms | %s', step, summary['input_stall_ms'],
+            ' | '.join('%s: %.2f ms' % (scope, time_ms) for scope, time_ms in sorted(scope_times.items())))
+        logger.info('Step %d. Saved the timeline at %s.', step, trace_path)
+        return summary
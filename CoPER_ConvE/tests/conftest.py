@@ -0,0 +1,40 @@
+"""Shared fixtures of the tests, which run on a small synthetic dataset."""
+from __future__ import absolute_import, division, print_function
+
+import os
+import numpy as np
+import pytest
+
+_NUM_ENT = 30
+_NUM_REL = 4
+
+
+def _write_synthetic_dataset(directory, num_ent, num_rel, num_triples, seed=0):
+    # Writes random triples to `train.txt`, `dev.txt`, and `test.txt`, using 90%, 5%, and 5% of them.
+    rng = np.random.RandomState(seed)
+    triples = np.stack([
+        rng.randint(num_ent, size=num_triples),
+        rng.randint(num_rel, size=num_triples),
+        rng.randint(num_ent, size=num_triples)], axis=1)
+    splits = np.split(triples, [int(0.9 * num_triples), int(0.95 * num_triples)])
+    for filename, split in zip(['train.txt', 'dev.txt', 'test.txt'], splits):
+        with open(os.path.join(directory, filename), 'w') as handle:
+            for e1, rel, e2 in split:
+                handle.write('entity_%d\trelation_%d\tentity_%d\n' % (e1, rel, e2))
+
+
+@pytest.fixture
+def synthetic_dataset(tmpdir):
+    """Writes the raw files of a synthetic dataset and returns its directory, along with a data loader for it."""
+    pytest.importorskip('tensorflow')
+    from qa_cpg.data import _DataLoader
+
+    class SyntheticLoader(_DataLoader):
+        def __init__(self):
+            super(SyntheticLoader, self).__init__(
+                url=None, filenames=['train.txt', 'dev.txt', 'test.txt'], dataset_name='synthetic',
+                filetypes=['train', 'dev', 'test'], add_reverse_per_filetype=[True, False, False])
+
+    directory = str(tmpdir)
+    _write_synthetic_dataset(directory, _NUM_ENT, _NUM_REL, num_triples=400)
+    return directory, SyntheticLoader()
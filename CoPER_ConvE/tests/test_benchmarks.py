@@ -0,0 +1,25 @@
+"""Tests that the benchmark suite runs on a synthetic dataset, outside of a wandb run.
+
+Run from the `CoPER_ConvE` directory with:
+    python -m pytest tests
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import pytest
+
+pytest.importorskip('tensorflow')
+wandb = pytest.importorskip('wandb')
+
+from qa_cpg.benchmarks import suite
+
+
+def test_benchmark_ranking(synthetic_dataset):
+    directory, data_loader = synthetic_dataset
+    data_loader.maybe_create_tf_record_files(directory)
+    args = argparse.Namespace(eval_batch_size=16, device='/CPU:0', num_ranking_runs=2)
+
+    # The benchmarks never start a wandb run.
+    assert wandb.run is None
+    results = suite.benchmark_ranking(data_loader, directory, args)
+    assert 0.0 < results['min_seconds'] <= results['mean_seconds']
@@ -0,0 +1,53 @@
+"""Tests when the TF record files of a dataset are recreated.
+
+Run from the `CoPER_ConvE` directory with:
+    python -m pytest tests
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import pytest
+
+pytest.importorskip('tensorflow')
+
+
+def _read_lines(path):
+    with open(path, 'r') as handle:
+        return [line.strip() for line in handle]
+
+
+def test_tf_records_are_reused(synthetic_dataset):
+    directory, data_loader = synthetic_dataset
+    _, filenames, _ = data_loader.maybe_create_tf_record_files(directory)
+    manifest_mtime = os.path.getmtime(os.path.join(directory, 'tfrecords_manifest.json'))
+    _, reused_filenames, _ = data_loader.maybe_create_tf_record_files(directory)
+    assert reused_filenames == filenames
+    assert os.path.getmtime(os.path.join(directory, 'tfrecords_manifest.json')) == manifest_mtime
+
+
+def test_tf_records_are_recreated_when_max_records_per_file_changes(synthetic_dataset):
+    directory, data_loader = synthetic_dataset
+    _, filenames, _ = data_loader.maybe_create_tf_record_files(directory)
+    _, resharded_filenames, _ = data_loader.maybe_create_tf_record_files(directory, max_records_per_file=10)
+    assert len(resharded_filenames['train']) > len(filenames['train'])
+
+
+def test_index_files_are_regenerated(synthetic_dataset):
+    directory, data_loader = synthetic_dataset
+    data_loader.maybe_create_tf_record_files(directory)
+
+    # Keep only the triples of the first entity, so that most entities disappear from the inputs.
+    for filename in ['train.txt', 'dev.txt', 'test.txt']:
+        path = os.path.join(directory, filename)
+        lines = [line for line in _read_lines(path) if line.startswith('entity_0\t')]
+        with open(path, 'w') as handle:
+            handle.write(''.join(line + '\n' for line in lines))
+    data_loader.maybe_create_tf_record_files(directory)
+
+    entities = set()
+    for filename in ['train.txt', 'dev.txt', 'test.txt']:
+        for line in _read_lines(os.path.join(directory, filename)):
+            e1, _, e2 = line.split('\t')
+            entities.update([e1, e2])
+    assert set(_read_lines(os.path.join(directory, 'entities.txt'))) == entities
+    assert data_loader.num_ent == len(entities)
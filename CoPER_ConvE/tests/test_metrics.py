@@ -0,0 +1,96 @@
+"""Tests the evaluation metrics, including the evaluation of the train split, whose samples are stored once per
+query, without a target entity.
+
+Run from the `CoPER_ConvE` directory with:
+    python -m pytest tests
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('wandb')
+
+from qa_cpg import data, metrics
+from qa_cpg.benchmarks.common import create_model
+
+_BATCH_SIZE = 16
+
+
+def _train_triples(directory):
+    with open(os.path.join(directory, 'train.txt'), 'r') as handle:
+        return set(tuple(line.strip().split('\t')) for line in handle)
+
+
+def test_is_better():
+    assert metrics.is_better({'mrr': 0.2}, None, 'mrr')
+    assert metrics.is_better({'mrr': 0.3}, {'mrr': 0.2}, 'mrr')
+    assert not metrics.is_better({'mrr': 0.2}, {'mrr': 0.2}, 'mrr')
+    assert metrics.is_better({'mr': 10.0}, {'mr': 12.0}, 'mr')
+    assert not metrics.is_better({'mr': 12.0}, {'mr': 10.0}, 'mr')
+
+
+def test_bootstrap_confidence_intervals_without_ranks():
+    intervals = metrics._bootstrap_confidence_intervals(
+        np.zeros([0], dtype=np.int64), (1, 10), num_bootstrap_samples=10, confidence=0.95, seed=0)
+    assert sorted(intervals) == ['hits@1', 'hits@10', 'mr', 'mrr']
+    assert all(np.isnan(lower) and np.isnan(upper) for lower, upper in intervals.values())
+
+
+def test_take_samples():
+    split = {
+        'e1': np.array([0, 1, 2]),
+        'rel': np.array([0, 0, 1]),
+        'e2': np.array([7, 5, 2]),
+        'indptr': np.array([0, 2, 3, 6]),
+        'indices': np.array([7, 8, 5, 1, 2, 3])}
+    samples = metrics._take_samples(split, np.array([0, 2]))
+    np.testing.assert_array_equal(samples['e1'], [0, 2])
+    np.testing.assert_array_equal(samples['e2'], [7, 2])
+    np.testing.assert_array_equal(samples['indptr'], [0, 2, 5])
+    np.testing.assert_array_equal(samples['indices'], [7, 8, 1, 2, 3])
+
+
+@pytest.mark.parametrize('model_descriptors', [{}, {'eval_chunk_size': 7}, {'num_ent_partitions': 3}])
+def test_train_split_evaluation(synthetic_dataset, model_descriptors):
+    directory, data_loader = synthetic_dataset
+
+    with tf.Graph().as_default():
+        dataset = data_loader.eval_dataset(
+            directory=directory, dataset_type='train', batch_size=_BATCH_SIZE, include_inv_relations=False,
+            buffer_size=1024, prefetch_buffer_size=1)
+        iterator = dataset.make_initializable_iterator()
+        model = create_model(data_loader.num_ent, data_loader.num_rel, **model_descriptors)
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            data.initialize_query_tables(session)
+            evaluator = metrics.MultiSplitEvaluator(model, batch_size=_BATCH_SIZE)
+            evaluator.add_split('train_evaluation', iterator, session.run(iterator.string_handle()))
+            mr, mrr, hits, confidence_intervals = evaluator.evaluate(
+                session, ['train_evaluation'], directory)['train_evaluation']
+            _, sampled_mrr, _, sampled_confidence_intervals = evaluator.evaluate(
+                session, ['train_evaluation'], directory, sample_size=50, num_bootstrap_samples=10)[
+                    'train_evaluation']
+
+            # Every train triple is evaluated once, with a real target that is among the answers of its query.
+            samples = evaluator._cache['train_evaluation']
+            assert len(samples['e2']) == len(_train_triples(directory))
+            assert np.all(samples['e2'] >= 0)
+            for i, e2 in enumerate(samples['e2']):
+                assert e2 in samples['indices'][samples['indptr'][i]:samples['indptr'][i + 1]]
+
+            num_samples = len(samples['e2'])
+            ranks = np.concatenate([
+                session.run(model.filtered_ranks, evaluator._feed_dict(
+                    samples, start, min(start + _BATCH_SIZE, num_samples)))
+                for start in range(0, num_samples, _BATCH_SIZE)])
+
+    assert np.all(ranks >= 1) and np.all(ranks <= data_loader.num_ent)
+    np.testing.assert_allclose(mr, np.mean(ranks))
+    np.testing.assert_allclose(mrr, np.mean(1.0 / ranks))
+    assert 0.0 <= hits[1] <= hits[10] <= 1.0
+    assert confidence_intervals is None
+    assert 0.0 < sampled_mrr <= 1.0
+    assert sampled_confidence_intervals['mrr'][0] <= sampled_confidence_intervals['mrr'][1]
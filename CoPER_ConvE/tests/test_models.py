@@ -0,0 +1,57 @@
+"""Tests that the alternative implementations of the ConvE model components compute the same outputs.
+
+Run from the `CoPER_ConvE` directory with:
+    python -m pytest tests
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from qa_cpg.benchmarks.common import create_model
+from qa_cpg.models import _per_sample_conv2d
+
+_NUM_ENT = 50
+_NUM_REL = 6
+
+
+def test_per_sample_conv2d_implementations():
+    with tf.Graph().as_default():
+        inputs = tf.random_normal([8, 10, 20, 1], seed=0)
+        filters = tf.random_normal([8, 3, 3, 1, 32], seed=1)
+        outputs = [_per_sample_conv2d(inputs, filters, impl=impl) for impl in ['map_fn', 'im2col']]
+        with tf.Session() as session:
+            map_fn_outputs, im2col_outputs = session.run(outputs)
+    assert map_fn_outputs.shape == (8, 8, 18, 32)
+    np.testing.assert_allclose(im2col_outputs, map_fn_outputs, atol=1e-4)
+
+
+@pytest.mark.parametrize('model_descriptors', [
+    {'context_rel_conv': [8], 'context_rel_out': [8]},
+    {'context_rel_conv': None, 'context_rel_out': [8]},
+    {'context_rel_conv': [], 'context_rel_out': None}])
+def test_group_by_relation_inference(model_descriptors):
+    with tf.Graph().as_default():
+        # Both models share their variables, and only differ in whether the parameters are generated per relation.
+        models = []
+        for reuse, group_by_relation in [(False, True), (True, False)]:
+            with tf.variable_scope('model', reuse=reuse):
+                models.append(create_model(
+                    _NUM_ENT, _NUM_REL, inference_only=True, group_by_relation=group_by_relation,
+                    **model_descriptors))
+        assert models[0].group_by_relation and not models[1].group_by_relation
+
+        # The batch contains repeated relations, in no particular order.
+        random_state = np.random.RandomState(0)
+        e1 = random_state.randint(_NUM_ENT, size=32)
+        rel = random_state.randint(_NUM_REL, size=32)
+        feed_dict = {}
+        for model in models:
+            feed_dict[model.e1] = e1
+            feed_dict[model.rel] = rel
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            grouped, ungrouped = session.run([model.predictions_all for model in models], feed_dict)
+    np.testing.assert_allclose(grouped, ungrouped, rtol=1e-5, atol=1e-6)
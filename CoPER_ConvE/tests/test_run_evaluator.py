@@ -0,0 +1,80 @@
+"""Tests the background evaluator on the checkpoints of a synthetic training run.
+
+Run from the `CoPER_ConvE` directory with:
+    python -m pytest tests
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+wandb = pytest.importorskip('wandb')
+
+from qa_cpg.experiment import create_model
+from qa_cpg.run_evaluator import run_evaluator
+from qa_cpg.utils.dict_with_attributes import AttributeDict
+
+_LAST_STEP = 20
+
+
+def _config():
+    return AttributeDict({
+        'model': {
+            'entity_embedding_size': 16,
+            'relation_embedding_size': 4,
+            'concat_rel': False,
+            'input_dropout': 0.2,
+            'feature_map_dropout': 0.3,
+            'output_dropout': 0.2,
+            'label_smoothing_epsilon': 0.1,
+            'batch_norm_momentum': 0.99,
+            'batch_norm_train_stats': True},
+        'context': {
+            'context_rel_conv': None,
+            'context_rel_out': None,
+            'context_rel_dropout': 0.2,
+            'context_rel_use_batch_norm': True},
+        'training': {
+            'learning_rate': 0.001,
+            'batch_size': 16,
+            'device': '/CPU:0',
+            'prop_negatives': 2.0,
+            'num_labels': 8,
+            'one_positive_label_per_sample': False,
+            'cache_data': False},
+        'eval': {
+            'validation_metric': 'mrr',
+            'add_loss_summaries': False,
+            'add_variable_summaries': False,
+            'add_tensor_summaries': False}})
+
+
+def test_run_evaluator(synthetic_dataset):
+    directory, data_loader = synthetic_dataset
+    cfg = _config()
+    checkpoint_dir = os.path.join(directory, 'checkpoints')
+    eval_dir = os.path.join(directory, 'evaluation')
+    os.makedirs(eval_dir)
+
+    data_loader.maybe_create_tf_record_files(directory)
+    with tf.Graph().as_default():
+        create_model(cfg, data_loader.num_ent, data_loader.num_rel)
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            saver = tf.train.Saver()
+            for step in [10, _LAST_STEP]:
+                saver.save(session, os.path.join(checkpoint_dir, 'model_weights.ckpt'), global_step=step)
+
+    # The evaluator runs in its own process, which never starts a wandb run.
+    assert wandb.run is None
+    with tf.Graph().as_default():
+        best_metrics_dev, metrics_test_at_best_dev, best_step = run_evaluator(
+            cfg, data_loader, directory, checkpoint_dir, eval_dir, os.path.join(directory, 'summaries'),
+            last_step=_LAST_STEP, timeout=1)
+
+    assert best_step in [10, _LAST_STEP]
+    assert 0.0 < best_metrics_dev['mrr'] <= 1.0
+    assert 0.0 < metrics_test_at_best_dev['mrr'] <= 1.0
+    assert tf.train.latest_checkpoint(eval_dir, latest_filename='best_checkpoint') is not None
+    assert os.path.exists(os.path.join(eval_dir, 'best_embeddings.ckpt'))
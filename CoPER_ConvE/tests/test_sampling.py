@@ -0,0 +1,47 @@
+"""Tests the alias tables and the sorted membership checks used for negative sampling.
+
+Run from the `CoPER_ConvE` directory with:
+    python -m pytest tests
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from qa_cpg.sampling import build_alias_table, contains_sorted
+
+
+def _alias_table_distribution(acceptance, alias):
+    # Each outcome is drawn with probability `1 / n`, and is then kept with its acceptance probability or replaced
+    # by its alias otherwise.
+    num_outcomes = len(acceptance)
+    probabilities = acceptance.astype(np.float64) / num_outcomes
+    np.add.at(probabilities, alias, (1.0 - acceptance) / num_outcomes)
+    return probabilities
+
+
+@pytest.mark.parametrize('counts', [[1, 1, 1, 1], [1, 2, 3, 4], [10, 0, 0, 1, 5], [0, 0, 7]])
+def test_build_alias_table(counts):
+    acceptance, alias = build_alias_table(counts)
+    assert np.all(acceptance >= 0.0) and np.all(acceptance <= 1.0 + 1e-6)
+    assert np.all(alias >= 0) and np.all(alias < len(counts))
+    np.testing.assert_allclose(
+        _alias_table_distribution(acceptance, alias), np.asarray(counts) / float(np.sum(counts)), atol=1e-6)
+
+
+def test_contains_sorted():
+    with tf.Graph().as_default(), tf.Session() as session:
+        found = session.run(contains_sorted(
+            tf.constant([1, 4, 7], dtype=tf.int64), tf.constant([0, 1, 5, 7, 8], dtype=tf.int64)))
+        np.testing.assert_array_equal(found, [False, True, False, True, False])
+
+        # Queries after the last value are compared to the sentinel, and an empty row only contains the sentinel.
+        empty = session.run(contains_sorted(
+            tf.zeros([0], dtype=tf.int64), tf.constant([0, 3], dtype=tf.int64)))
+        np.testing.assert_array_equal(empty, [False, False])
+
+        batch_found = session.run(contains_sorted(
+            tf.constant([[2, 3], [5, 9]], dtype=tf.int64), tf.constant([[3, 4, 10], [0, 9, 5]], dtype=tf.int64)))
+        np.testing.assert_array_equal(batch_found, [[True, False, False], [False, True, True]])